@@ -1,5 +1,6 @@
 import asyncio
-from typing import Dict, Union, Tuple
+import time
+from typing import Dict, Union, Tuple, List, Callable, Awaitable
 
 # NameType = Union[str, Tuple[str]]
 NameType = Union[str, int, Tuple[Union[str, int]]]
@@ -8,10 +9,14 @@ NameType = Union[str, int, Tuple[Union[str, int]]]
 class FuturesPool:
     """
     Manage a collection of named futures.
+
+    A future is named by the response it waits for (e.g. a response code). Requests for the same name queue up
+    (see `request` and `acquire_timeout`), requests for different names can be in flight at the same time.
     """
 
     def __init__(self):
         self._futures: Dict[str, asyncio.Future] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
 
     def acquire(self, name: NameType):
         if isinstance(name, tuple):
@@ -21,42 +26,81 @@ class FuturesPool:
         assert isinstance(name, (str, int))
 
         existing = self._futures.get(name)
-        if existing and not existing.done():
+        lock = self._locks.get(name)
+        if (existing and not existing.done()) or (lock and lock.locked()):
+            # can't queue without awaiting, see acquire_timeout()
             raise Exception("already waiting for future named '%s'" % name)
 
         fut = asyncio.Future()
         self._futures[name] = fut
         return FutureContext(name, pool=self)
 
-    async def acquire_timeout(self, name: NameType, timeout):
-        if isinstance(name, tuple):
-            await asyncio.gather(*tuple(self.acquire_timeout(n, timeout) for n in name), return_exceptions=False)
-            return FutureContext(name, pool=self)
-
-        assert isinstance(name, (str, int))
-
-        existing = self._futures.get(name)
-        if existing and not existing.done():
-            for i in range(int(timeout * 10)):
-                await asyncio.sleep(.1)
-                if existing.done():
-                    existing = None
-                    break
-            if existing:
-                raise Exception("still waiting for future named '%s'" % name)
+    @staticmethod
+    async def _acquire_lock(lock: asyncio.Lock, timeout) -> bool:
+        """
+        Like wait_for(lock.acquire(), timeout), which can acquire the lock while the timeout cancels it (and leak it).
+        :return: False on timeout
+        """
+        acquire = asyncio.ensure_future(lock.acquire())
+        try:
+            await asyncio.wait((acquire,), timeout=timeout)
+        except BaseException:
+            if acquire.done() and not acquire.cancelled():
+                lock.release()
+            else:
+                acquire.cancel()
+            raise
+        if not acquire.done():
+            acquire.cancel()  # a pending acquire doesn't take the lock when cancelled
+            return False
+        return True
+
+    async def _lock(self, names: Tuple, timeout) -> List[asyncio.Lock]:
+        # lock in a fixed order, so requests with overlapping names don't dead-lock
+        locks = []
+        t_deadline = time.time() + timeout
+        try:
+            for n in sorted(names, key=str):
+                lock = self._locks.setdefault(n, asyncio.Lock())
+                if not await self._acquire_lock(lock, max(0., t_deadline - time.time())):
+                    raise asyncio.TimeoutError("still waiting for future named '%s'" % (names,))
+                locks.append(lock)
+        except BaseException:
+            for lock in locks:
+                lock.release()
+            raise
+        return locks
 
-        fut = asyncio.Future()
-        self._futures[name] = fut
-        return FutureContext(name, pool=self)
+    async def acquire_timeout(self, name: NameType, timeout):
+        """
+        Wait (up to `timeout`) until pending futures with the same name are done, then acquire.
+        Release by leaving the returned context.
+        """
+        names = name if isinstance(name, tuple) else (name,)
+        assert all(isinstance(n, (str, int)) for n in names)
+
+        locks = await self._lock(names, timeout)
+        for n in names:
+            self._futures[n] = asyncio.Future()
+        return FutureContext(name, pool=self, locks=locks)
+
+    async def request(self, name: NameType, send: Callable[[], Awaitable], timeout):
+        """
+        Send a request and wait for its response(s) `name`. Requests for the same name are queued (first come first
+        served), waiting for its turn counts into the timeout.
+        :param send: coroutine function that sends the request
+        :return: the response (or a list of responses if name is a tuple)
+        """
+        t_deadline = time.time() + timeout
+        with await self.acquire_timeout(name, timeout):
+            await send()
+            return await self.wait_for(name, max(0.01, t_deadline - time.time()))
 
     def set_result(self, name, value):
         fut = self._futures.get(name, None)
-        if fut:
-            if fut.done():
-                # silently remove done future 
-                self.remove(name)
-            else:
-                fut.set_result(value)
+        if fut and not fut.done():
+            # a done future keeps its result until the waiter picks it up
+            fut.set_result(value)
 
     def clear(self):
         for fut in self._futures.values():
@@ -87,12 +131,15 @@ class FuturesPool:
 
 
 class FutureContext:
-    def __init__(self, name: NameType, pool: FuturesPool):
+    def __init__(self, name: NameType, pool: FuturesPool, locks: List[asyncio.Lock] = ()):
         self.name = name
         self.pool = pool
+        self.locks = locks
 
     def __enter__(self):
         pass
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.pool.remove(self.name)
+        for lock in self.locks:
+            lock.release()
@@ -0,0 +1,126 @@
+"""
+Placement of BMS devices on multiple bluetooth adapters (hci0, hci1, ..).
+
+Each device is placed on the adapter with the best score, combining the connection success rate of the device on
+that adapter, the signal strength (RSSI) the adapter sees and the number of devices already on the adapter.
+After repeated connection failures a device migrates to the best other adapter.
+"""
+import asyncio
+from collections import defaultdict
+from typing import List, Dict, Optional, Tuple, Set
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+
+class AdapterPool:
+    RSSI_MIN = -100  # dBm, score 0
+    RSSI_MAX = -40  # dBm, score 1
+
+    W_SUCCESS = 2.
+    W_RSSI = 1.
+    W_LOAD = .25
+
+    def __init__(self, adapters: List[str], migrate_after=3):
+        """
+
+        :param adapters: adapter names, e.g. ['hci0', 'hci1']
+        :param migrate_after: move a device to another adapter after this many connection failures in a row
+        """
+        assert adapters, "no adapters"
+        self.adapters = list(adapters)
+        self.migrate_after = migrate_after
+
+        self._placement: Dict[str, str] = {}  # address -> adapter
+        self._rssi: Dict[Tuple[str, str], int] = {}  # (adapter, address) -> rssi
+        self._num_ok: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._num_fail: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._fails_row: Dict[str, int] = defaultdict(int)
+        self._scanned = set()  # adapters that ran a discovery
+
+    def __str__(self):
+        return 'AdapterPool(%s)' % ','.join('%s:%d' % (a, self.load(a)) for a in self.adapters)
+
+    async def discover(self, timeout=10, targets: Optional[Set[str]] = None):
+        """
+        Scan on all adapters concurrently and record the RSSI of each device.
+        :param targets: addresses and names to look for, an adapter stops scanning as soon as it saw all of them
+        :return: discovered devices (BLEDevice), one per address
+        """
+        from bleak import BleakScanner
+        from bmslib.bt import bt_scan
+
+        async def _scan(adapter):
+            try:
+                if targets is not None:
+                    return adapter, await bt_scan(targets, timeout=timeout, adapter=adapter)
+                return adapter, await BleakScanner.discover(timeout=timeout, adapter=adapter, return_adv=True)
+            except Exception as e:
+                logger.warning('Discovery on adapter %s failed: %s', adapter, e)
+                return adapter, {}
+
+        devices = {}
+        for adapter, found in await asyncio.gather(*map(_scan, self.adapters)):
+            if found:
+                self._scanned.add(adapter)
+            for address, (dev, adv) in found.items():
+                self._rssi[(adapter, address)] = adv.rssi
+                devices.setdefault(address, dev)
+        return list(devices.values())
+
+    def load(self, adapter: str) -> int:
+        return sum(a == adapter for a in self._placement.values())
+
+    def score(self, adapter: str, address: str) -> float:
+        key = (adapter, address)
+        success_rate = (self._num_ok[key] + 1) / (self._num_ok[key] + self._num_fail[key] + 2)
+
+        rssi = self._rssi.get(key)
+        if rssi is None:
+            # an adapter that scanned and did not see the device is unlikely to reach it
+            rssi_score = 0. if adapter in self._scanned else .5
+        else:
+            rssi_score = min(1., max(0., (rssi - self.RSSI_MIN) / (self.RSSI_MAX - self.RSSI_MIN)))
+
+        load = self.load(adapter) - (self._placement.get(address) == adapter)
+        return self.W_SUCCESS * success_rate + self.W_RSSI * rssi_score - self.W_LOAD * load
+
+    def best_adapter(self, address: str, exclude: Optional[str] = None) -> str:
+        candidates = [a for a in self.adapters if a != exclude] or self.adapters
+        return max(candidates, key=lambda a: self.score(a, address))
+
+    async def add(self, bms):
+        """ Place the BMS on an adapter and let it report its connection results """
+        adapter = self.best_adapter(bms.address)
+        self._placement[bms.address] = adapter
+        bms.adapter_pool = self
+        await bms.set_adapter(adapter)
+        logger.info('%s placed on adapter %s (score %.2f)', bms.name, adapter, self.score(adapter, bms.address))
+
+    async def report(self, bms, ok: bool):
+        adapter = self._placement.get(bms.address)
+        if adapter is None:
+            return
+        key = (adapter, bms.address)
+
+        if ok:
+            self._num_ok[key] += 1
+            self._fails_row[bms.address] = 0
+            return
+
+        self._num_fail[key] += 1
+        self._fails_row[bms.address] += 1
+        if self._fails_row[bms.address] < self.migrate_after or len(self.adapters) < 2:
+            return
+
+        target = self.best_adapter(bms.address, exclude=adapter)
+        logger.warning('%s failed to connect %d times on %s, migrating to %s', bms.name,
+                       self._fails_row[bms.address], adapter, target)
+        self._fails_row[bms.address] = 0
+        self._placement[bms.address] = target
+        try:
+            await bms.set_adapter(target)
+        except Exception as e:
+            logger.warning('%s migration failed: %s', bms.name, e)
+            self._placement[bms.address] = adapter
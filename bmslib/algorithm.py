@@ -1,5 +1,5 @@
 import time
-from typing import Optional, Union
+from typing import Optional, Union, List
 
 from bmslib.bms import BmsSample
 from bmslib.util import get_logger, dict_to_short_string
@@ -41,6 +41,10 @@ class BaseAlgorithm:
     def update(self, sample: BmsSample) -> UpdateResult:
         raise NotImplementedError()
 
+    def soc_thresholds(self) -> List[float]:
+        """ SoC levels where the algorithm might switch """
+        return []
+
 
 class SocArgs:
     def __init__(self, charge_stop, charge_start=None, discharge_stop=None, discharge_start=None,
@@ -82,13 +86,22 @@ class SocAlgorithm(BaseAlgorithm):
 
     # def restore(self, charging, last_calibration_time):
 
+    def soc_thresholds(self) -> List[float]:
+        thresholds = [self.args.charge_start, self.args.charge_stop]
+        if self.calibration_due(time.time()):
+            thresholds.append(100)
+        return thresholds
+
+    def calibration_due(self, now: float) -> bool:
+        return bool(self.args.calibration_interval_s) and \
+            now - self.state.last_calibration_time > self.args.calibration_interval_s
+
     def update(self, sample: BmsSample) -> Optional[UpdateResult]:
         # SOC_SPAN_MARGIN = 1 / 5
 
         if self.args.calibration_interval_s:
             time_since_last_calib = sample.timestamp - self.state.last_calibration_time
-            need_calibration = time_since_last_calib > self.args.calibration_interval_s
-            if need_calibration:
+            if self.calibration_due(sample.timestamp):
                 if sample.soc == 100:
                     logger.info('Reached 100% soc, calibration done.')
                     self.state.last_calibration_time = sample.timestamp
@@ -1,7 +1,7 @@
 import math
 import time
 from copy import copy
-from typing import List, Dict, Optional
+from typing import Any, Callable, List, Dict, Hashable, Optional, Set, Tuple
 
 MIN_VALUE_EXPIRY = 20
 
@@ -25,6 +25,119 @@ class DeviceInfo:
         return s + ')'
 
 
+class FetchPlan:
+    """
+    Declares how often each class of data is fetched from a BMS, in seconds. An interval of 0 fetches the data with
+    every sample. The sample itself is fetched every `sample_period`.
+
+    * voltages: cell voltages
+    * temperatures: temperature sensors
+    * status: switches and status flags (if the BMS needs an extra query for it)
+    * device_info: hardware and software version etc.
+    """
+
+    def __init__(self, voltages=0., temperatures=30., status=30., device_info=60. * 5):
+        self.intervals: Dict[str, float] = dict(voltages=voltages, temperatures=temperatures, status=status,
+                                                device_info=device_info)
+        self._t_last: Dict[str, float] = {}
+        self._pending: Set[str] = set()
+
+    def __str__(self):
+        return 'FetchPlan(%s)' % ','.join('%s=%g' % kv for kv in self.intervals.items())
+
+    def update(self, spec: str):
+        """
+        Override intervals from a config string, e.g. `voltages=10,temperatures=60`
+        :param spec:
+        """
+        for kv in filter(bool, spec.replace(';', ',').split(',')):
+            k, v = kv.split('=')
+            k = k.strip()
+            if k not in self.intervals:
+                raise ValueError("unknown data class '%s' in fetch plan (expected one of %s)" % (
+                    k, ', '.join(self.intervals.keys())))
+            self.intervals[k] = float(v)
+
+    def due(self, kind: str, now: Optional[float] = None) -> bool:
+        t_last = self._t_last.get(kind)
+        if t_last is None:
+            return True
+        return ((now or time.time()) - t_last) >= self.intervals[kind]
+
+    def done(self, kind: str, now: Optional[float] = None):
+        self._t_last[kind] = now or time.time()
+        self._pending.discard(kind)
+
+    def prefetched(self, kind: str, now: Optional[float] = None):
+        """
+        The BMS read `kind` ahead along with the sample. It counts as fetched, the consumer picks it up with the next
+        fetch_<kind>() call, see pending()
+        """
+        self.done(kind, now)
+        self._pending.add(kind)
+
+    def pending(self, kind: str) -> bool:
+        return kind in self._pending
+
+    def reset(self, kind: str):
+        """ fetch `kind` with the next sample """
+        self._t_last.pop(kind, None)
+
+
+class QueryCache:
+    """
+    Per-connection cache of query responses, so data that doesn't change isn't queried with every sample.
+    Models declare the lifetime of their queries (by response name) in `BtBms.QUERY_LIFETIMES`:
+
+    * static: device info, cell count, rated capacity. Queried once per connection
+    * slow: settings and switch states. Queried again after the `status` interval of the FetchPlan
+    * dynamic: queried with every sample, never cached. This is the default for undeclared queries
+
+    BtBms clears the cache on disconnect and drops the slow entries after set_switch().
+    """
+    STATIC = 'static'
+    SLOW = 'slow'
+    DYNAMIC = 'dynamic'
+
+    def __init__(self, lifetimes: Dict[Hashable, str], fetch_plan: FetchPlan):
+        assert set(lifetimes.values()) <= {self.STATIC, self.SLOW, self.DYNAMIC}, "unknown lifetime in %s" % lifetimes
+        self.lifetimes = lifetimes
+        self.fetch_plan = fetch_plan
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+
+    def lifetime(self, name) -> str:
+        return self.lifetimes.get(name, self.DYNAMIC)
+
+    def get(self, name, default=None):
+        entry = self._entries.get(name)
+        if entry is None:
+            return default
+        t, value = entry
+        if self.lifetime(name) == self.SLOW and time.time() - t >= self.fetch_plan.intervals['status']:
+            del self._entries[name]
+            return default
+        return value
+
+    def __contains__(self, name):
+        return self.get(name, _MISSING) is not _MISSING
+
+    def put(self, name, value):
+        """ store `value`, unless `name` is a dynamic query """
+        if self.lifetime(name) != self.DYNAMIC:
+            self._entries[name] = (time.time(), value)
+
+    def invalidate(self, lifetime: Optional[str] = None):
+        """ drop all entries, or only those of `lifetime` """
+        if lifetime is None:
+            self._entries.clear()
+        else:
+            for name in [n for n in self._entries if self.lifetime(n) == lifetime]:
+                del self._entries[name]
+
+
+_MISSING = object()
+
+
 class PowerMonitorSample:
     # Todo this is a draft
     def __init__(self, voltage, current, power=math.nan, total_energy=math.nan):
@@ -60,11 +173,7 @@ class BmsSample:
         self._power = power  # 0 -> +0
         self.balance_current = balance_current
 
-        # infer soc from capacity if soc is nan or type(soc)==int (for higher precision)
-        if capacity > 0 and (math.isnan(soc) or (isinstance(soc, int) and charge > 0)):
-            soc = round(charge / capacity * 100, 2)
-        elif math.isnan(capacity) and soc > .2:
-            capacity = round(charge / soc * 100)
+        soc, capacity = self._infer_soc(soc, charge, capacity)
 
         # assert math.isfinite(soc)
 
@@ -84,6 +193,15 @@ class BmsSample:
         if switches:
             assert all(map(lambda x: isinstance(x, bool), switches.values())), "non-bool switches values %s" % switches
 
+    @staticmethod
+    def _infer_soc(soc, charge, capacity):
+        # infer soc from capacity if soc is nan or type(soc)==int (for higher precision)
+        if capacity > 0 and (math.isnan(soc) or (isinstance(soc, int) and charge > 0)):
+            soc = round(charge / capacity * 100, 2)
+        elif math.isnan(capacity) and soc > .2:
+            capacity = round(charge / soc * 100)
+        return soc, capacity
+
     @property
     def power(self):
         """
@@ -115,3 +233,66 @@ class BmsSample:
         if not math.isnan(res._power) and res._power != 0:
             res._power *= x
         return res
+
+
+# BmsSample attributes and their defaults
+SAMPLE_DEFAULTS = dict(voltage=math.nan, current=math.nan, _power=math.nan, balance_current=math.nan,
+                       charge=math.nan, capacity=math.nan, soc=math.nan, cycle_capacity=math.nan,
+                       num_cycles=math.nan, temperatures=None, mos_temperature=math.nan, switches=None,
+                       uptime=math.nan)
+
+
+class LazyBmsSample(BmsSample):
+    """
+    A BmsSample that keeps the raw frame and decodes a field on first access (then caches it). Cheap to create for
+    every notification of a streaming BMS, when most of the samples are only used for the current and power meters.
+
+    Fields are read from the compiled layout by name, `fields` overrides this for values that need more than a
+    layout field (e.g. a list of temperatures). Keyword arguments set fields that are already decoded.
+    The frame must not change after creating the sample.
+    """
+
+    def __init__(self, frame, layout, fields: Optional[Dict[str, Callable[['LazyBmsSample'], Any]]] = None,
+                 timestamp: Optional[float] = None, **values):
+        self._lazy_frame = frame
+        self._lazy_layout = layout  # CompiledLayout
+        self._lazy_fields = fields or {}
+        self.timestamp = timestamp or time.time()
+        self.num_samples = 0
+        self.__dict__.update(values)
+
+    def raw(self, name: str):
+        """ decode the layout field `name` """
+        return self._lazy_layout.unpack_field(self._lazy_frame, name)
+
+    def _decode(self, name: str):
+        if name in self.__dict__:
+            return self.__dict__[name]
+        fn = self._lazy_fields.get(name)
+        if fn is not None:
+            return fn(self)
+        if name in self._lazy_layout.names:
+            return self.raw(name)
+        return SAMPLE_DEFAULTS[name]
+
+    def __getattr__(self, name):
+        # only called for attributes that are not decoded yet
+        if name.startswith('_lazy') or name not in SAMPLE_DEFAULTS:
+            raise AttributeError(name)
+
+        if name == 'soc' or name == 'capacity':
+            soc, capacity = self._infer_soc(self._decode('soc'), self.charge, self._decode('capacity'))
+            self.__dict__.setdefault('soc', soc)
+            self.__dict__.setdefault('capacity', capacity)
+            return self.__dict__[name]
+
+        v = self._decode(name)
+        if name == 'current':
+            v = v or 0  # -0 -> +0
+        self.__dict__[name] = v
+        return v
+
+    def values(self):
+        d = {name: getattr(self, name) for name in SAMPLE_DEFAULTS}
+        d.update((k, v) for k, v in self.__dict__.items() if not k.startswith('_lazy'))
+        return {**d, "power": self.power}
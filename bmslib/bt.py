@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import backoff
 import bleak.exc
 import re
@@ -7,10 +8,11 @@ import time
 import uuid
 from bleak import BleakClient, BleakScanner
 from bleak.backends.characteristic import BleakGATTCharacteristic
-from typing import Callable, List, Union, Iterable
+from typing import Any, Awaitable, Callable, List, Union, Iterable, Optional, Set, Tuple
 
-from . import FuturesPool
-from .bms import BmsSample, DeviceInfo
+from . import FuturesPool, store
+from .bms import BmsSample, DeviceInfo, FetchPlan, QueryCache
+from .scanner import get_scanner
 from .util import get_logger
 
 BleakDeviceNotFoundError = getattr(bleak.exc, 'BleakDeviceNotFoundError', bleak.exc.BleakError)
@@ -18,10 +20,45 @@ BleakDeviceNotFoundError = getattr(bleak.exc, 'BleakDeviceNotFoundError', bleak.
 CharSpec = Union[BleakGATTCharacteristic, int, str, uuid.UUID]
 
 
+async def bt_scan(targets: Iterable[str], timeout: float = 10, adapter: Optional[str] = None) -> dict:
+    """
+    Scan until every target (address or name) was seen or the timeout expires.
+    :return: address -> (BLEDevice, AdvertisementData) of all devices seen
+    """
+    found = {}
+    remaining = set(t.strip().lower() for t in targets)
+    all_seen = asyncio.Event()
+    scanner = get_scanner(adapter)
+
+    def on_detection(device, adv):
+        found[device.address] = (device, adv)
+        scanner.record(device, adv)  # advertisement data for type auto-detection
+        remaining.discard(device.address.lower())
+        remaining.discard((device.name or '').strip().lower())
+        if not remaining:
+            all_seen.set()
+
+    kwargs = dict(adapter=adapter) if adapter else {}
+    async with BleakScanner(detection_callback=on_detection, **kwargs):
+        try:
+            await asyncio.wait_for(all_seen.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    return found
+
+
 @backoff.on_exception(backoff.expo, Exception, max_time=10, logger=None)
-async def bt_discovery(logger):
+async def bt_discovery(logger, targets: Optional[Set[str]] = None):
+    """
+    :param targets: addresses and names to look for, the scan ends as soon as all were seen. None for a full scan
+    """
     logger.info('BT Discovery:')
-    devices = await BleakScanner.discover()
+    if targets is None:
+        devices = await BleakScanner.discover()
+    else:
+        t0 = time.time()
+        devices = [dev for dev, adv in (await bt_scan(targets)).values()]
+        logger.info('Scan for %d devices took %.1fs', len(targets), time.time() - t0)
     if not devices:
         logger.info(' - no devices found - ')
     for d in devices:
@@ -68,17 +105,45 @@ def bt_power(on):
 class BtBms:
     shutdown = False
 
+    SUPPORTS_PUSH = False  # True if the BMS streams samples on its own, see subscribe()
+    DISCOVERABLE = True  # the BMS advertises and is found by a bluetooth scan
+    PASSIVE = False  # True if the BMS is read from its advertisements and never connected
+    FETCH_INTERVALS = {}  # overrides FetchPlan defaults for this model, e.g. dict(voltages=10)
+    TIMEOUT = 10  # default response timeout in seconds, see _q_batch()
+    QUERY_LIFETIMES = {}  # response name -> QueryCache.STATIC or QueryCache.SLOW, e.g. {0x94: QueryCache.STATIC}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'set_switch' in cls.__dict__:
+            cls.set_switch = _invalidate_after_switch(cls.__dict__['set_switch'])
+
     def __init__(self, address: str, name: str, keep_alive=False, psk=None, adapter=None, verbose_log=False,
+                 capture: Optional[str] = None, replay: Optional[str] = None, replay_speed: float = 1.,
                  _uses_pin=False):
+        """
+        :param capture: record the bluetooth traffic to this file, see bmslib.replay
+        :param replay: serve the traffic from this capture file instead of connecting
+        :param replay_speed: replay speed factor, 0 for no delays
+        """
         self.address = address
+        self._gatt_cache_key = store.gatt_cache_key(address)  # the BLE address, validated once
         self.name = name
         self.keep_alive = keep_alive
         self.verbose_log = verbose_log
         self.logger = get_logger(verbose_log)
         self._fetch_futures = FuturesPool()
         self._psk = psk
+        self._recorder = None
+        if capture:
+            from bmslib.replay import CaptureRecorder
+            self._recorder = CaptureRecorder(capture)  # one per device, shared by the clients of set_adapter()
         self._connect_time = 0
         self._pending_disconnect_call = False
+        self.fetch_plan = FetchPlan(**self.FETCH_INTERVALS)
+        self.query_cache = QueryCache(self.QUERY_LIFETIMES, self.fetch_plan)
+
+        self.adapter_pool = None  # AdapterPool, if the adapter is picked automatically
+        self.connection_pool = None  # ConnectionPool, if it manages keep-alive
 
         if not _uses_pin and psk:
             self.logger.warning('%s usually does not use a pairing PIN', type(self).__name__)
@@ -87,8 +152,11 @@ class BtBms:
             from bmslib.models.dummy import BleakDummyClient
             self.client = BleakDummyClient(address, disconnected_callback=self._on_disconnect)
             self._adapter = "fake"
+        elif replay:
+            from bmslib.replay import ReplayClient
+            self.client = ReplayClient(replay, address, disconnected_callback=self._on_disconnect, speed=replay_speed)
+            self._adapter = "fake"
         else:
-            kwargs = {}
             if psk:
                 try:
                     import bleak.backends.bluezdbus.agent
@@ -101,13 +169,9 @@ class BtBms:
             self._adapter = adapter
             if adapter:  # hci0, hci1 (BT adapter hardware)
                 self.logger.info('Using adapter %s', adapter)
-                kwargs['adapter'] = adapter
 
-            self.client = BleakClient(address,
-                                      handle_pairing=bool(psk),
-                                      disconnected_callback=self._on_disconnect,
-                                      **kwargs
-                                      )
+            # passive devices are read from advertisements and have no connection
+            self.client = None if self.PASSIVE else self._create_client(adapter)
 
             self._in_disconnect = False
 
@@ -117,16 +181,57 @@ class BtBms:
             """
             self._pending_disconnect_call = False
 
+    def _create_client(self, adapter: Optional[str]) -> BleakClient:
+        kwargs = {}
+        if adapter:
+            kwargs['adapter'] = adapter
+        client = BleakClient(self.address,
+                             handle_pairing=bool(self._psk),
+                             disconnected_callback=self._on_disconnect,
+                             **kwargs
+                             )
+        if self._recorder:
+            from bmslib.replay import RecordingClient
+            client = RecordingClient(client, self._recorder)
+        return client
+
+    async def set_adapter(self, adapter: Optional[str]):
+        """
+        Move the device to another bluetooth adapter. The BMS must be disconnected.
+        :param adapter: hci0, hci1, .. or None for the default adapter
+        """
+        if self._adapter == "fake":
+            return  # dummy and replay clients don't use an adapter
+        if self.is_connected:
+            raise RuntimeError("can't change adapter of connected %s" % self.name)
+        if adapter == self._adapter:
+            return
+        self.logger.info('%s adapter %s -> %s', self.name, self._adapter or "default", adapter or "default")
+        if self.client:
+            try:
+                # a failed connect attempt can leave the client half-connected
+                await self.client.disconnect()
+            except Exception as e:
+                self.logger.debug('%s error disconnecting old client: %s', self.name, e)
+        self._adapter = adapter
+        self.client = None if self.PASSIVE else self._create_client(adapter)
+
     @property
     def connect_time(self):
         return self._connect_time
 
+    @property
+    def adapter(self) -> str:
+        """ name of the bluetooth adapter this BMS connects through """
+        return self._adapter or "default"
+
     async def start_notify(self, char_specifier: Union[CharSpec, List[CharSpec]],
                            callback: Callable[[int, bytearray], None], **kwargs) -> CharSpec:
         """
         This function wraps BleakClient.start_notify, differences:
           * Accept a list of char_specifiers and tries them until it finds a match
           * Before subscribing it un-subscribes dangling subscriptions
+          * Tries the char_specifier that worked with the last connection first (see gatt_cache())
         :param char_specifier:
         :param callback:
         :param kwargs:
@@ -134,6 +239,15 @@ class BtBms:
         """
         if not isinstance(char_specifier, list):
             char_specifier = [char_specifier]
+
+        cached = self.gatt_cache().get('notify')
+        if cached in char_specifier:
+            try:
+                await self.client.start_notify(cached, callback, **kwargs)
+                return cached
+            except Exception as e:
+                self.logger.debug('start_notify %s (cached) failed: %s', cached, e)
+
         exception = None
         for cs in char_specifier:
             try:
@@ -142,12 +256,26 @@ class BtBms:
                 except:
                     pass
                 await self.client.start_notify(cs, callback, **kwargs)
+                if len(char_specifier) > 1 and isinstance(cs, (int, str)):
+                    self.remember_gatt(notify=cs)
                 return cs
             except Exception as e:
                 exception = e
         await enumerate_services(self.client, self.logger)
         raise exception
 
+    def gatt_cache(self, firmware: Optional[str] = None) -> dict:
+        """
+        Characteristics and frame variant that worked with the last connection, to skip probing on reconnect.
+        Models must fall back to probing if a cached value fails.
+        :param firmware: ignore values recorded with another firmware
+        """
+        return store.load_gatt_cache(self._gatt_cache_key, firmware)
+
+    def remember_gatt(self, firmware: Optional[str] = None, **values):
+        """ record resolved characteristics (handles or UUIDs) and frame variant for the next connection """
+        store.store_gatt_cache(self._gatt_cache_key, firmware, **values)
+
     def find_char(self, uuid_or_handle: Union[str, int], property_name: str, service=None) -> Union[
         None, BleakGATTCharacteristic]:
         for service in ((service,) if service else self.client.services):
@@ -172,6 +300,8 @@ class BtBms:
         # if not self._in_disconnect:
         #    self._pending_disconnect_call = True
 
+        self.query_cache.invalidate()
+
         try:
             self._fetch_futures.clear()
         except Exception as e:
@@ -186,13 +316,21 @@ class BtBms:
                              self._adapter or "default", timeout)
         # bleak`s connect timeout is buggy (on macos)
         try:
-            await asyncio.wait_for(self.client.connect(timeout=timeout), timeout=timeout + 1)
+            async with get_scanner(self._adapter).paused():
+                await asyncio.wait_for(self.client.connect(timeout=timeout), timeout=timeout + 1)
         except getattr(bleak.exc, 'BleakDeviceNotFoundError', bleak.exc.BleakError) as exc:
-            self.logger.error("%s, starting scanner", exc)
-            await bt_discovery(self.logger)
+            # the shared scanner keeps looking for the device, the next attempt can find it
+            scanner = get_scanner(self._adapter)
+            self.logger.error("%s, %s", exc, scanner.get(self.address) or 'not seen yet, scanning')
+            self.adapter_pool and await self.adapter_pool.report(self, ok=False)
+            await scanner.ensure_running()
+            raise
+        except Exception:
+            self.adapter_pool and await self.adapter_pool.report(self, ok=False)
             raise
 
         self._connect_time = time.time()
+        self.adapter_pool and await self.adapter_pool.report(self, ok=True)
 
         if self.verbose_log:
             try:
@@ -241,7 +379,7 @@ class BtBms:
 
     async def _connect_with_scanner(self, timeout=20):
         """
-        Starts a bluetooth discovery and tries to establish a BLE connection with back off.
+        Waits until the shared scanner sees the device and tries to establish a BLE connection with back off.
          This fixes connection errors for some BMS (jikong). Use instead of connect().
 
         :param timeout:
@@ -255,23 +393,18 @@ class BtBms:
         if BtBms.shutdown:
             raise RuntimeError("in shutdown")
 
-        import bleak
-        scanner_kw = {}
-        if self._adapter:
-            scanner_kw['adapter'] = self._adapter
-        scanner = bleak.BleakScanner(**scanner_kw)
-        self.logger.debug("starting scan")
-        await scanner.start()
+        scanner = get_scanner(self._adapter)
+        try:
+            adv = await scanner.wait_for(self.client.address, timeout=timeout / 2)
+        except asyncio.TimeoutError:
+            raise BleakDeviceNotFoundError(
+                self.client.address, 'Device %s not discovered. Make sure it in range and is not being '
+                                     'accessed by another app. (found %s)' % (self.client.address, set(scanner.seen)))
+        self.logger.debug("found %s", adv)
 
         attempt = 1
         while True:
             try:
-                discovered = set(b.address for b in scanner.discovered_devices)
-                if self.client.address not in discovered:
-                    raise BleakDeviceNotFoundError(
-                        self.client.address, 'Device %s not discovered. Make sure it in range and is not being '
-                                             'accessed by another app. (found %s)' % (self.client.address, discovered))
-
                 self.logger.debug("connect attempt %d", attempt)
                 await self._connect_client(timeout=timeout / 2)
                 break
@@ -282,16 +415,60 @@ class BtBms:
                     await asyncio.sleep(0.2 * (1.5 ** attempt))
                     attempt += 1
                 else:
-                    await scanner.stop()
                     raise
 
-        await scanner.stop()
-
     async def disconnect(self):
         self._in_disconnect = True
-        await self.client.disconnect()
-        self._in_disconnect = False
+        try:
+            await self.client.disconnect()
+        finally:
+            self._in_disconnect = False
+            if self._recorder:
+                self._recorder.finish()
         self._fetch_futures.clear()
+        self.query_cache.invalidate()
+
+    async def _q_batch(self, commands: List[Tuple[Union[str, int], bytes]], char, timeout=None,
+                       prepare: Optional[Callable[[], None]] = None) -> list:
+        """
+        Pipeline several queries: write all request frames back to back, then wait for the responses, which the
+        notification handler matches by name (usually the command byte) as they arrive.
+        :param commands: list of (response name, request frame)
+        :param char: characteristic to write to
+        :param prepare: called before sending, after the responses are acquired (e.g. to set up frame buffers)
+        :return: list of responses, in the order of `commands`
+        """
+        names = tuple(name for name, _ in commands)
+
+        async def send():
+            if prepare:
+                prepare()
+            for _, frame in commands:
+                await self.client.write_gatt_char(char, data=frame)
+
+        return await self._fetch_futures.request(names, send, timeout or self.TIMEOUT)
+
+    async def _q_batch_cached(self, commands: List[Tuple[Union[str, int], bytes]], char, **kwargs) -> list:
+        """
+        Like _q_batch(), but static and slow queries (see QUERY_LIFETIMES) are answered from the query cache.
+        """
+        cache = self.query_cache
+        missing = [(name, frame) for name, frame in commands if name not in cache]
+        responses = dict(zip((name for name, _ in missing),
+                             (await self._q_batch(missing, char, **kwargs)) if missing else []))
+        for name, resp in responses.items():
+            cache.put(name, resp)
+        return [responses[name] if name in responses else cache.get(name) for name, _ in commands]
+
+    async def _q_cached(self, name, query: Callable[[], Awaitable[Any]]):
+        """
+        Return the cached result of query `name` or await `query()` and cache its result.
+        """
+        value = self.query_cache.get(name)
+        if value is None:
+            value = await query()
+            self.query_cache.put(name, value)
+        return value
 
     async def fetch_device_info(self) -> DeviceInfo:
         """
@@ -324,10 +501,18 @@ class BtBms:
         raise NotImplementedError()
 
     async def subscribe(self, callback: Callable[[BmsSample], None]):
-        raise NotImplemented()
+        """
+        Register a callback for samples pushed by the BMS. Only available if SUPPORTS_PUSH is True.
+        The callback might be called from a non-asyncio thread.
+        :param callback:
+        """
+        raise NotImplementedError()
+
+    async def unsubscribe(self, callback: Callable[[BmsSample], None]):
+        raise NotImplementedError()
 
     async def subscribe_voltages(self, callback: Callable[[List[int]], None]):
-        raise NotImplemented()
+        raise NotImplementedError()
 
     async def set_switch(self, switch: str, state: bool):
         """
@@ -339,19 +524,23 @@ class BtBms:
         raise NotImplementedError()
 
     def __str__(self):
-        return f'{self.__class__.__name__}({self.client.address},{self.name})'
+        return f'{self.__class__.__name__}({self.client.address if self.client else self.address},{self.name})'
 
     async def __aenter__(self):
         # print("enter")
+        if self.connection_pool:
+            return await self.connection_pool.enter(self)
         if self.keep_alive and self.is_connected:
             return
         await self.connect()
 
     async def __aexit__(self, *args):
         # print("exit")
+        if self.connection_pool:
+            return await self.connection_pool.exit(self)
         if self.keep_alive:
             return
-        if self.client.is_connected:
+        if self.is_connected:
             await self.disconnect()
 
     def __await__(self):
@@ -366,6 +555,18 @@ class BtBms:
         return None
 
 
+def _invalidate_after_switch(set_switch):
+    # switch states and settings changed, query them again with the next sample
+    @functools.wraps(set_switch)
+    async def wrapper(self: BtBms, switch: str, state: bool):
+        try:
+            return await set_switch(self, switch, state)
+        finally:
+            self.query_cache.invalidate(QueryCache.SLOW)
+
+    return wrapper
+
+
 # noinspection DuplicatedCode
 async def enumerate_services(client: BleakClient, logger):
     try:
@@ -0,0 +1,179 @@
+"""
+Parse btsnoop HCI logs (Android `btsnoop_hci.log`, PacketLogger and Wireshark exports, btmon) and extract the ATT
+traffic of each BLE connection: writes, notifications and reads per characteristic handle, and the GATT services if
+the log covers the service discovery.
+
+References
+- https://fte.com/webhelpii/hsu/Content/Technical_Information/BT_Snoop_File_Format.htm
+- Bluetooth Core Spec Vol 3 Part F (ATT), Vol 4 Part E (HCI)
+"""
+import struct
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+BTSNOOP_MAGIC = b'btsnoop\0'
+BTSNOOP_EPOCH_DELTA = 0x00dcddb30f2f8000  # microseconds from year 0 to 1970
+
+DATALINK_H1 = 1001  # un-encapsulated HCI, packet type from flags
+DATALINK_H4 = 1002  # HCI UART, packet type byte in front
+DATALINK_MONITOR = 2001  # Linux monitor (btmon), opcode in flags
+
+HCI_COMMAND, HCI_ACL, HCI_EVENT = 0x01, 0x02, 0x04
+L2CAP_CID_ATT = 0x0004
+
+ATT_READ_BY_TYPE_RSP = 0x09
+ATT_READ_REQ = 0x0A
+ATT_READ_RSP = 0x0B
+ATT_READ_BY_GROUP_TYPE_RSP = 0x11
+ATT_WRITE_REQ = 0x12
+ATT_NOTIFICATION = 0x1B
+ATT_INDICATION = 0x1D
+ATT_WRITE_CMD = 0x52
+
+GATT_PROPERTIES = [(0x02, 'read'), (0x04, 'write-without-response'), (0x08, 'write'), (0x10, 'notify'),
+                   (0x20, 'indicate')]
+
+
+class Packet(NamedTuple):
+    t: float  # unix time
+    sent: bool  # host -> controller
+    type: int  # HCI_COMMAND, HCI_ACL or HCI_EVENT
+    data: bytes  # without packet type byte
+
+
+class AttEvent(NamedTuple):
+    t: float
+    kind: str  # 'w'rite, 'r'ead or 'n'otification, as in bmslib.replay
+    handle: int  # attribute (characteristic value) handle
+    data: bytes
+
+
+def uuid_str(b: bytes) -> str:
+    """ 16 or 128 bit little-endian uuid """
+    if len(b) == 2:
+        return '0000%04x-0000-1000-8000-00805f9b34fb' % int.from_bytes(b, 'little')
+    h = bytes(reversed(b)).hex()
+    return '%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def read_btsnoop(path: str) -> Iterator[Packet]:
+    with open(path, 'rb') as f:
+        header = f.read(16)
+        if header[:8] != BTSNOOP_MAGIC:
+            raise ValueError('%s is not a btsnoop file' % path)
+        _, datalink = struct.unpack('>II', header[8:])
+        if datalink not in (DATALINK_H1, DATALINK_H4, DATALINK_MONITOR):
+            raise ValueError('unsupported btsnoop datalink type %d' % datalink)
+
+        while True:
+            rec = f.read(24)
+            if len(rec) < 24:
+                return
+            _, incl_len, flags, _, ts = struct.unpack('>IIIIq', rec)
+            data = f.read(incl_len)
+            t = (ts - BTSNOOP_EPOCH_DELTA) * 1e-6
+
+            if datalink == DATALINK_H4:
+                if not data:
+                    continue
+                yield Packet(t, not flags & 1, data[0], data[1:])
+            elif datalink == DATALINK_H1:
+                yield Packet(t, not flags & 1, (HCI_EVENT if flags & 1 else HCI_COMMAND) if flags & 2 else HCI_ACL,
+                             data)
+            else:
+                opcode = flags & 0xFFFF  # 2 command, 3 event, 4 ACL tx, 5 ACL rx
+                if opcode in (4, 5):
+                    yield Packet(t, opcode == 4, HCI_ACL, data)
+                elif opcode == 3:
+                    yield Packet(t, False, HCI_EVENT, data)
+
+
+class Connection:
+    def __init__(self, handle: int):
+        self.handle = handle
+        self.address: Optional[str] = None  # peer address, if the log covers the connect
+        self.services: List[dict] = []  # see bmslib.replay capture header
+        self.events: List[AttEvent] = []
+        self._read_handle: Optional[int] = None
+
+    def char_uuid(self, handle: int) -> Optional[str]:
+        for service in self.services:
+            for c in service['characteristics']:
+                if c['handle'] == handle:
+                    return c['uuid']
+        return None
+
+    def _on_att(self, t: float, sent: bool, pdu: bytes):
+        op = pdu[0]
+        if sent and op in (ATT_WRITE_REQ, ATT_WRITE_CMD) and len(pdu) >= 3:
+            self.events.append(AttEvent(t, 'w', int.from_bytes(pdu[1:3], 'little'), bytes(pdu[3:])))
+        elif not sent and op in (ATT_NOTIFICATION, ATT_INDICATION) and len(pdu) >= 3:
+            self.events.append(AttEvent(t, 'n', int.from_bytes(pdu[1:3], 'little'), bytes(pdu[3:])))
+        elif sent and op == ATT_READ_REQ and len(pdu) >= 3:
+            self._read_handle = int.from_bytes(pdu[1:3], 'little')
+        elif not sent and op == ATT_READ_RSP and self._read_handle is not None:
+            self.events.append(AttEvent(t, 'r', self._read_handle, bytes(pdu[1:])))
+            self._read_handle = None
+        elif not sent and op == ATT_READ_BY_GROUP_TYPE_RSP and len(pdu) > 2:
+            # primary services: handle, end group handle, uuid
+            n = pdu[1]
+            for i in range(2, len(pdu) - n + 1, n):
+                start, end = struct.unpack_from('<HH', pdu, i)
+                self.services.append(dict(uuid=uuid_str(pdu[i + 4:i + n]), start=start, end=end, characteristics=[]))
+        elif not sent and op == ATT_READ_BY_TYPE_RSP and len(pdu) > 2 and pdu[1] in (7, 21):
+            # characteristic declarations: handle, properties, value handle, uuid
+            n = pdu[1]
+            for i in range(2, len(pdu) - n + 1, n):
+                decl, props, value_handle = struct.unpack_from('<HBH', pdu, i)
+                char = dict(uuid=uuid_str(pdu[i + 5:i + n]), handle=value_handle,
+                            properties=[name for bit, name in GATT_PROPERTIES if props & bit])
+                service = next((s for s in self.services if s['start'] <= decl <= s['end']), None)
+                if service is not None and all(c['handle'] != value_handle for c in service['characteristics']):
+                    service['characteristics'].append(char)
+
+
+def read_att(path: str) -> List[Connection]:
+    """
+    Extract the ATT traffic of every LE connection in the log.
+    """
+    found: List[Connection] = []
+    connections: Dict[int, Connection] = {}  # by connection handle, handles are re-used after a disconnect
+    fragments: Dict[Tuple[int, bool], bytearray] = {}  # L2CAP reassembly per (connection handle, direction)
+
+    def connection(handle) -> Connection:
+        if handle not in connections:
+            connections[handle] = Connection(handle)
+            found.append(connections[handle])
+        return connections[handle]
+
+    for p in read_btsnoop(path):
+        if p.type == HCI_EVENT and len(p.data) >= 12 and p.data[0] == 0x3E and p.data[2] in (0x01, 0x0A):
+            # LE (enhanced) connection complete
+            status, handle = p.data[3], int.from_bytes(p.data[4:6], 'little')
+            if status == 0:
+                connections.pop(handle, None)
+                conn = connection(handle)
+                conn.address = ':'.join('%02X' % b for b in reversed(p.data[8:14]))
+
+        elif p.type == HCI_ACL and len(p.data) >= 4:
+            hf, length = struct.unpack_from('<HH', p.data)
+            handle, pb = hf & 0x0FFF, (hf >> 12) & 0x3
+            key = handle, p.sent
+            payload = p.data[4:4 + length]
+            if pb == 0x1:  # continuing fragment
+                if key not in fragments:
+                    continue
+                fragments[key] += payload
+            else:
+                fragments[key] = bytearray(payload)
+
+            buf = fragments[key]
+            if len(buf) < 4:
+                continue
+            l2cap_len, cid = struct.unpack_from('<HH', buf)
+            if len(buf) < 4 + l2cap_len:
+                continue
+            del fragments[key]
+            if cid == L2CAP_CID_ATT and l2cap_len:
+                connection(handle)._on_att(p.t, p.sent, bytes(buf[4:4 + l2cap_len]))
+
+    return [c for c in found if c.events]
@@ -0,0 +1,161 @@
+"""
+Connection pool: a budget of bluetooth connections that stay open between samples.
+
+Devices are ranked by priority, then by how often they are sampled. The top `slots - 1` devices keep their connection
+(keep-alive), all other devices share the remaining slot and connect for each sample. A kept device only loses its
+connection to a device with a higher priority or a clearly shorter sample period (see HYSTERESIS), so devices sampled
+at the same rate don't take turns. An open connection holds a slot
+until the device disconnects, so concurrent sampling never opens more than `slots` connections. If all devices fit
+into the slots, every device is kept alive.
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional, Set
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+REPORT_INTERVAL = 60 * 5
+HYSTERESIS = .8  # a device takes the keep-alive of another one if sampled at least this much more often (period ratio)
+
+
+class _Member:
+    def __init__(self, bms, priority: int, sample_period: Optional[float]):
+        self.bms = bms
+        self.priority = priority
+        self.sample_period = sample_period  # configured
+        self.interval = 0.  # smoothed time between samples
+        self.t_last_use = 0.
+
+    def use(self, now: float):
+        if self.t_last_use:
+            dt = now - self.t_last_use
+            self.interval = (0.8 * self.interval + 0.2 * dt) if self.interval else dt
+        self.t_last_use = now
+
+    @property
+    def period(self) -> float:
+        # the measured interval jitters, prefer the configured period
+        return self.sample_period or self.interval or float('inf')
+
+    @property
+    def rank(self):
+        # higher priority first, then the most frequently sampled, then the most recently used
+        return self.priority, -self.period, self.t_last_use
+
+    def outranks(self, other: '_Member') -> bool:
+        if self.priority != other.priority:
+            return self.priority > other.priority
+        return self.period < other.period * HYSTERESIS
+
+
+class ConnectionPool:
+
+    def __init__(self, slots: int):
+        assert slots > 0, "need at least 1 slot"
+        self.slots = slots
+        self._members: Dict[str, _Member] = {}
+        self._in_use: Set[str] = set()
+        self._open: Optional[asyncio.Semaphore] = None  # one permit per open connection, created in the event loop
+        self._holders: Set[str] = set()  # devices holding a permit
+        self._keep: Set[str] = set()  # current keep set
+
+        self.num_connects = 0
+        self.num_hits = 0  # samples on an open connection
+        self.t_connecting = 0.  # total time spent connecting
+
+        self._t_last_report = time.time()
+
+    def __str__(self):
+        return 'ConnectionPool(%d/%d open, %d devices)' % (
+            sum(m.bms.is_connected for m in self._members.values()), self.slots, len(self._members))
+
+    def add(self, bms, priority=0, sample_period: Optional[float] = None):
+        self._members[bms.name] = _Member(bms, priority, sample_period)
+        bms.connection_pool = self
+        bms.set_keep_alive(False)  # the pool decides
+
+    def keep_set(self) -> Set[str]:
+        """ names of the devices that keep their connection """
+        if len(self._members) <= self.slots:
+            return set(self._members.keys())
+        ranked: List[_Member] = sorted(self._members.values(), key=lambda m: m.rank, reverse=True)
+        kept = [m for m in ranked if m.bms.name in self._keep]
+        others = [m for m in ranked if m.bms.name not in self._keep]
+        while len(kept) < self.slots - 1:
+            kept.append(others.pop(0))
+        # replace the weakest kept device while the strongest other one clearly outranks it
+        while others and others[0].outranks(kept[-1]):
+            kept[-1], others[0] = others[0], kept[-1]
+            kept.sort(key=lambda m: m.rank, reverse=True)
+            others.sort(key=lambda m: m.rank, reverse=True)
+        self._keep = set(m.bms.name for m in kept)
+        return set(self._keep)
+
+    @property
+    def connect_time_saved(self):
+        """ estimated time saved by not re-connecting, in seconds """
+        return self.num_hits * (self.t_connecting / self.num_connects) if self.num_connects else 0.
+
+    async def enter(self, bms):
+        now = time.time()
+        self._members[bms.name].use(now)
+        self._in_use.add(bms.name)
+
+        if bms.is_connected:
+            self.num_hits += 1
+            return
+
+        try:
+            if bms.name not in self._holders:
+                # free the slots of idle devices that dropped out of the keep set, then wait for one
+                await self._disconnect_idle()
+                if self._open is None:
+                    self._open = asyncio.Semaphore(self.slots)
+                await self._open.acquire()
+                self._holders.add(bms.name)
+                now = time.time()
+            await bms.connect()
+        except BaseException:
+            # __aexit__ is not called if __aenter__ fails
+            self._in_use.discard(bms.name)
+            self._release(bms.name)
+            raise
+        self.num_connects += 1
+        self.t_connecting += time.time() - now
+
+    async def exit(self, bms):
+        self._in_use.discard(bms.name)
+        # disconnect this and any idle device that dropped out of the keep set
+        await self._disconnect_idle()
+        if not bms.is_connected:
+            self._release(bms.name)
+        self._report()
+
+    async def _disconnect_idle(self):
+        keep = self.keep_set()
+        for m in list(self._members.values()):
+            name = m.bms.name
+            if name in keep or name in self._in_use or name not in self._holders:
+                continue
+            if m.bms.is_connected:
+                try:
+                    await m.bms.disconnect()
+                except Exception as e:
+                    logger.warning('%s error disconnecting: %s', name, e)
+            self._release(name)
+
+    def _release(self, name: str):
+        if name in self._holders:
+            self._holders.discard(name)
+            self._open.release()
+
+    def _report(self):
+        now = time.time()
+        if now - self._t_last_report < REPORT_INTERVAL:
+            return
+        self._t_last_report = now
+        logger.info('%s keep-alive [%s], %d connects (avg %.2fs), %d hits, connect time saved %.0fs', self,
+                    ', '.join(sorted(self.keep_set())), self.num_connects,
+                    self.t_connecting / max(1, self.num_connects), self.num_hits, self.connect_time_saved)
@@ -0,0 +1,147 @@
+"""
+Frame reassembly for BMS notification handlers.
+
+A BMS response often arrives split over several notifications (or several responses arrive in one). FrameAssembler
+buffers the notification data in a pre-allocated buffer, cuts it into frames by protocol rules (header, length,
+trailer and checksum) and passes each frame to a callback as a `memoryview` into that buffer, without copying.
+The view is only valid during the callback, copy it (`bytes(frame)`) to keep it.
+
+On a bad frame (wrong trailer or checksum) the assembler drops one byte and searches the next header, so a frame
+interrupted by another one doesn't swallow the next good frame.
+"""
+from typing import Callable, Optional, Union
+
+from bmslib.util import get_logger
+
+FrameCallback = Callable[[memoryview], None]
+LengthRule = Union[int, Callable[[memoryview], Optional[int]]]
+
+
+class FrameAssembler:
+
+    def __init__(self, on_frame: FrameCallback, header: bytes = b'', length: Optional[LengthRule] = None,
+                 trailer: bytes = b'', check: Optional[Callable[[memoryview], bool]] = None, max_size=1024,
+                 logger=None):
+        """
+        :param on_frame: called with each complete frame
+        :param header: bytes every frame starts with, data before it is discarded
+        :param length: frame length including header and trailer, or a function that returns it from the start
+                of the frame (None if more data is needed). If not set, a frame ends with a notification that ends
+                with `trailer`, and a notification that starts with `header` starts a new frame.
+        :param trailer: bytes every frame ends with
+        :param check: checksum test, returns False for a corrupt frame
+        :param max_size: buffer size, larger than the largest frame
+        """
+        assert length is not None or trailer, "need a length or a trailer to find the end of a frame"
+        self.on_frame = on_frame
+        self.header = bytes(header)
+        self.length = length
+        self.trailer = bytes(trailer)
+        self.check = check
+        self.logger = logger or get_logger()
+
+        self._buf = bytearray(max_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+        self.num_frames = 0
+        self.num_errors = 0
+
+    def __len__(self):
+        """ number of buffered bytes """
+        return self._end - self._start
+
+    def clear(self):
+        self._start = self._end = 0
+
+    def feed(self, data: Union[bytes, bytearray, memoryview]):
+        if self.length is None and self.header and data[:len(self.header)] == self.header:
+            self.clear()
+
+        n = len(data)
+        if self._end + n > len(self._buf):
+            self._compact()
+            if self._end + n > len(self._buf):
+                self.logger.warning('frame buffer overflow, discarding %d bytes', self._end)
+                self.num_errors += 1
+                self.clear()
+                if n > len(self._buf):
+                    data = data[-len(self._buf):]
+                    n = len(data)
+
+        self._buf[self._end:self._end + n] = data
+        self._end += n
+
+        self._cut()
+
+        if self._start == self._end:
+            self.clear()
+
+    def _compact(self):
+        n = self._end - self._start
+        if self._start:
+            self._buf[0:n] = self._buf[self._start:self._end]
+            self._start, self._end = 0, n
+
+    def _sync(self) -> bool:
+        """ move to the next header, returns False if there is none (yet) """
+        h = self.header
+        if not h or self._view[self._start:self._start + len(h)] == h:
+            return True
+        idx = self._buf.find(h, self._start, self._end)
+        if idx < 0:
+            # keep a partial header at the end
+            skip = max(self._start, self._end - len(h) + 1)
+        else:
+            skip = idx
+        if skip > self._start:
+            self.logger.debug('frame sync: discarding %s', bytes(self._view[self._start:skip]))
+            self._start = skip
+        return idx >= 0
+
+    def _cut(self):
+        view = self._view
+        while self._end - self._start >= max(1, len(self.header)):
+            if not self._sync():
+                return
+
+            avail = self._end - self._start
+
+            if self.length is None:
+                # delimiter mode: a frame ends with a notification that ends with the trailer
+                if view[self._end - len(self.trailer):self._end] == self.trailer:
+                    self._emit(view[self._start:self._end])
+                    self._start = self._end
+                return
+
+            n = self.length if isinstance(self.length, int) else self.length(view[self._start:self._end])
+            if n is None or n > avail:
+                if n is not None and n > len(self._buf):
+                    self._bad(view[self._start:self._end], 'length %d exceeds buffer' % n)
+                    continue
+                return
+
+            frame = view[self._start:self._start + n]
+            if n < max(1, len(self.header) + len(self.trailer)):
+                self._bad(frame, 'length %d' % n)
+                continue
+            if self.trailer and frame[n - len(self.trailer):] != self.trailer:
+                self._bad(frame, 'trailer')
+                continue
+            if self.check and not self.check(frame):
+                self._bad(frame, 'checksum')
+                continue
+
+            self._emit(frame)
+            self._start += n
+
+    def _emit(self, frame: memoryview):
+        self.num_frames += 1
+        self.on_frame(frame)
+
+    def _bad(self, frame: memoryview, reason: str):
+        # drop one byte, _sync() finds the next header
+        self.num_errors += 1
+        self.logger.debug('bad frame (%s), resync: %s', reason, bytes(frame))
+        self._start += 1
@@ -1,39 +1,77 @@
 import asyncio
 import math
 import statistics
+import time
 from copy import copy
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Callable, Optional, Tuple
 
-from bmslib.bms import BmsSample
+from bmslib.bms import BmsSample, FetchPlan, MIN_VALUE_EXPIRY
 from bmslib.bt import BtBms
 from bmslib.util import get_logger
 
 
+class GroupSample(BmsSample):
+    """
+    Aggregate of member samples. Members without a sample in the staleness window are left out and listed in
+    `stale_members`.
+    """
+    stale_members: Tuple[str, ...] = ()
+
+    def values(self):
+        vals = super().values()
+        vals.pop('stale_members', None)
+        vals['num_stale_members'] = len(self.stale_members)
+        return vals
+
+
 class BmsGroup:
 
-    def __init__(self, name):
+    def __init__(self, name, max_sample_age=MIN_VALUE_EXPIRY):
         self.name = name
         self.bms_names = list()
         self.samples: Dict[str, BmsSample] = {}
         self.voltages: Dict[str, List[int]] = {}
-        # self.max_sample_age = 0
+        self.max_sample_age = max_sample_age  # staleness window in seconds
+        self._listeners: List[Callable[[str], None]] = []
+
+    def add_listener(self, callback: Callable[[str], None]):
+        """ `callback(bms_name)` is called after each update of a member's sample or voltages """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[str], None]):
+        self._listeners.remove(callback)
+
+    def _notify(self, bms_name: str):
+        for callback in self._listeners:
+            callback(bms_name)
 
     def update(self, bms: BtBms, sample: BmsSample):
         assert bms.name in self.bms_names, "bms %s not in group %s" % (bms.name, self.bms_names)
         self.samples[bms.name] = copy(sample)
+        self._notify(bms.name)
 
     def update_voltages(self, bms: BtBms, voltages: List[int]):
         assert bms.name in self.bms_names, "bms %s not in group %s" % (bms.name, self.bms_names)
         self.voltages[bms.name] = copy(voltages)
-
-    def fetch(self) -> BmsSample:
-        # ts_expire = time.time() - self.max_sample_age
-        # expired = set(k for k,s in self.samples.items() if s.timestamp < ts_expire)
-        return sum_parallel(self.samples.values())
-
-    def fetch_voltages(self):
+        self._notify(bms.name)
+
+    def fresh_members(self, now: Optional[float] = None) -> List[str]:
+        """ members with a sample in the staleness window """
+        t_min = (now or time.time()) - self.max_sample_age
+        return [name for name in self.bms_names if name in self.samples and self.samples[name].timestamp >= t_min]
+
+    def fetch(self, now: Optional[float] = None) -> GroupSample:
+        fresh = self.fresh_members(now)
+        if not fresh:
+            raise GroupNotReady("group %s has no fresh member samples" % self.name)
+        sample = sum_parallel((self.samples[name] for name in fresh), cls=GroupSample)
+        sample.stale_members = tuple(name for name in self.bms_names if name not in fresh)
+        return sample
+
+    def fetch_voltages(self, now: Optional[float] = None):
+        fresh = self.fresh_members(now)
         try:
-            return sum((self.voltages[name] for name in self.bms_names), [])
+            return sum((self.voltages[name] for name in fresh), [])
         except KeyError as e:
             raise GroupNotReady(e)
 
@@ -45,7 +83,13 @@ class GroupNotReady(Exception):
 
 
 class VirtualGroupBms:
+    """
+    Aggregates the samples of its members. Push-driven: a group sample is emitted as soon as every fresh member
+    (see `BmsGroup.max_sample_age`) has a new sample. Stale members are left out (partial aggregate).
+    """
     # TODO inherit from bms base class
+    SUPPORTS_PUSH = True
+
     def __init__(self, address: str, name=None, verbose_log=False, **kwargs):
         self.address = address
         self.name = name
@@ -53,13 +97,16 @@ class VirtualGroupBms:
         self.verbose_log = verbose_log
         self.members: List[BtBms] = []
         self.logger = get_logger(verbose_log)
+        self.fetch_plan = FetchPlan(voltages=0, temperatures=0)  # members are sampled, the group is in-memory
+        self._subscriptions: Dict[Callable[[BmsSample], None], Callable[[str], None]] = {}
+        self._t_subscribe = 0.
 
     def __str__(self):
         return 'VirtualGroupBms(%s,[%s])' % (self.name, self.address)
 
     @property
     def is_connected(self):
-        return set(self.group.samples.keys()) == set(self.group.bms_names)
+        return bool(self.group.samples)
 
     @property
     def is_virtual(self):
@@ -70,7 +117,7 @@ class VirtualGroupBms:
         return max(bms.connect_time for bms in self.members)
 
     def debug_data(self):
-        return "missing %s" % (set(self.group.bms_names) - set(self.group.samples.keys()))
+        return "stale %s" % (set(self.group.bms_names) - set(self.group.fresh_members()))
 
     async def fetch(self) -> BmsSample:
         # TODO wait for update with timeout
@@ -92,13 +139,49 @@ class VirtualGroupBms:
     def get_member_names(self):
         return self.group.bms_names
 
-    async def connect(self):
-        for i in range(10):
-            if self.is_connected:
+    async def connect(self, timeout=None):
+        # wait for the first member sample
+        if self.is_connected:
+            return
+        arrived = asyncio.Event()
+        on_update = lambda _: arrived.set()
+        self.group.add_listener(on_update)
+        try:
+            await asyncio.wait_for(arrived.wait(), timeout or self.group.max_sample_age)
+        except asyncio.TimeoutError:
+            raise GroupNotReady("group %s waiting for member data %s" % (self.name, self.debug_data()))
+        finally:
+            self.group.remove_listener(on_update)
+
+    async def subscribe(self, callback: Callable[[BmsSample], None]):
+        t_emitted: Dict[str, float] = {}  # timestamps of member samples in the last aggregate
+        stale_logged = ()
+        self._t_subscribe = time.time()
+
+        def on_update(_bms_name):
+            nonlocal stale_logged
+            now = time.time()
+            samples = self.group.samples
+            fresh = self.group.fresh_members(now)
+            if not fresh:
                 return
-            await asyncio.sleep(0.2)
-
-        raise GroupNotReady("group %s waiting for member data %s" % (self.name, self.debug_data()))
+            if len(fresh) < len(self.group.bms_names) and now - self._t_subscribe < self.group.max_sample_age:
+                return  # give all members a chance to deliver their first sample
+            if any(samples[name].timestamp <= t_emitted.get(name, 0) for name in fresh):
+                return  # wait until every fresh member has a new sample
+            for name in fresh:
+                t_emitted[name] = samples[name].timestamp
+            sample = self.group.fetch(now)
+            if sample.stale_members != stale_logged:
+                stale_logged = sample.stale_members
+                self.logger.info('%s stale members: %s', self.name, ', '.join(stale_logged) or 'none')
+            callback(sample)
+
+        self._subscriptions[callback] = on_update
+        self.group.add_listener(on_update)
+
+    async def unsubscribe(self, callback: Callable[[BmsSample], None]):
+        self.group.remove_listener(self._subscriptions.pop(callback))
 
     async def disconnect(self):
         pass
@@ -131,8 +214,9 @@ def finite_or_fallback(x, fallback):
     return x if is_finite(x) else fallback
 
 
-def sum_parallel(samples: Iterable[BmsSample]) -> BmsSample:
-    return BmsSample(
+def sum_parallel(samples: Iterable[BmsSample], cls=BmsSample) -> BmsSample:
+    samples = list(samples)
+    return cls(
         voltage=statistics.mean(s.voltage for s in samples),
         current=sum(s.current for s in samples),
         power=sum(s.power for s in samples),
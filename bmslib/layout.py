@@ -0,0 +1,127 @@
+"""
+Declarative frame layouts.
+
+A layout lists the fields of a binary BMS frame (name, offset, struct format, scale). It compiles once per firmware
+variant into a few `struct.Struct` objects, so decoding a frame is a single `unpack_from` call per group of
+non-overlapping fields instead of an `int.from_bytes` call per field:
+
+    LAYOUT = Layout('<', [
+        Field('voltage', 118, 'I', 1e-3),
+        Field('current', 126, 'i', -1e-3),
+        Field('mos_temperature', 112, 'h', .1, variant='32s'),
+    ])
+    values = LAYOUT.compile(variant='32s', shift=32).unpack(frame)
+
+A field's value is `(raw + bias) * scale`, fields without scale keep an int.
+"""
+import math
+import struct
+import sys
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+
+class Field(NamedTuple):
+    name: str
+    offset: int
+    fmt: str  # struct format character, e.g. 'H' for uint16
+    scale: float = 1
+    bias: float = 0
+    nan: Optional[int] = None  # raw value meaning "no reading", decoded as nan
+    variant: Optional[str] = None  # only part of this firmware variant
+
+
+class CompiledLayout:
+
+    def __init__(self, byte_order: str, fields: List[Field], shift: int):
+        self.fields = sorted(fields, key=lambda f: f.offset)
+        self.names = [f.name for f in self.fields]
+
+        # one struct per run of non-overlapping fields, gaps are padded
+        self._groups: List[Tuple[int, struct.Struct]] = []
+        self._convert: List[Tuple[int, float, float, float, Optional[int]]] = []
+        start = end = None
+        fmt = ''
+        for f in self.fields:
+            offset = f.offset + shift
+            if end is None or offset < end:
+                if fmt:
+                    self._groups.append((start, struct.Struct(byte_order + fmt)))
+                start = end = offset
+                fmt = ''
+            fmt += 'x' * (offset - end) + f.fmt
+            end = offset + struct.calcsize(byte_order + f.fmt)
+        if fmt:
+            self._groups.append((start, struct.Struct(byte_order + fmt)))
+
+        # single fields, see unpack_field()
+        self._single: Dict[str, Tuple[int, struct.Struct, Optional[tuple]]] = {}
+
+        for i, f in enumerate(self.fields):
+            conv = None
+            if f.scale != 1 or f.bias or f.nan is not None:
+                # divide by 10 instead of multiplying with .1, which gives 26.8 instead of 26.800000000000001
+                div = round(1 / f.scale) if f.scale else 0
+                if abs(div) > 1 and abs(1 / f.scale - div) < 1e-9:
+                    conv = (1, div, f.bias, f.nan)
+                else:
+                    conv = (f.scale, 1, f.bias, f.nan)
+                self._convert.append((i,) + conv)
+            self._single[f.name] = (f.offset + shift, struct.Struct(byte_order + f.fmt), conv)
+
+        self.size = end or 0  # minimum frame length
+
+    def unpack(self, buf, base=0) -> Dict[str, Any]:
+        """ decode all fields of the frame `buf`, which starts at `base` """
+        raw = []
+        for offset, s in self._groups:
+            raw += s.unpack_from(buf, base + offset)
+        for i, scale, div, bias, nan in self._convert:
+            v = raw[i]
+            raw[i] = math.nan if v == nan else ((v + bias) * scale if div == 1 else (v + bias) / div)
+        return dict(zip(self.names, raw))
+
+    def unpack_field(self, buf, name: str, base=0):
+        """ decode a single field """
+        offset, s, conv = self._single[name]
+        v = s.unpack_from(buf, base + offset)[0]
+        if conv:
+            scale, div, bias, nan = conv
+            v = math.nan if v == nan else ((v + bias) * scale if div == 1 else (v + bias) / div)
+        return v
+
+
+class Layout:
+
+    def __init__(self, byte_order: str, fields: List[Field]):
+        """
+        :param byte_order: '<' little or '>' big endian
+        """
+        assert byte_order in ('<', '>'), "byte order must be '<' or '>'"
+        self.byte_order = byte_order
+        self.fields = fields
+        self._compiled: Dict[Tuple[Optional[str], int], CompiledLayout] = {}
+
+    def compile(self, variant: Optional[str] = None, shift: int = 0) -> CompiledLayout:
+        """
+        :param variant: include fields of this variant (and those of all variants)
+        :param shift: added to all offsets (e.g. a firmware that inserts bytes in front)
+        """
+        key = variant, shift
+        if key not in self._compiled:
+            fields = [f for f in self.fields if f.variant is None or f.variant == variant]
+            self._compiled[key] = CompiledLayout(self.byte_order, fields, shift)
+        return self._compiled[key]
+
+    def unpack(self, buf, base=0, variant: Optional[str] = None, shift: int = 0) -> Dict[str, Any]:
+        return self.compile(variant, shift).unpack(buf, base)
+
+
+_NATIVE_ORDER = '<' if sys.byteorder == 'little' else '>'
+
+
+def unpack_array(buf, offset: int, count: int, fmt='H', byte_order='<') -> List[int]:
+    """ decode `count` integers of the same type, e.g. cell voltages """
+    size = struct.calcsize(fmt)
+    if byte_order == _NATIVE_ORDER:
+        return memoryview(buf)[offset:offset + count * size].cast(fmt).tolist()
+    return list(struct.unpack_from(byte_order + fmt * count, buf, offset))
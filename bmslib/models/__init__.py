@@ -1,9 +1,30 @@
+import asyncio
+import inspect
+import re
+from typing import Iterable, List, Optional, Set
+
 from bmslib.util import get_logger
 
 logger = get_logger()
 
-
-def get_bms_model_class(name):
+# advertisement signatures for `type: auto`, first match wins:
+# (type, local name regex, service uuid, manufacturer id), None matches anything
+ADVERTISEMENT_SIGNATURES = [
+    ('victron', None, None, 0x02E1),
+    ('jk', r'^JK[-_]', None, None),
+    ('ant', r'^ANT-', None, None),
+    ('daly', r'^(DL-|Daly)', None, None),
+    ('sok', r'^SOK-', None, None),
+    ('supervolt', r'^SX\d', None, None),
+    ('jbd', r'^(SP\d+S|JBD|xiaoxiang)', None, None),
+    # devices with a custom name
+    ('jk', None, '0000ffe0-0000-1000-8000-00805f9b34fb', 0x0B65),
+    ('daly', None, '0000fff0-0000-1000-8000-00805f9b34fb', None),
+    ('jbd', None, '0000ff00-0000-1000-8000-00805f9b34fb', None),
+]
+
+
+def _bms_registry():
     import bmslib.models.ant
     import bmslib.models.daly
     import bmslib.models.daly2
@@ -27,6 +48,7 @@ def get_bms_model_class(name):
         jk_32s=models.jikong.JKBt_32s,
         ant=models.ant.AntBt,
         victron=models.victron.SmartShuntBt,
+        victron_adv=models.victron.SmartShuntAdvBt,
         group_parallel=bmslib.group.VirtualGroupBms,
         # group_serial=bmslib.group.VirtualGroupBms, # TODO
         supervolt=models.supervolt.SuperVoltBt,
@@ -34,7 +56,81 @@ def get_bms_model_class(name):
         dummy=models.dummy.DummyBt,
     )
 
-    return bms_registry.get(name)
+    return bms_registry
+
+
+def get_bms_model_class(name):
+    return _bms_registry().get(name)
+
+
+def get_bms_model_type(bms_class) -> Optional[str]:
+    """ Reverse of get_bms_model_class, e.g. to pass the `type: auto` resolved type on """
+    return next((name for name, cls in _bms_registry().items() if cls is bms_class), None)
+
+
+def detect_bms_type(name: Optional[str], service_uuids: Iterable[str], manufacturer_ids: Iterable[int],
+                    key: Optional[str] = None) -> Optional[str]:
+    """
+    Guess the device type from advertisement data, None if unknown.
+    :param key: Victron advertisement encryption key, picks `victron_adv` over `victron`
+    """
+    name = (name or '').strip()
+    service_uuids = set(u.lower() for u in service_uuids)
+    manufacturer_ids = set(manufacturer_ids)
+    for bms_type, name_re, service_uuid, manufacturer_id in ADVERTISEMENT_SIGNATURES:
+        if name_re and not re.match(name_re, name, re.IGNORECASE):
+            continue
+        if service_uuid and service_uuid not in service_uuids:
+            continue
+        if manufacturer_id is not None and manufacturer_id not in manufacturer_ids:
+            continue
+        if bms_type == 'victron' and key:
+            return 'victron_adv'
+        return bms_type
+    return None
+
+
+def _detect_type(dev: dict, addr: str) -> Optional[str]:
+    from bmslib.scanner import find_advertisement
+    adv = find_advertisement(addr)
+    if not adv:
+        logger.error('Can not detect type of %s, it was not found by the scan. Set its `type` to use it', addr)
+        return None
+    bms_type = detect_bms_type(adv.name, adv.adv.service_uuids or [], (adv.adv.manufacturer_data or {}).keys(),
+                               key=dev.get('key'))
+    if bms_type:
+        logger.info('Detected %s as type %s', addr, bms_type)
+    else:
+        logger.error('Can not detect type of %s from its advertisement %s. Set its `type` to use it', addr,
+                     adv.adv)
+    return bms_type
+
+
+async def detect_auto_types(devices: List[dict], timeout=30.) -> list:
+    """
+    Scan for `type: auto` devices that the discovery missed (or was skipped), so construct_bms can detect their type.
+    :return: BLEDevices found
+    """
+    from bmslib.scanner import find_advertisement, get_scanner
+
+    pending = [dev for dev in devices if dev.get('type') == 'auto' and dev.get('address') and not dev.get('replay')
+               and not dev['address'].startswith('#') and not find_advertisement(dev['address'])]
+    if not pending:
+        return []
+
+    logger.info('Scanning %.0fs for %s to detect their type', timeout, ', '.join(dev['address'] for dev in pending))
+
+    async def scan(dev):
+        try:
+            adv = await get_scanner(dev.get('adapter')).wait_for(dev['address'], timeout, max_age=None)
+            return adv.device
+        except asyncio.TimeoutError:
+            return None
+        except Exception as e:
+            logger.warning('Error scanning for %s: %s', dev['address'], e)
+            return None
+
+    return [d for d in await asyncio.gather(*map(scan, pending)) if d]
 
 
 def construct_bms(dev, verbose_log, bt_discovered_devices):
@@ -43,7 +139,11 @@ def construct_bms(dev, verbose_log, bt_discovered_devices):
     if not addr or addr.startswith('#'):
         return None
 
-    bms_class = get_bms_model_class(dev['type'])
+    bms_type = dev['type']
+    if bms_type == 'auto':
+        bms_type = _detect_type(dev, addr)
+
+    bms_class = get_bms_model_class(bms_type)
 
     if bms_class is None:
         logger.warning('Unknown device type %s', dev)
@@ -63,11 +163,38 @@ def construct_bms(dev, verbose_log, bt_discovered_devices):
 
     addr = name2addr(addr)
 
-    name: str = dev.get('alias') or dev_by_addr(addr).name
+    name: str = dev.get('alias') or (addr if dev.get('replay') else dev_by_addr(addr).name)
+
+    kwargs = {}
+    if dev.get('key'):  # advertisement encryption key (victron_adv)
+        if 'key' in inspect.signature(bms_class.__init__).parameters:
+            kwargs['key'] = dev['key']
+        else:
+            logger.warning('%s: type %s does not use a `key`, ignoring it', addr, bms_type)
+    if dev.get('capture'):  # record bluetooth traffic, see bmslib.replay
+        kwargs['capture'] = dev['capture']
+    if dev.get('replay'):
+        kwargs['replay'] = dev['replay']
+        kwargs['replay_speed'] = float(dev.get('replay_speed', 1))
 
     return bms_class(addr,
                      name=name,
                      verbose_log=verbose_log or dev.get('debug'),
                      psk=dev.get('pin'),
                      adapter=dev.get('adapter'),
+                     **kwargs
                      )
+
+
+def discovery_targets(devices: List[dict]) -> Set[str]:
+    """
+    Addresses (or names) of the configured devices a bluetooth scan should find.
+    """
+    targets = set()
+    for dev in devices:
+        addr: str = dev.get('address') or ''
+        if not addr or addr.startswith('#') or addr.startswith('test_') or dev.get('replay'):
+            continue
+        if dev.get('type') == 'auto' or getattr(get_bms_model_class(dev.get('type')), 'DISCOVERABLE', False):
+            targets.add(addr)
+    return targets
@@ -22,6 +22,8 @@ import crcmod as crcmod
 
 from bmslib.bms import BmsSample, DeviceInfo
 from bmslib.bt import BtBms
+from bmslib.frame import FrameAssembler
+from bmslib.layout import Field, Layout, unpack_array
 from bmslib.util import to_hex_str
 
 crc16_modbus = crcmod.mkCrcFun(0x18005, rev=True, initCrc=0xFFFF, xorOut=0x0000)
@@ -32,6 +34,33 @@ def calc_crc16(data: bytes):
     return [i & 0xff, (i >> 8) & 0xff]
 
 
+def _frame_length(frame: memoryview):
+    # 0x7E 0xA1, func, addr (2), data length, data, crc (2), 0xAA 0x55
+    return 6 + frame[5] + 4 if len(frame) >= 6 else None
+
+
+def _check_frame(frame: memoryview):
+    return calc_crc16(bytes(frame[1:-4])) == list(frame[-4:-2])
+
+
+# status response 0x11, offsets for a BMS without cells and temperature sensors, see AntBt.fetch()
+STATUS_LAYOUT = Layout('<', [
+    Field('mos_temperature', 34, 'H'),
+    # 36 balancer temperature
+    Field('voltage', 38, 'H', .01),
+    Field('current', 40, 'h', .1),
+    Field('soc', 42, 'H'),
+    # 44 state of health
+    Field('switch_dsg', 46, 'B'),  # dsg mos state
+    Field('switch_chg', 47, 'B'),  # charge mos state
+    # 48 balance state, 49 reserved
+    Field('capacity', 50, 'I', 1e-6),
+    Field('charge', 54, 'I', 1e-6),
+    Field('cycle_charge', 58, 'I', .001),
+    # 62 power (int32)
+])
+
+
 class AntCommandFuncs(enum.Enum):
     Status = 0x01
     DeviceInfo = 0x02
@@ -56,13 +85,15 @@ class AntBt(BtBms):
     CHAR_UUID = '0000ffe1-0000-1000-8000-00805f9b34fb'  # Handle 0x10
     TIMEOUT = 16
     WRITE_REGISTER = 0x51
+    # response framing, see FrameAssembler
+    FRAMING = dict(header=b'\x7E\xA1', length=_frame_length, trailer=b'\x55', check=_check_frame)
 
     TEMPERATURE_STEP = 1 # it sends out noisy data in between
     TEMPERATURE_SMOOTH = 40
 
     def __init__(self, address, **kwargs):
         super().__init__(address, _uses_pin=False, **kwargs)
-        self._buffer = bytearray()
+        self._frames = FrameAssembler(self._on_frame, logger=self.logger, **self.FRAMING)
         self._switches = None
         self._last_response = None
         self._voltages = []
@@ -73,32 +104,11 @@ class AntBt(BtBms):
 
         # print("bms msg {0}: {1} {2}".format(sender, to_hex_str(data), data))
 
-        if data.startswith(b'\x7E\xA1'):
-            self._buffer.clear()
-
-        self._buffer += data
+        self._frames.feed(data)
 
-        if self._buffer.endswith(b'\x55'):
-            buf = self._buffer
-            func = buf[2]
-            data_len = buf[5]
-            frame_len = 6 + data_len + 4
-
-            if len(buf) < frame_len:
-                self.logger.warning('Unexpected size: header says %d, got %d bytes', frame_len, len(buf))
-                buf.clear()
-                return
-
-            crc = calc_crc16(buf[1:1 + frame_len - 5])
-            crc_exp = list(buf[frame_len - 4:frame_len - 2])
-
-            self._last_response = buf[:]
-            self._buffer.clear()
-
-            if crc != crc_exp:
-                self.logger.warning('CRC16 error: %s != %s (expected)', crc, crc_exp)
-            else:
-                self._fetch_futures.set_result(func, self._last_response)
+    def _on_frame(self, frame: memoryview):
+        self._last_response = bytearray(frame)
+        self._fetch_futures.set_result(frame[2], self._last_response)
 
     async def connect(self, timeout=20, **kwargs):
         # await super().connect(**kwargs)
@@ -115,9 +125,9 @@ class AntBt(BtBms):
         await super().disconnect()
 
     async def _q(self, cmd: AntCommandFuncs, addr, val, resp_code):
-        with await self._fetch_futures.acquire_timeout(resp_code, timeout=self.TIMEOUT/2):
-            await self.client.write_gatt_char(self.CHAR_UUID, data=_ant_command(cmd, addr, val))
-            return await self._fetch_futures.wait_for(resp_code, self.TIMEOUT)
+        return await self._fetch_futures.request(
+            resp_code, lambda: self.client.write_gatt_char(self.CHAR_UUID, data=_ant_command(cmd, addr, val)),
+            self.TIMEOUT)
 
     async def fetch_device_info(self) -> DeviceInfo:
         buf: bytearray = await self._q(AntCommandFuncs.DeviceInfo, 0x026c, 0x20, resp_code=0x12)
@@ -136,82 +146,32 @@ class AntBt(BtBms):
         # data = bytearray(b'~\xa1\x11\x00\x00~\x05\x01\x02\x08\x02\x00\x00\x00\x00\x00\x00\x00\x01\x00B\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xd4\r\xd5\r\xd5\r\xd5\r\xd5\r\xd4\r\xd5\r\xd5\r\xd8\xff\xd8\xff\x1c\x00\x1d\x00\x11\x0b\x00\x00d\x00d\x00\x01\x02\x00\x00\x00\xe1\xf5\x05\x00\xe1\xf5\x05\xa52\x00\x00\x00\x00\x00\x00\xff\x97\x01\x00\x00\x00\x00\x00\xd5\r\x02\x00\xd4\r\x01\x00\x01\x00\xd4\r\xf8\xff\x82\x00\x00\x00\xab\x02\xf2\xfa\x10\x00\x00\x00:e\x00\x00\x1f\x00\x00\x00\xfab\x00\x00\x11\xc3\xaaU')
         data = await self._q(AntCommandFuncs.Status, 0x0000, 0xbe, resp_code=0x11)
 
-        u16 = lambda i: int.from_bytes(data[i:(i + 2)], byteorder='little', signed=False)
-        i16 = lambda i: int.from_bytes(data[i:(i + 2)], byteorder='little', signed=True)
-        u32 = lambda i: int.from_bytes(data[i:(i + 4)], byteorder='little', signed=False)
-        i32 = lambda i: int.from_bytes(data[i:(i + 4)], byteorder='little', signed=True)
-
         num_temp = data[8]
         num_cell = data[9]
-        offset = 34
-
-        self._voltages = [u16(i * 2 + offset) for i in range(num_cell)]
-        offset += num_cell * 2
 
-        temperatures = [u16(i * 2 + offset) for i in range(num_temp)]
+        # cell voltages and temperatures (uint16 each) are followed by the status fields
+        self._voltages = unpack_array(data, 34, num_cell, 'H', '<')
+        temperatures = unpack_array(data, 34 + num_cell * 2, num_temp, 'H', '<')
         temperatures = [t if t != 65496 else math.nan for t in temperatures]
-        offset += num_temp * 2
-
-        mos_temp = u16(offset)
-        offset += 2
-
-        # balancer_temp = u16(offset)
-        offset += 2
-
-        voltage = u16(offset) * 0.01
-        offset += 2
-
-        current = i16(offset) * 0.1
-        offset += 2
-
-        soc = u16(offset)
-        offset += 2
-
-        # soh = u16(offset)  # state of health
-        offset += 2
-
-        # dsg mos state
-        switch_dsg = data[offset]
-        offset += 1
-
-        # charge mos state
-        switch_chg = data[offset]
-        offset += 1
-
-        # bal state
-        offset += 1
-
-        # reserved ?
-        offset += 1
-
-        capacity = u32(offset) * 0.000001
-        offset += 4
-
-        charge = u32(offset) * 0.000001
-        offset += 4
-
-        cycle_charge = u32(offset) * 0.001
-        offset += 4
 
-        # power = i32(offset)
-        offset += 4
+        v = STATUS_LAYOUT.unpack(data, shift=(num_cell + num_temp) * 2)
 
         sample = BmsSample(
-            voltage=voltage,
-            current=current,
+            voltage=v['voltage'],
+            current=v['current'],
             # power=
-            charge=charge,
-            capacity=capacity,
-            cycle_capacity=cycle_charge,
+            charge=v['charge'],
+            capacity=v['capacity'],
+            cycle_capacity=v['cycle_charge'],
             # num_cycles=0,
-            soc=soc,
+            soc=v['soc'],
 
             temperatures=temperatures,
-            mos_temperature=mos_temp,
+            mos_temperature=v['mos_temperature'],
 
             switches=dict(
-                discharge=switch_dsg == 1,
-                charge=switch_chg == 1,
+                discharge=v['switch_dsg'] == 1,
+                charge=v['switch_chg'] == 1,
             ),
 
             # charge_enabled
@@ -18,17 +18,24 @@ import asyncio
 import math
 import struct
 import time
-from typing import Dict
+from typing import Any, Dict
 
-from bmslib.bms import BmsSample
+from bmslib.bms import BmsSample, QueryCache
 from bmslib.bt import BtBms, enumerate_services
-from bmslib.cache.mem import mem_cache_deco
+from bmslib.frame import FrameAssembler
 
 
 def calc_crc(message_bytes):
     return sum(message_bytes) & 0xFF
 
 
+RESP_LEN = 13
+
+
+def _check_frame(frame: memoryview):
+    return calc_crc(frame[0:RESP_LEN - 1]) == frame[RESP_LEN - 1]
+
+
 def daly_command_message(command: int, extra=""):
     """
     Takes the command ID and formats a request message
@@ -54,12 +61,17 @@ def daly_command_message(command: int, extra=""):
 
 class DalyBt(BtBms):
     TIMEOUT = 12
+    # response framing, see FrameAssembler
+    FRAMING = dict(header=b'\xa5', length=RESP_LEN, check=_check_frame)
 
     SOC_NOT_FULL_YET = 99.1  # when the gauge reaches 100% but no OV yet
 
     TEMPERATURE_STEP = 1
     TEMPERATURE_SMOOTH = 40
 
+    FETCH_INTERVALS = dict(voltages=10)  # voltages take the most response frames
+    QUERY_LIFETIMES = {0x93: QueryCache.SLOW, 0x94: QueryCache.STATIC}  # status (switches), states (cell count)
+
     def __init__(self, address, **kwargs):
         super().__init__(address, **kwargs)
         if kwargs.get('psk'):
@@ -67,55 +79,41 @@ class DalyBt(BtBms):
         self.UUID_RX = None
         self.UUID_TX = None
         self._fetch_nr: Dict[int, list] = {}
+        self._frames = FrameAssembler(self._on_frame, logger=self.logger, **self.FRAMING)
         # self._num_cells = 0
-        self._states = None
         self._last_response = None
+        self._prefetched: Dict[int, list] = {}  # responses queried along with fetch()
 
     async def get_states_cached(self, key):
-        if not self._states:
-            self._states = await self.fetch_states()
-            self.logger.debug('got daly states: %s', self._states)
-        return self._states.get(key)
+        states = await self._q_cached(0x94, self.fetch_states)
+        return states.get(key)
 
     def _notification_callback(self, _sender, data):
-        RESP_LEN = 13
-
-        # split responses into chunks with length RESP_LEN
-        responses = [data[i:i + RESP_LEN] for i in range(0, len(data), RESP_LEN)]
+        # a notification can hold several responses of RESP_LEN bytes
+        self._frames.feed(data)
 
-        for response_bytes in responses:
-            self.logger.debug('daly resp: %s', response_bytes)
+    def _on_frame(self, frame: memoryview):
+        self.logger.debug('daly resp: %s', bytes(frame))
 
-            if len(response_bytes) < RESP_LEN:
-                self.logger.warning("msg too short: %s", response_bytes)
-                continue
+        command = frame[2]
+        response_bytes = bytes(frame[4:-1])
 
-            check_comp = calc_crc(response_bytes[0:12])
-            check_expect = response_bytes[12]
-
-            command = response_bytes[2]
-            response_bytes = response_bytes[4:-1]
-
-            if check_comp != check_expect:
-                self.logger.warning("checksum fail, expected %s, got %s. %s", check_expect, check_comp, response_bytes)
-                continue
-
-            # buffer for multi-response commands
-            buf = self._fetch_nr.get(command, None)
-            if buf:
-                try:
-                    i = buf.index(None)
-                    buf[i] = response_bytes
-                    if i + 1 == len(buf):  # last item?
-                        response_bytes = buf
-                    else:
-                        continue
-                except ValueError:
-                    # this happens if buf is already full and still receiving messages
-                    continue
-
-            self._last_response = response_bytes
-            self._fetch_futures.set_result(command, response_bytes)
+        # buffer for multi-response commands
+        buf = self._fetch_nr.get(command, None)
+        if buf:
+            try:
+                i = buf.index(None)
+                buf[i] = response_bytes
+                if i + 1 == len(buf):  # last item?
+                    response_bytes = buf
+                else:
+                    return
+            except ValueError:
+                # this happens if buf is already full and still receiving messages
+                return
+
+        self._last_response = response_bytes
+        self._fetch_futures.set_result(command, response_bytes)
 
     async def connect(self, timeout=10, **kwargs):
         try:
@@ -130,6 +128,12 @@ class DalyBt(BtBms):
              '02f00000-0000-0000-0000-00000000ff01'),  # (15,19,31)
         ]
 
+        # try the characteristics that worked last time first
+        cached = tuple(self.gatt_cache().get('rx_tx_sx') or ())
+        if cached in CHARACTERISTIC_UUIDS:
+            CHARACTERISTIC_UUIDS.remove(cached)
+            CHARACTERISTIC_UUIDS.insert(0, cached)
+
         for rx, tx, sx in CHARACTERISTIC_UUIDS:
             try:
                 await self.client.start_notify(rx, self._notification_callback)
@@ -137,6 +141,7 @@ class DalyBt(BtBms):
                 self.UUID_RX = rx
                 self.UUID_TX = tx
                 self.logger.debug("found rx uuid to be working: %s (tx %s, sx %s)", rx, tx, sx)
+                self.remember_gatt(rx_tx_sx=[rx, tx, sx])
                 break
             except Exception as e:
                 self.logger.warning("tried rx/tx/sx uuids %s/%s/%s: %s", rx, tx, sx, e)
@@ -152,31 +157,38 @@ class DalyBt(BtBms):
         await super().disconnect()
 
     async def _q(self, command: int, num_responses: int = 1):
-        msg = daly_command_message(command)
-        if num_responses > 1:
-            self._fetch_nr[command] = [None] * num_responses
-        else:
-            self._fetch_nr.pop(command, None)
-
-        with await self._fetch_futures.acquire_timeout(command, timeout=self.TIMEOUT / 2):
-            self.logger.debug("daly send: %s", msg)
-            await self.client.write_gatt_char(self.UUID_TX, msg)
-
-            try:
-                sample = await self._fetch_futures.wait_for(command, self.TIMEOUT)
-            except TimeoutError:
-                n_recv = num_responses - self._fetch_nr.get(command, [None]).count(None)
-                raise TimeoutError(
-                    "timeout awaiting result %02x, got %d/%d responses" % (command, n_recv, num_responses))
-
-            return sample
+        try:
+            return (await self._q_many({command: num_responses}))[command]
+        except TimeoutError:
+            n_recv = num_responses - self._fetch_nr.get(command, [None]).count(None)
+            raise TimeoutError(
+                "timeout awaiting result %02x, got %d/%d responses" % (command, n_recv, num_responses))
+
+    async def _q_many(self, commands: Dict[int, int]) -> Dict[int, Any]:
+        """
+        Send several commands at once and wait for all responses.
+        :param commands: command -> number of response frames
+        :return: command -> response (a list of frames for multi-response commands)
+        """
+
+        def prepare():
+            for command, num_responses in commands.items():
+                if num_responses > 1:
+                    self._fetch_nr[command] = [None] * num_responses
+                else:
+                    self._fetch_nr.pop(command, None)
+            self.logger.debug("daly send: %s", ' '.join('%02x' % c for c in commands))
+
+        responses = await self._q_batch([(c, daly_command_message(c)) for c in commands], self.UUID_TX,
+                                        prepare=prepare)
+        return dict(zip(commands, responses))
 
     async def set_switch(self, switch: str, state: bool):
         fet_addr = dict(discharge=0xD9, charge=0xDA)
         msg = daly_command_message(fet_addr[switch], extra="01" if state else "00")
         self.logger.info('write %s', msg)
-        self._fetch_status.invalidate(self)
-        status = await self._fetch_status()
+        self.query_cache.invalidate(QueryCache.SLOW)
+        status = await self._get_status()
         await self.client.write_gatt_char(self.UUID_TX, msg)
 
         #if switch == "charge" and state != status['discharging_mosfet']:
@@ -184,22 +196,52 @@ class DalyBt(BtBms):
         #    await self.client.write_gatt_char(self.UUID_TX, msg)
 
     async def fetch(self) -> BmsSample:
-        status = await self._fetch_status()
-
-        sample = await self.fetch_soc(sample_kwargs=dict(
+        # query everything this sample needs in one go, instead of a round trip per command
+        timestamp = time.time()
+        plan = self.fetch_plan
+        cache = self.query_cache
+        status, states = cache.get(0x93), cache.get(0x94)
+        commands = {0x90: 1}
+        if status is None:
+            commands[0x93] = 1
+        if states is None:
+            commands[0x94] = 1
+        else:
+            # read ahead what the sampler is going to ask for next, see fetch_voltages() and fetch_temperatures()
+            if plan.due('voltages') and 0x95 not in self._prefetched and states['num_cells'] > 0:
+                commands[0x95] = math.ceil(states['num_cells'] / 3)
+            if plan.due('temperatures') and 0x96 not in self._prefetched and states['num_temps'] > 0:
+                commands[0x96] = math.ceil(states['num_temps'] / 7)
+
+        responses = await self._q_many(commands)
+
+        if 0x93 in responses:
+            status = self._parse_status(responses[0x93])
+            cache.put(0x93, status)
+        if 0x94 in responses:
+            states = self._parse_states(responses[0x94])
+            cache.put(0x94, states)
+        for c, kind in ((0x95, 'voltages'), (0x96, 'temperatures')):
+            if c in responses:
+                self._prefetched[c] = responses[c]
+                plan.prefetched(kind, timestamp)
+
+        return self._parse_soc(responses[0x90], timestamp, sample_kwargs=dict(
+            num_cycles=states.get('num_cycles'),
             charge=status['capacity_ah'],
             switches=dict(
                 charge=bool(status['charging_mosfet']),
                 discharge=bool(status['discharging_mosfet'])
             ),
         ))
-        # self.logger.info(sample.switches)
-        return sample
 
     async def fetch_soc(self, sample_kwargs=None):
         timestamp = time.time()
         resp = await self._q(0x90)
+        num_cycles = await self.get_states_cached('num_cycles')
+        return self._parse_soc(resp, timestamp, dict(sample_kwargs or {}, num_cycles=num_cycles))
 
+    def _parse_soc(self, resp, timestamp, sample_kwargs=None):
         parts = struct.unpack('>h h h h', resp)
 
         # x_v =  parts[1] / 10,  # always 0 "x_voltage", acquisition
@@ -208,9 +250,8 @@ class DalyBt(BtBms):
             voltage=parts[0] / 10,
             current=(parts[2] - 30000) / 10,  # negative=charging, positive=discharging
             soc=parts[3] / 10,
-            num_cycles=await self.get_states_cached('num_cycles'),
             timestamp=timestamp,
-            **sample_kwargs,
+            **(sample_kwargs or {}),
         )
 
         if sample.soc < 0 or sample.soc > 100:
@@ -219,10 +260,13 @@ class DalyBt(BtBms):
 
         return sample
 
-    @mem_cache_deco(ttl=30)
+    async def _get_status(self):
+        return await self._q_cached(0x93, self._fetch_status)
+
     async def _fetch_status(self):
-        response_data = await self._q(0x93)
+        return self._parse_status(await self._q(0x93))
 
+    def _parse_status(self, response_data):
         # dsgOFF:
         # bytearray(b'\x01\x01\x01]\x00\x03\xda,')    '1 1 1 5d 0 3 da 2c'
         # bytearray(b'\x01\x01\x01k\x00\x03\xe2L')    '1 1 1 6b 0 3 e2 4c'
@@ -256,9 +300,9 @@ class DalyBt(BtBms):
         return status
 
     async def fetch_states(self):
+        return self._parse_states(await self._q(0x94))
 
-        response_data = await self._q(0x94)
-
+    def _parse_states(self, response_data):
         parts = struct.unpack('>b b ? ? b h x', response_data)
 
         state_bits = bin(parts[4])[2:]
@@ -295,7 +339,7 @@ class DalyBt(BtBms):
             assert isinstance(num_cells, int) and 0 < num_cells <= 32, "num_cells %s outside range" % num_cells
 
         num_resp = math.ceil(num_cells / 3)  # bms sends tuples of 3 (ceil)
-        resp = await self._q(0x95, num_responses=num_resp)
+        resp = self._prefetched.pop(0x95, None) or await self._q(0x95, num_responses=num_resp)
         voltages = []
         for i in range(num_resp):
             v = struct.unpack(">b 3h x", resp[i])
@@ -312,7 +356,7 @@ class DalyBt(BtBms):
 
         temperatures = []
         n_resp = math.ceil(num_sensors / 7)  # bms sends tuples of 7 (ceil)
-        resp = await self._q(0x96, num_responses=n_resp)
+        resp = self._prefetched.pop(0x96, None) or await self._q(0x96, num_responses=n_resp)
         if n_resp == 1:
             resp = [resp]
         for i in range(n_resp):
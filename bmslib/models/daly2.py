@@ -11,34 +11,47 @@ References
 from bmslib import FuturesPool
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
+from bmslib.frame import FrameAssembler
+from bmslib.layout import Field, Layout, unpack_array
 
 
 def _daly_command(command: int):
     return bytes([0xDD, 0xA5, command, 0x00, 0xFF, 0xFF - (command - 1), 0x77])
 
 
+# offsets into the data (after the 3 byte header)
+STATUS_LAYOUT = Layout('>', [
+    Field('product_date', 10, 'h'),
+    Field('mos_byte', 20, 'B'),
+    Field('voltage', 80, 'H', .1),
+    Field('current', 82, 'H', .1, bias=-30000),
+    Field('soc', 84, 'H', .1),
+    Field('charge', 96, 'H', .1),
+    Field('num_temp', 100, 'H'),
+    Field('num_cycles', 102, 'H'),
+])
+
+
 class Daly2Bt(BtBms):
     UUID_RX = '0000fff1-0000-1000-8000-00805f9b34fb'
     UUID_TX = '0000fff2-0000-1000-8000-00805f9b34fb'
     TIMEOUT = 8
+    # response framing, see FrameAssembler
+    FRAMING = dict(trailer=b'w')
 
     def __init__(self, address, **kwargs):
         super().__init__(address, **kwargs)
-        self._buffer = bytearray()
+        self._frames = FrameAssembler(self._on_frame, logger=self.logger, **self.FRAMING)
         self._fetch_futures = FuturesPool()
         self._switches = None
 
     def _notification_handler(self, _sender, data):
         self.logger.debug("ble data frame %s", data)
-        self._buffer += data
-
-        if self._buffer.endswith(b'w'):
-            command = self._buffer[1]
-            buf = self._buffer[:]
-            self._buffer.clear()
+        self._frames.feed(data)
 
-            # print(command, 'buffer endswith w', self._buffer)
-            self._fetch_futures.set_result(command, buf)
+    def _on_frame(self, frame: memoryview):
+        buf = bytearray(frame)
+        self._fetch_futures.set_result(buf[1], buf)
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
@@ -50,7 +63,7 @@ class Daly2Bt(BtBms):
         await super().disconnect()
 
     async def _q(self, cmd):
-        with self._fetch_futures.acquire(cmd):
+        with await self._fetch_futures.acquire_timeout(cmd, timeout=self.TIMEOUT / 2):
             # await self.client.write_gatt_char(self.UUID_TX, data=_jbd_command(cmd))
             return await self._fetch_futures.wait_for(cmd, self.TIMEOUT)
 
@@ -59,24 +72,24 @@ class Daly2Bt(BtBms):
         #  https://github.com/roccotsi2/esp32-smart-bms-simulation
 
         buf = await self._q(cmd=bytes.fromhex("D2 03 00 00 00 3E D7 B9"))
-        buf = buf[3:]
+        v = STATUS_LAYOUT.unpack(buf, base=3)
 
         #num_cell = int.from_bytes(buf[21:22], 'big')
-        num_temp = int.from_bytes(buf[100:102], 'big')
+        num_temp = v['num_temp']
 
-        mos_byte = int.from_bytes(buf[20:21], 'big')
+        mos_byte = v['mos_byte']
 
         sample = BmsSample(
-            voltage=int.from_bytes(buf[80:82], byteorder='big') / 10,
-            current=(int.from_bytes(buf[82:84], byteorder='big') - 30000) / 10,
-            soc=int.from_bytes(buf[84:86], byteorder='big') / 10,
+            voltage=v['voltage'],
+            current=v['current'],
+            soc=v['soc'],
 
-            charge=int.from_bytes(buf[96:98], byteorder='big') / 10,
+            charge=v['charge'],
             #capacity=int.from_bytes(buf[6:8], byteorder='big', signed=True) / 100,
 
-            num_cycles=int.from_bytes(buf[102:104], byteorder='big'),
+            num_cycles=v['num_cycles'],
 
-            temperatures=[(int.from_bytes(buf[64 + i * 2:i * 2 + 66], 'big') - 40) for i in range(num_temp)],
+            temperatures=[t - 40 for t in unpack_array(buf, 3 + 64, num_temp, 'H', '>')],
 
             switches=dict(
                 discharge=mos_byte == 2 or mos_byte == 3,
@@ -94,7 +107,6 @@ class Daly2Bt(BtBms):
         # self.rawdat['P']=round(self.rawdat['Vbat']*self.rawdat['Ibat'], 1)
         # self.rawdat['Bal'] = int.from_bytes(self.response[12:14], byteorder='big', signed=False)
 
-        product_date = int.from_bytes(buf[10:12], byteorder='big', signed=True)
         # productDate = convertByteToUInt16(data1: data[14], data2: data[15])
 
         return sample
@@ -16,6 +16,7 @@ from bmslib.util import get_logger, dotdict
 
 class DummyBt(BtBms):
     TEMPERATURE_STEP = .1
+    DISCOVERABLE = False
 
     def __init__(self, address, **kwargs):
         super().__init__(address, **kwargs)
@@ -100,6 +101,9 @@ class BleakDummyClient:
     async def start_notify(self, char_specifier, callback: Callable[[int, bytearray], None]):
         return await self._bms.start_notify(char_specifier, callback)
 
+    async def stop_notify(self, char_specifier):
+        pass
+
     async def write_gatt_char(self, char_specifier, data: Union[bytes, bytearray, memoryview],
                               response: bool = False, ):
         return await self._bms.write_gatt_char(char_specifier, data, response)
@@ -178,4 +182,7 @@ class JBDDummy:
         if data == b'\xdd\xa5\x03\x00\xff\xfdw':
             msg = bytearray.fromhex('dd03001b0a50fda4b717dac000002cf300000000000016540308020b7d0b77f8e277')
             self._callbacks['0000ff01-0000-1000-8000-00805f9b34fb'](self, bytes(msg))
+        elif data == b'\xdd\xa5\x04\x00\xff\xfcw':
+            msg = bytearray.fromhex('dd0400100ce50ce20ce90ce60ce30ce40ce70ce5f86777')
+            self._callbacks['0000ff01-0000-1000-8000-00805f9b34fb'](self, bytes(msg))
         pass
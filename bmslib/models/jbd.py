@@ -16,36 +16,61 @@ import asyncio
 
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
+from bmslib.frame import FrameAssembler
+from bmslib.layout import Field, Layout, unpack_array
 
 
 def _jbd_command(command: int):
     return bytes([0xDD, 0xA5, command, 0x00, 0xFF, 0xFF - (command - 1), 0x77])
 
 
+def _frame_length(frame: memoryview):
+    # 0xDD, command, status, data length, data, 2 checksum bytes, 0x77
+    return frame[3] + 7 if len(frame) >= 4 else None
+
+
+def _check_frame(frame: memoryview):
+    return (0x10000 - sum(frame[2:-3])) & 0xFFFF == int.from_bytes(frame[-3:-1], 'big')
+
+
+# basic info 0x03, offsets into the data (after the 4 byte header)
+BASIC_INFO_LAYOUT = Layout('>', [
+    Field('voltage', 0, 'H', .01),
+    Field('current', 2, 'h', -.01),
+    Field('charge', 4, 'H', .01),
+    Field('capacity', 6, 'H', .01),
+    Field('num_cycles', 8, 'H'),
+    Field('product_date', 10, 'h'),
+    Field('soc', 19, 'B'),
+    Field('mos_byte', 20, 'B'),
+    Field('num_cell', 21, 'B'),
+    Field('num_temp', 22, 'B'),
+])
+
+
 class JbdBt(BtBms):
     UUID_RX = '0000ff01-0000-1000-8000-00805f9b34fb'
     UUID_TX = '0000ff02-0000-1000-8000-00805f9b34fb'
     TIMEOUT = 16
+    FETCH_INTERVALS = dict(voltages=10)  # cell voltages are a separate query (0x04)
+    # response framing, see FrameAssembler
+    FRAMING = dict(header=b'\xdd', length=_frame_length, trailer=b'\x77', check=_check_frame)
 
     def __init__(self, address, **kwargs):
         super().__init__(address, **kwargs)
-        self._buffer = bytearray()
+        self._frames = FrameAssembler(self._on_frame, logger=self.logger, **self.FRAMING)
         self._switches = None
         self._last_response = None
+        self._prefetched = {}  # responses queried along with fetch()
 
     def _notification_handler(self, sender, data):
-
         # print("bms msg {0}: {1}".format(sender, data))
-        self._buffer += data
-
-        if self._buffer.endswith(b'w'):
-            command = self._buffer[1]
-            buf = self._buffer[:]
-            self._buffer.clear()
+        self._frames.feed(data)
 
-            # print(command, 'buffer endswith w', self._buffer)
-            self._last_response = buf
-            self._fetch_futures.set_result(command, buf)
+    def _on_frame(self, frame: memoryview):
+        buf = bytes(frame)
+        self._last_response = buf
+        self._fetch_futures.set_result(buf[1], buf)
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
@@ -62,33 +87,39 @@ class JbdBt(BtBms):
         await super().disconnect()
 
     async def _q(self, cmd):
-        with self._fetch_futures.acquire(cmd):
-            await self.client.write_gatt_char(self.UUID_TX, data=_jbd_command(cmd))
-            return await self._fetch_futures.wait_for(cmd, self.TIMEOUT)
+        return await self._fetch_futures.request(
+            cmd, lambda: self.client.write_gatt_char(self.UUID_TX, data=_jbd_command(cmd)), self.TIMEOUT)
 
     async def fetch(self) -> BmsSample:
         # binary reading
         #  https://github.com/NeariX67/SmartBMSUtility/blob/main/Smart%20BMS%20Utility/Smart%20BMS%20Utility/BMSData.swift
 
-        buf = await self._q(cmd=0x03)
-        buf = buf[4:]
+        plan = self.fetch_plan
+        commands = [0x03]
+        if plan.due('voltages') and 0x04 not in self._prefetched:
+            commands.append(0x04)  # read ahead, see fetch_voltages()
+        responses = await self._q_batch([(c, _jbd_command(c)) for c in commands], self.UUID_TX)
+        if len(commands) > 1:
+            self._prefetched[0x04] = responses[1]
+            plan.prefetched('voltages')
 
-        num_cell = int.from_bytes(buf[21:22], 'big')
-        num_temp = int.from_bytes(buf[22:23], 'big')
+        buf = responses[0]
+        v = BASIC_INFO_LAYOUT.unpack(buf, base=4)
 
-        mos_byte = int.from_bytes(buf[20:21], 'big')
+        num_temp = v['num_temp']
+        mos_byte = v['mos_byte']
 
         sample = BmsSample(
-            voltage=int.from_bytes(buf[0:2], byteorder='big', signed=False) / 100,
-            current=-int.from_bytes(buf[2:4], byteorder='big', signed=True) / 100,
+            voltage=v['voltage'],
+            current=v['current'],
 
-            charge=int.from_bytes(buf[4:6], byteorder='big', signed=False) / 100,
-            capacity=int.from_bytes(buf[6:8], byteorder='big', signed=False) / 100,
-            soc=buf[19],
+            charge=v['charge'],
+            capacity=v['capacity'],
+            soc=v['soc'],
 
-            num_cycles=int.from_bytes(buf[8:10], byteorder='big', signed=False),
+            num_cycles=v['num_cycles'],
 
-            temperatures=[(int.from_bytes(buf[23 + i * 2:i * 2 + 25], 'big') - 2731) / 10 for i in range(num_temp)],
+            temperatures=[(t - 2731) / 10 for t in unpack_array(buf, 4 + 23, num_temp, 'H', '>')],
 
             switches=dict(
                 discharge=mos_byte == 2 or mos_byte == 3,
@@ -106,16 +137,14 @@ class JbdBt(BtBms):
         # self.rawdat['P']=round(self.rawdat['Vbat']*self.rawdat['Ibat'], 1)
         # self.rawdat['Bal'] = int.from_bytes(self.response[12:14], byteorder='big', signed=False)
 
-        product_date = int.from_bytes(buf[10:12], byteorder='big', signed=True)
         # productDate = convertByteToUInt16(data1: data[14], data2: data[15])
 
         return sample
 
     async def fetch_voltages(self):
-        buf = await self._q(cmd=0x04)
+        buf = self._prefetched.pop(0x04, None) or await self._q(cmd=0x04)
         num_cell = int(buf[3] / 2)
-        voltages = [(int.from_bytes(buf[4 + i * 2:i * 2 + 6], 'big')) for i in range(num_cell)]
-        return voltages
+        return unpack_array(buf, 4, num_cell, 'H', '>')
 
     async def set_switch(self, switch: str, state: bool):
 
@@ -20,10 +20,12 @@ from collections import defaultdict
 
 import asyncio
 import time
-from typing import List, Callable, Dict, Tuple
+from typing import List, Callable, Dict, Optional, Tuple
 
-from bmslib.bms import BmsSample, DeviceInfo
+from bmslib.bms import BmsSample, DeviceInfo, LazyBmsSample
 from bmslib.bt import BtBms
+from bmslib.frame import FrameAssembler
+from bmslib.layout import Field, Layout, unpack_array
 from bmslib.util import to_hex_str
 
 
@@ -45,16 +47,61 @@ def _jk_command(address, value: list = ()):
     return frame
 
 
-MIN_RESPONSE_SIZE = 300
-MAX_RESPONSE_SIZE = 320
+RESPONSE_HEADER = bytes([0x55, 0xAA, 0xEB, 0x90])
+RESPONSE_SIZE = 300
+
+
+def _check_frame(frame: memoryview):
+    return calc_crc(frame[0:RESPONSE_SIZE - 1]) == frame[RESPONSE_SIZE - 1]
+
+
+# 0x02 frame (cell info), variant '32s' is firmware >= 11, which has all offsets shifted by 32
+CELL_INFO_LAYOUT = Layout('<', [
+    Field('voltage', 118, 'I', 1e-3),
+    Field('current', 126, 'i', -1e-3),
+    Field('temp1', 130, 'h', .1, nan=-2000),
+    Field('temp2', 132, 'h', .1, nan=-2000),
+    Field('mos_temperature', 134, 'h', .1, variant='24s'),
+    Field('mos_temperature', 112, 'h', .1, variant='32s'),
+    Field('balance_current', 138, 'h', 1e-3),
+    Field('soc', 141, 'B'),
+    Field('charge', 142, 'I', 1e-3),  # "remaining capacity"
+    Field('capacity', 146, 'I', 1e-3),  # computed capacity (starts at self.capacity, which is user-defined)
+    Field('num_cycles', 150, 'I'),
+    Field('cycle_capacity', 154, 'I', 1e-3),  # total charge TODO rename cycle charge
+    Field('uptime', 162, 'I'),  # seconds
+    #  166 charge FET state, 167 discharge FET state
+    Field('temp3', 224, 'h', .1, nan=-2000, variant='32s'),
+    Field('temp4', 226, 'h', .1, nan=-2000, variant='32s'),
+])
+
+_FIELDS_24S = dict(
+    temperatures=lambda s: [s.raw('temp1'), s.raw('temp2')],
+    uptime=lambda s: float(s.raw('uptime')),
+)
+_FIELDS_32S = dict(
+    _FIELDS_24S,
+    temperatures=lambda s: [s.raw('temp1'), s.raw('temp2'), s.raw('temp3'), s.raw('temp4')],
+)
+
+# 0x01 frame (settings)
+SETTINGS_LAYOUT = Layout('<', [
+    Field('charge', 118, 'B'),
+    Field('discharge', 122, 'B'),
+    Field('balance', 126, 'B'),
+])
 
 
 class JKBt(BtBms):
     SERVICE_UUID = "0000ffe0-0000-1000-8000-00805f9b34fb"
     CHAR_UUID = "0000ffe1-0000-1000-8000-00805f9b34fb"
+    # response framing, see FrameAssembler
+    FRAMING = dict(header=RESPONSE_HEADER, length=RESPONSE_SIZE, check=_check_frame)
 
     TIMEOUT = 8
 
+    SUPPORTS_PUSH = True  # after connect() the BMS continuously sends 0x02 frames
+
     SOC_NOT_FULL_YET = 99.0  # when the gauge reaches 100% but no OV yet
     TEMPERATURE_STEP = 0.1
     TEMPERATURE_SMOOTH = 30
@@ -63,55 +110,25 @@ class JKBt(BtBms):
         super().__init__(address, **kwargs)
         if kwargs.get('psk'):
             self.logger.warning('JK usually does not use a pairing PIN')
-        self._buffer = bytearray()
+        self._frames = FrameAssembler(self._decode_msg, logger=self.logger, **self.FRAMING)
         self._resp_table: Dict[int, Tuple[bytearray, float]] = {}
         self.num_cells = None
-        self._callbacks: Dict[int, List[Callable[[bytes], None]]] = defaultdict(List)
+        self._callbacks: Dict[int, List[Callable[[bytes], None]]] = defaultdict(list)
         self.char_handle_notify = None
         self.char_handle_write = None
         self.is_new_11fw_32s = None  # https://github.com/syssi/esphome-jk-bms/blob/main/esp32-ble-example.yaml#L6
-
-    def _buffer_crc_check(self):
-        crc_comp = calc_crc(self._buffer[0:MIN_RESPONSE_SIZE - 1])
-        crc_expected = self._buffer[MIN_RESPONSE_SIZE - 1]
-        if crc_comp != crc_expected:
-            self.logger.debug("crc check failed, %s != %s, %s", crc_comp, crc_expected, self._buffer)
-        return crc_comp == crc_expected
+        self._subscriptions: Dict[Callable[[BmsSample], None], Callable[[bytes], None]] = {}
 
     def _notification_handler(self, _sender, data):
-        HEADER = bytes([0x55, 0xAA, 0xEB, 0x90])
-
-        if data[0:4] == HEADER:  # and len(self._buffer)
-            self.logger.debug("header, clear buf %s", self._buffer)
-            self._buffer.clear()
-
-        self._buffer += data
-
-        self.logger.debug("bms msg(%d) (buf%d): %s\n", len(data), len(self._buffer), to_hex_str(data))
-
-        if len(self._buffer) >= MIN_RESPONSE_SIZE:
-            if len(self._buffer) > MAX_RESPONSE_SIZE:
-                self.logger.warning('buffer longer than expected %d %s', len(self._buffer), self._buffer)
+        self.logger.debug("bms msg(%d) (buf%d): %s\n", len(data), len(self._frames), to_hex_str(data))
+        self._frames.feed(data)
 
-            crc_ok = self._buffer_crc_check()
-
-            if not crc_ok and HEADER in self._buffer:
-                idx = self._buffer.index(HEADER)
-                self.logger.debug("crc check failed, header at %d, discarding start of %s", idx, self._buffer)
-                self._buffer = self._buffer[idx:]
-                crc_ok = self._buffer_crc_check()
-
-            if not crc_ok:
-                self.logger.error("crc check failed, discarding buffer %s", self._buffer)
-            else:
-                self._decode_msg(bytearray(self._buffer))
-            self._buffer.clear()
-
-    def _decode_msg(self, buf: bytearray):
+    def _decode_msg(self, frame: memoryview):
+        buf = bytearray(frame)
         resp_type = buf[4]
         self.logger.debug('got response %d (len%d)', resp_type, len(buf))
         self._resp_table[resp_type] = buf, time.time()
-        self._fetch_futures.set_result(resp_type, self._buffer[:])
+        self._fetch_futures.set_result(resp_type, buf)
         callbacks = self._callbacks.get(resp_type, None)
         if callbacks:
             for cb in callbacks:
@@ -131,6 +148,37 @@ class JKBt(BtBms):
             self.logger.info("%s normal connect failed (%s), connecting with scanner", self.name, str(e) or type(e))
             await self._connect_with_scanner(timeout=timeout)
 
+        cached = self.gatt_cache()
+        try:
+            # characteristics that worked last time, skips walking the services
+            if cached.get('notify') is None or cached.get('write') is None:
+                raise LookupError('not cached')
+            self.char_handle_notify, self.char_handle_write = cached['notify'], cached['write']
+            await self.start_notify(self.char_handle_notify, self._notification_handler)
+            await self._q(cmd=0x97, resp=0x03)  # device info
+        except Exception as e:
+            if cached.get('notify') is not None:
+                self.logger.info('%s cached characteristics failed (%s), resolving', self.name, str(e) or type(e))
+            self._resolve_chars()
+            await self.start_notify(self.char_handle_notify, self._notification_handler)
+            await self._q(cmd=0x97, resp=0x03)  # device info
+
+        await self._q(cmd=0x96, resp=(0x02, 0x01))  # device state (resp 0x01 & 0x02)
+        # after these 2 commands the bms will continuously send 0x02-type messages
+
+        buf, _ = self._resp_table[0x01]
+        self.num_cells = buf[114]
+        assert 0 < self.num_cells <= 24, "num_cells unexpected %s" % self.num_cells
+        # self.capacity = int.from_bytes(buf[130:134], byteorder='little', signed=False) * 0.001
+
+        sw_version = self._sw_version()
+        if self.is_new_11fw_32s is None and sw_version:
+            self.is_new_11fw_32s = self.gatt_cache(sw_version).get('frame_32s')
+        self.remember_gatt(sw_version, notify=getattr(self.char_handle_notify, 'handle', self.char_handle_notify),
+                           write=getattr(self.char_handle_write, 'handle', self.char_handle_write))
+
+    def _resolve_chars(self):
+        self.char_handle_notify = None
         service = self.get_service(self.SERVICE_UUID)
         self.char_handle_write = self.find_char(self.CHAR_UUID, 'write', service=service)
 
@@ -147,28 +195,19 @@ class JKBt(BtBms):
         self.logger.debug('char_handle_notify=%s, char_handle_write=%s', self.char_handle_notify,
                           self.char_handle_write)
 
-        await self.start_notify(self.char_handle_notify, self._notification_handler)
-
-        await self._q(cmd=0x97, resp=0x03)  # device info
-        await self._q(cmd=0x96, resp=(0x02, 0x01))  # device state (resp 0x01 & 0x02)
-        # after these 2 commands the bms will continuously send 0x02-type messages
-
-        buf, _ = self._resp_table[0x01]
-        self.num_cells = buf[114]
-        assert 0 < self.num_cells <= 24, "num_cells unexpected %s" % self.num_cells
-        # self.capacity = int.from_bytes(buf[130:134], byteorder='little', signed=False) * 0.001
-
     async def disconnect(self):
         await self.client.stop_notify(self.char_handle_notify)
         await super().disconnect()
 
     async def _q(self, cmd, resp):
         await asyncio.sleep(.1)
-        with await self._fetch_futures.acquire_timeout(resp, timeout=self.TIMEOUT / 2):
-            frame = _jk_command(cmd, [])
+        frame = _jk_command(cmd, [])
+
+        async def send():
             self.logger.debug("write %s", frame)
             await self.client.write_gatt_char(self.char_handle_write, data=frame)
-            return await self._fetch_futures.wait_for(resp, self.TIMEOUT)
+
+        return await self._fetch_futures.request(resp, send, self.TIMEOUT)
 
     async def _write(self, address, value):
         frame = _jk_command(address, value)
@@ -190,53 +229,31 @@ class JKBt(BtBms):
                           sn=read_str(buf, 6 + 16 + 8 + 16 + 40),
                           )
 
+    def _sw_version(self) -> Optional[str]:
+        try:
+            return read_str(self._resp_table[0x03][0], 6 + 16 + 8) or None
+        except (KeyError, ValueError, UnicodeDecodeError):
+            return None
+
     def _decode_sample(self, buf: bytearray, t_buf: float) -> BmsSample:
         buf_set, t_set = self._resp_table[0x01]
 
-        offset = 0
         if self.is_new_11fw_32s is None:
             self.is_new_11fw_32s = True
 
         if self.is_new_11fw_32s:
-            offset = 32
-            self.logger.debug('New 11.x firmware, offset=%s', offset)
-
-        i16 = lambda i: int.from_bytes(buf[i:(i + 2)], byteorder='little', signed=True)
-        u32 = lambda i: int.from_bytes(buf[i:(i + 4)], byteorder='little', signed=False)
-        f32u = lambda i: u32(i) * 1e-3
-        f32s = lambda i: int.from_bytes(buf[i:(i + 4)], byteorder='little', signed=True) * 1e-3
+            self.logger.debug('New 11.x firmware, offset=%s', 32)
+            layout = CELL_INFO_LAYOUT.compile(variant='32s', shift=32)
+            fields = _FIELDS_32S
+        else:
+            layout = CELL_INFO_LAYOUT.compile(variant='24s')
+            fields = _FIELDS_24S
 
-        temp = lambda x: float('nan') if x == -2000 else (x / 10)
+        switches = SETTINGS_LAYOUT.unpack(buf_set)
 
-        temperatures = [temp(i16(130 + offset)), temp(i16(132 + offset))]
-        if self.is_new_11fw_32s:
-            temperatures += [temp(i16(224 + offset)), temp(i16(226 + offset))]
-
-        return BmsSample(
-            voltage=f32u(118 + offset),
-            current=-f32s(126 + offset),
-            soc=buf[141 + offset],
-
-            cycle_capacity=f32u(154 + offset),  # total charge TODO rename cycle charge
-            capacity=f32u(146 + offset),  # computed capacity (starts at self.capacity, which is user-defined),
-            charge=f32u(142 + offset),  # "remaining capacity"
-
-            temperatures=temperatures,
-            mos_temperature=i16((112 if self.is_new_11fw_32s else 134) + offset) / 10,
-            balance_current=i16(138 + offset) / 1000,
-
-            # 146 charge_full (see above)
-            num_cycles=u32(150 + offset),
-            switches=dict(
-                charge=bool(buf_set[118]),
-                discharge=bool(buf_set[122]),
-                balance=bool(buf_set[126]),
-            ),
-            #  #buf[166 + offset]),  charge FET state
-            # buf[167 + offset]), discharge FET state
-            uptime=float(u32(162 + offset)),  # seconds
-            timestamp=t_buf,
-        )
+        # fields are decoded when used, most samples only feed the energy meters
+        return LazyBmsSample(buf, layout, fields, timestamp=t_buf,
+                             switches={k: bool(s) for k, s in switches.items()})
 
     async def fetch(self, wait=True) -> BmsSample:
 
@@ -254,6 +271,12 @@ class JKBt(BtBms):
         if 0x01 not in self._resp_table:
             await self._q(cmd=0x96, resp=0x01)  # query settings
 
+        await self._detect_frame_version()
+
+        buf, t_buf = self._resp_table[0x02]
+        return self._decode_sample(buf, t_buf)
+
+    async def _detect_frame_version(self):
         if self.is_new_11fw_32s is None:
             di = None
             try:
@@ -261,14 +284,26 @@ class JKBt(BtBms):
                 self.is_new_11fw_32s = int(di.sw_version.split('.')[0]) >= 11
                 self.logger.info('%s SW ver %s detected frame ver: %s', self,di.sw_version,
                                  "32s (fw>=11)" if self.is_new_11fw_32s else "24s (fw<11)")
+                self.remember_gatt(di.sw_version, frame_32s=self.is_new_11fw_32s)
             except Exception as e:
                 self.logger.info("Unrecognized SW version %s", di)
 
-        buf, t_buf = self._resp_table[0x02]
-        return self._decode_sample(buf, t_buf)
-
     async def subscribe(self, callback: Callable[[BmsSample], None]):
-        self._callbacks[0x02].append(lambda buf: callback(self._decode_sample(buf, t_buf=time.time())))
+        await self._detect_frame_version()
+
+        def _on_frame(buf):
+            if 0x01 not in self._resp_table:
+                # settings (switch states) invalidated by set_switch, wait for the next 0x01 frame
+                return
+            callback(self._decode_sample(buf, t_buf=time.time()))
+
+        self._subscriptions[callback] = _on_frame
+        self._callbacks[0x02].append(_on_frame)
+
+    async def unsubscribe(self, callback: Callable[[BmsSample], None]):
+        cb = self._subscriptions.pop(callback, None)
+        if cb in self._callbacks[0x02]:
+            self._callbacks[0x02].remove(cb)
 
     async def fetch_voltages(self):
         """
@@ -277,9 +312,7 @@ class JKBt(BtBms):
         if self.num_cells is None:
             raise Exception("num_cells not set")
         buf, t_buf = self._resp_table[0x02]
-        voltages = [int.from_bytes(buf[(6 + i * 2):(6 + i * 2 + 2)], byteorder='little') for i in
-                    range(self.num_cells)]
-        return voltages
+        return unpack_array(buf, 6, self.num_cells, 'H', '<')
 
     async def set_switch(self, switch: str, state: bool):
         # from https://github.com/syssi/esphome-jk-bms/blob/4079c22eaa40786ffa0cabd45d0d98326a1fdd29/components/jk_bms_ble/switch/__init__.py
@@ -292,6 +325,9 @@ class JKBt(BtBms):
         await asyncio.sleep(.2)  # wait a bit before triggering settings fetch
         self._resp_table.pop(0x01, None)  # invalidate settings frame which stores switch states
         # await asyncio.sleep(0.2)  # not sure if this is needed
+        if self._subscriptions:
+            # there might be no fetch() call re-querying settings when samples are pushed
+            await self._q(cmd=0x96, resp=0x01)
 
     def debug_data(self):
         return dict(resp=self._resp_table, char_w=self.char_handle_write, char_r=self.char_handle_notify)
@@ -23,8 +23,9 @@ import struct
 import statistics
 
 from bmslib import FuturesPool
-from bmslib.bms import BmsSample
+from bmslib.bms import BmsSample, QueryCache
 from bmslib.bt import BtBms
+from bmslib.frame import FrameAssembler
 
 
 def get_str(ubit, uuid):
@@ -83,24 +84,25 @@ class SokBt(BtBms):
     UUID_RX = '0000ffe1-0000-1000-8000-00805f9b34fb'
     UUID_TX = '0000ffe2-0000-1000-8000-00805f9b34fb'
     TIMEOUT = 10
+    FETCH_INTERVALS = dict(voltages=10)  # cell voltages are a separate query
+    # 0xC2 also carries the cell voltages the sample voltage is computed from, re-read it every sample
+    QUERY_LIFETIMES = {0xC0: QueryCache.STATIC}  # name
+    # response framing, see FrameAssembler
+    FRAMING = dict(trailer=b'w')
 
     def __init__(self, address, **kwargs):
         super().__init__(address, **kwargs)
-        self._buffer = bytearray()
+        self._frames = FrameAssembler(self._on_frame, logger=self.logger, **self.FRAMING)
         self._fetch_futures = FuturesPool()
         self._switches = None
 
     def _notification_handler(self, sender, data):
         self.logger.debug("ble data frame %s", data)
-        self._buffer += data
+        self._frames.feed(data)
 
-        if self._buffer.endswith(b'w'):
-            command = self._buffer[1]
-            buf = self._buffer[:]
-            self._buffer.clear()
-
-            # print(command, 'buffer endswith w', self._buffer)
-            self._fetch_futures.set_result(command, buf)
+    def _on_frame(self, frame: memoryview):
+        buf = bytearray(frame)
+        self._fetch_futures.set_result(buf[1], buf)
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
@@ -112,13 +114,14 @@ class SokBt(BtBms):
         await super().disconnect()
 
     async def _q(self, cmd):
-        with self._fetch_futures.acquire(cmd):
-            await self.client.write_gatt_char(self.UUID_TX, data=_sok_command(cmd))
-            return await self._fetch_futures.wait_for(cmd, self.TIMEOUT)
+        return await self._fetch_futures.request(
+            cmd, lambda: self.client.write_gatt_char(self.UUID_TX, data=_sok_command(cmd)), self.TIMEOUT)
 
     async def fetch(self) -> BmsSample:
+        info, name, detail = await self._q_batch_cached(
+            [(c, _sok_command(c)) for c in (0xC1, 0xC0, 0xC2)], self.UUID_TX)
 
-        buf = await self._q(cmd=0xC1)  # info
+        buf = info
         logging.debug(f'SOK: Received [{bytes(buf).hex().upper()}]')
         # this is not accurate, find out why
         # self.volts = (getLeInt3(value, 2) * 4) / 1000**2
@@ -128,7 +131,7 @@ class SokBt(BtBms):
         # ema = getLeInt3(buf, 8) / 1000 # not sure what this is
         current = getLeInt3(buf, 11) / 1000
 
-        buf = await self._q(cmd=0xC0)  # name
+        buf = name
         logging.debug(f'SOK: Received [{bytes(buf).hex().upper()}]')
         # name = bytes(buf[2:10]).decode('utf-8').rstrip()
 
@@ -136,14 +139,13 @@ class SokBt(BtBms):
         # logging.debug(f'SOK: Received [{bytes(buf).hex().upper()}]')
         # temp = getLeShort(buf, 5)
 
-        buf = await self._q(cmd=0xC2)  # year, mv, hot
+        buf = detail  # year, mv, hot
         logging.debug(f'SOK: Received [{bytes(buf).hex().upper()}]')
         # year = 2000 + buf[2]
         rated = getBeUint3(buf, 5) / 128
         # heater_on = getLeUShort(buf,8)
 
-        buf = await self._q(cmd=0xC2)  # detail
-        logging.debug(f'SOK: Received [{bytes(buf).hex().upper()}]')
+        # detail, the same response
         cells = [0, 0, 0, 0]
         for x in range(0, 4):
             cell = buf[2+(x*4)]
@@ -9,23 +9,66 @@ References
 
 """
 import asyncio
+import binascii
 import sys
 import time
 
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms, enumerate_services
+from bmslib.frame import FrameAssembler
+from bmslib.layout import Field, Layout, unpack_array
+
+# frames are ASCII hex between ':' and '~', offsets below are into the decoded bytes
+
+# realtime data, 128 chars
+REALTIME_LAYOUT = Layout('>', [
+    Field('bus_address', 0, 'B'),
+    Field('command', 1, 'B'),
+    Field('version', 2, 'B'),
+    Field('length', 3, 'H'),
+    # 5: date (7 bytes), 12: 16 cell voltages (uint16 mV)
+    Field('chargingA', 44, 'H', .01),
+    Field('dischargingA', 46, 'H', .01),
+    Field('temp0', 48, 'B', bias=-40),
+    Field('temp1', 49, 'B', bias=-40),
+    Field('temp2', 50, 'B', bias=-40),
+    Field('temp3', 51, 'B', bias=-40),
+    Field('workingState', 52, 'H'),
+    Field('alarm', 54, 'B'),
+    Field('balanceState', 55, 'H'),
+    Field('dischargeNumber', 57, 'H'),
+    Field('chargeNumber', 59, 'H'),
+    Field('soc', 61, 'B'),
+    # 62: end code
+])
+
+# capacity, 30 chars
+CAPACITY_LAYOUT = Layout('>', [
+    Field('bus_address', 0, 'B'),
+    Field('command', 1, 'B'),
+    Field('version', 2, 'B'),
+    Field('length', 3, 'H'),
+    # 5: reserved (2 bytes)
+    Field('remainingAh', 7, 'H', .1),
+    Field('completeAh', 9, 'H', .1),
+    Field('designedAh', 11, 'H', .1),
+    # 13: end code
+])
 
 
 class SuperVoltBt(BtBms):
     TIMEOUT = 8
+    # response framing, see FrameAssembler
+    FRAMING = dict(header=b':', trailer=b'~')
 
     def __init__(self, address, **kwargs):
         self.UUID_RX = ''
         self.UUID_TX = ''
         super().__init__(address, **kwargs)
-        self.notificationReceived = False
+        self._notification = asyncio.Event()
 
         self.data = None
+        self._frames = FrameAssembler(self._on_frame, logger=self.logger, **self.FRAMING)
         self._switches = None
 
         self.num_cell = 4
@@ -36,6 +79,7 @@ class SuperVoltBt(BtBms):
         self.soc = None
         self.workingState = 0  # https://github.com/fl4p/batmon-ha/issues/226
         self.alarm = None
+        self.balanceState = None
         self.chargingA = None
         self.dischargingA = None
         self.loadA = None
@@ -45,6 +89,7 @@ class SuperVoltBt(BtBms):
         self.designedAh = None
         self.dischargeNumber = None
         self.chargeNumber = None
+        self.frame_header = None  # bus_address, command, version, length of the last frame
 
     def _notification_handler(self, sender, data):
         """
@@ -55,26 +100,24 @@ class SuperVoltBt(BtBms):
         if self.verbose_log:
             self.logger.info("notification: {} {}".format(data.hex(), sender))
         if data is not None:
-            # ':' is the start of a new data set
-            if data[0] == ord(':'):
-                self.data = data
-            else:
-                self.data += data
-            # Check if self.data is complete, it should start with ':' and end with '~'
-            if self.data[0] == ord(':') and data[-1] == ord('~'):
-                self.parseData(self.data)
-                self.lastUpdatetime = time.time()
-                self.notificationReceived = True
+            # a data set starts with ':' and ends with '~'
+            self._frames.feed(data)
         else:
             self.data = None
-            self.notificationReceived = True
+            self._notification.set()
+
+    def _on_frame(self, frame: memoryview):
+        self.data = bytes(frame)
+        self.parseData(self.data)
+        self.lastUpdatetime = time.time()
+        self._notification.set()
 
     async def waitForNotification(self, timeS: float) -> bool:
-        start = time.time()
-        await asyncio.sleep(0.1)
-        while (time.time() - start < timeS and not self.notificationReceived):
-            await asyncio.sleep(0.1)
-        return self.notificationReceived
+        try:
+            await asyncio.wait_for(self._notification.wait(), timeS)
+        except asyncio.TimeoutError:
+            pass
+        return self._notification.is_set()
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
@@ -86,12 +129,18 @@ class SuperVoltBt(BtBms):
             '0000ff02-0000-1000-8000-00805f9b34fb': '0000ff01-0000-1000-8000-00805f9b34fb',  # new
         }
 
+        # try the characteristics that worked last time first
+        cached = self.gatt_cache().get('rx_tx')
+        if cached and rxtx_uuids.get(cached[0]) == cached[1]:
+            rxtx_uuids = {cached[0]: cached[1], **rxtx_uuids}
+
         for rx, tx in rxtx_uuids.items():
             try:
                 await self.client.write_gatt_char(char_specifier=tx, data=bytearray(b""))
                 await self.start_notify(rx, self._notification_handler)
                 self.UUID_RX = rx
                 self.UUID_TX = tx
+                self.remember_gatt(rx_tx=[rx, tx])
                 break
             except Exception as e:
                 self.logger.info('tried char rx/tx=%r/%r, err %s', rx, tx, e)
@@ -134,9 +183,11 @@ class SuperVoltBt(BtBms):
 
     async def requestData(self):
         try:
+            self._notification.clear()
             await self.requestRealtimeData()
             await self.waitForNotification(10.0)
 
+            self._notification.clear()
             await self.requestCapacity()
             await self.waitForNotification(10.0)
         except:
@@ -144,203 +195,60 @@ class SuperVoltBt(BtBms):
 
     # try to read values from data
     def parseData(self, data):
-        if self.verbose_log:
-            self.logger.debug("parseData: {}".format(len(data)))
+        if not data:
+            self.logger.debug("no data")
+            return
+
+        frame_type = FRAME_TYPES.get(len(data))
+        if not frame_type:
+            self.logger.warning("wrong length: %d", len(data))
+            return
+
+        layout, handler = frame_type
         try:
-            if data:
-                if len(data) == 128:
-                    if self.verbose_log:
-                        self.logger.info("parse Realtimedata: {}".format(type(data)))
-                    if type(data) is bytearray:
-                        data = bytes(data)
-                    if type(data) is bytes:
-                        # print("bytes")
-
-                        start = 1
-                        end = start + 2
-                        self.address = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("address: " + str(self.address))
-
-                        start = end
-                        end = start + 2
-                        self.command = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("command: " + str(self.command))
-
-                        start = end
-                        end = start + 2
-                        self.version = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("version: " + str(self.version))
-
-                        start = end
-                        end = start + 4
-                        self.length = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("length: " + str(self.length))
-
-                        start = end
-                        end = start + 14
-                        bdate = data[start: end]
-                        if self.verbose_log:
-                            self.logger.debug("date: " + str(bdate))
-
-                        start = end
-                        end = start + 16 * 4
-                        bvoltarray = data[start: end]
-                        # print("voltarray: " + str(bvoltarray))
-                        self.totalV = 0
-                        for i in range(0, 11):
-                            bvolt = data[(start + i * 4): (start + i * 4 + 4)]
-                            self.cellV[i] = int(bvolt.decode(), 16)
-                            self.totalV += self.cellV[i] * 1e-3
-                            if self.verbose_log:
-                                self.logger.debug(
-                                    "volt" + str(i) + ": " + str(bvolt) + " / " + str(self.cellV[i]) + "V")
-
-                        if self.verbose_log:
-                            self.logger.debug("totalVolt: " + str(self.totalV))
-
-                        start = end
-                        end = start + 4
-                        bcharging = data[start: end]
-                        self.chargingA = int(bcharging.decode(), 16) / 100.0
-                        if self.verbose_log:
-                            self.logger.debug("charging: " + str(bcharging) + " / " + str(self.chargingA) + "A")
-                        if self.chargingA > 500:
-                            # problem with supervolt
-                            self.logger.info("charging too big: {}".format(self.chargingA))
-                            self.chargingA = 0.0
-
-                        start = end
-                        end = start + 4
-                        bdischarging = data[start: end]
-                        self.dischargingA = int(bdischarging.decode(), 16) / 100.0
-                        if self.verbose_log:
-                            self.logger.debug(
-                                "discharging: " + str(bdischarging) + " / " + str(self.dischargingA) + "A")
-                        if self.dischargingA > 500:
-                            # problem with supervolt
-                            self.logger.info("discharging too big: {}".format(self.dischargingA))
-                            self.dischargingA = 0.0
-
-                        self.loadA = -self.chargingA + self.dischargingA
-                        if self.verbose_log:
-                            self.logger.debug("loadA:" + str(self.loadA) + "A")
-
-                        for i in range(0, 4):
-                            start = end
-                            end = start + 2
-                            btemp = data[start: end]
-                            self.tempC[i] = int(btemp.decode(), 16) - 40
-                            if self.verbose_log:
-                                self.logger.debug(
-                                    "temp" + str(i) + ": " + str(btemp) + " / " + str(self.tempC[i]) + "°C")
-
-                        start = end
-                        end = start + 4
-                        self.workingState = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("workingstate: " + str(self.workingState) + " / " + str(data[start: end])
-                                              + " / " + self.getWorkingStateTextShort() + " / " + self.getWorkingStateText())
-
-                        start = end
-                        end = start + 2
-                        self.alarm = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("alarm: " + str(self.alarm))
-
-                        start = end
-                        end = start + 4
-                        self.balanceState = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("balanceState: " + str(self.balanceState))
-
-                        start = end
-                        end = start + 4
-                        self.dischargeNumber = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("dischargeNumber: " + str(self.dischargeNumber))
-
-                        start = end
-                        end = start + 4
-                        self.chargeNumber = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("chargeNumber: " + str(self.chargeNumber))
-
-                        # State of Charge (%)
-                        start = end
-                        end = start + 2
-                        self.soc = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("soc: " + str(self.soc))
-                            self.logger.info("end of parse realtimedata")
-                            self.logger.debug("end code:" + str(int(data[end:128 - 1].decode(), 16)))
-
-                    else:
-                        self.logger.warning("no bytes")
-                elif len(data) == 30:
-                    if self.verbose_log:
-                        self.logger.debug("capacity")
-                    if type(data) is bytearray:
-                        data = bytes(data)
-                    if type(data) is bytes:
-                        start = 1
-                        end = start + 2
-                        self.address = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("address: " + str(self.address))
-
-                        start = end
-                        end = start + 2
-                        self.command = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("command: " + str(self.command))
-
-                        start = end
-                        end = start + 2
-                        self.version = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("version: " + str(self.version))
-
-                        start = end
-                        end = start + 4
-                        self.length = int(data[start: end].decode(), 16)
-                        if self.verbose_log:
-                            self.logger.debug("length: " + str(self.length))
-
-                        start = end
-                        end = start + 4
-                        breseved = data[start: end]
-                        if self.verbose_log:
-                            self.logger.debug("reseved: " + str(breseved))
-
-                        start = end
-                        end = start + 4
-                        self.remainingAh = int(data[start: end].decode(), 16) / 10.0
-                        if self.verbose_log:
-                            self.logger.debug("remainingAh: " + str(self.remainingAh) + " / " + str(data[start: end]))
-
-                        start = end
-                        end = start + 4
-                        self.completeAh = int(data[start: end].decode(), 16) / 10.0
-                        if self.verbose_log:
-                            self.logger.debug("completeAh: " + str(self.completeAh))
-
-                        start = end
-                        end = start + 4
-                        self.designedAh = int(data[start: end].decode(), 16) / 10.0
-                        if self.verbose_log:
-                            self.logger.debug("designedAh: " + str(self.designedAh))
-                            self.logger.info("end of parse capacity")
-                            self.logger.debug("end code:" + str(int(data[end:30 - 1].decode(), 16)))
-                else:
-                    self.logger.warning("wrong length: " + str(len(data)))
-            else:
-                self.logger.debug("no data")
-        except:
+            payload = binascii.unhexlify(data[1:-1])
+            values = layout.unpack(payload)
+            handler(self, values, payload)
+        except Exception:
             self.logger.error(sys.exc_info(), exc_info=True)
+            return
+
+        if self.verbose_log:
+            self.logger.debug("parseData(%d): %s", len(data), values)
+
+    def _on_header(self, values: dict):
+        self.frame_header = {k: values[k] for k in ('bus_address', 'command', 'version', 'length')}
+
+    def _on_realtime(self, values: dict, payload: bytes):
+        self._on_header(values)
+        self.tempC = [values['temp%d' % i] for i in range(4)]
+        self.workingState = values['workingState']
+        self.alarm = values['alarm']
+        self.balanceState = values['balanceState']
+        self.dischargeNumber = values['dischargeNumber']
+        self.chargeNumber = values['chargeNumber']
+        self.soc = values['soc']
+
+        self.cellV = unpack_array(payload, 12, 16, 'H', '>')
+        self.totalV = sum(self.cellV[:11]) * 1e-3
+
+        self.chargingA = values['chargingA']
+        self.dischargingA = values['dischargingA']
+        if self.chargingA > 500:
+            # problem with supervolt
+            self.logger.info("charging too big: {}".format(self.chargingA))
+            self.chargingA = 0.0
+        if self.dischargingA > 500:
+            # problem with supervolt
+            self.logger.info("discharging too big: {}".format(self.dischargingA))
+            self.dischargingA = 0.0
+        self.loadA = -self.chargingA + self.dischargingA
+
+    def _on_capacity(self, values: dict, payload: bytes):
+        self._on_header(values)
+        self.remainingAh = values['remainingAh']
+        self.completeAh = values['completeAh']
+        self.designedAh = values['designedAh']
 
     def getWorkingStateTextShort(self):
         if self.workingState is None:
@@ -479,6 +387,12 @@ class SuperVoltBt(BtBms):
 #        self.logger.info("send switch msg: %s", data)
 #        await self.client.write_gatt_char(self.UUID_TX, data=data)
 
+FRAME_TYPES = {
+    128: (REALTIME_LAYOUT.compile(), SuperVoltBt._on_realtime),
+    30: (CAPACITY_LAYOUT.compile(), SuperVoltBt._on_capacity),
+}
+
+
 class SuperVoltBt2(SuperVoltBt):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1,16 +1,21 @@
 """
  https://community.victronenergy.com/questions/93919/victron-bluetooth-ble-protocol-publication.html
  https://github.com/Fabian-Schmidt/esphome-victron_ble
+
+Instant readout (advertisements):
+ https://community.victronenergy.com/questions/187303/victron-bluetooth-advertising-protocol.html
+ https://github.com/keshavdv/victron-ble
 """
 import asyncio
 import math
 import sys
 import time
 from functools import partial
-from typing import Optional
+from typing import Optional, Tuple, List, Callable
 
 from bmslib.bms import BmsSample, DeviceInfo
 from bmslib.bt import BtBms
+from bmslib.scanner import get_scanner, Advertisement
 
 VICTRON_CHARACTERISTICS = {
     "charge": dict(  # consumed Ah
@@ -49,10 +54,13 @@ def parse_value(data, char):
 
 class SmartShuntBt(BtBms):
     TIMEOUT = 8
+    STALE_AFTER = 10  # seconds without notification until the health monitor checks a value
+    EXPIRE_AFTER = 60  # fetch() fails if no value was updated for this many seconds
 
     def __init__(self, address, **kwargs):
         super().__init__(address, _uses_pin=True, **kwargs)
         self._keep_alive_task: Optional[asyncio.Task] = None
+        self._health_task: Optional[asyncio.Task] = None
         self._values = {}
         self._values_t = {k: 0 for k in VICTRON_CHARACTERISTICS.keys()}
 
@@ -67,28 +75,67 @@ class SmartShuntBt(BtBms):
                 self.logger.warning('error sending keep alive %s', data , exc_info=1)
             await asyncio.sleep(interval / 1000 / 2)
 
-    async def _fetch_value(self, key: str, reload_services=False):
-        if reload_services:
-            await self.client.get_services()
-        char = VICTRON_CHARACTERISTICS[key]
-        data = await asyncio.wait_for(self.client.read_gatt_char(char['uuid']), timeout=self.TIMEOUT)
-        return parse_value(data, char)
+    async def _health_loop(self):
+        while self.is_connected:
+            await asyncio.sleep(self.STALE_AFTER / 2)
+            try:
+                await self._check_health()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.warning('%s health check failed: %s', self.name, str(e) or type(e))
 
-    async def _subscribe(self, key: str, val=None):
-        char = VICTRON_CHARACTERISTICS[key]
-        self._values[key] = val or await self._fetch_value(key)
-        self._values_t[key] = time.time()
-        await self.start_notify(char['uuid'], partial(self._handle_notification, key))
+    async def _check_health(self):
+        """
+        Find characteristics without notifications for STALE_AFTER seconds, read them and re-subscribe those whose
+        value changed meanwhile (a stalled notification stream). Services are refreshed once for all of them.
+        """
+        t_expire = time.time() - self.STALE_AFTER
+        stale = [k for k, t in self._values_t.items() if t < t_expire and not math.isnan(self._values.get(k, 0))]
+        if not stale:
+            return
+
+        await self.client.get_services()
+        values = await self._fetch_values(stale)
+
+        changed = {k: v for k, v in values.items() if v != self._values.get(k)}
+        t_now = time.time()
+        for k in stale:
+            if k not in changed:
+                self._values_t[k] = t_now  # value steady, the stream is alive
+        if changed:
+            self.logger.warning('values %s expired, re-sub', ', '.join(changed))
+            await self._subscribe(changed)
+
+    async def _fetch_values(self, keys: List[str]) -> dict:
+        """ read characteristics concurrently """
+
+        async def read(key):
+            char = VICTRON_CHARACTERISTICS[key]
+            data = await asyncio.wait_for(self.client.read_gatt_char(char['uuid']), timeout=self.TIMEOUT)
+            return parse_value(data, char)
+
+        return dict(zip(keys, await asyncio.gather(*map(read, keys))))
+
+    async def _subscribe(self, values: dict):
+        t_now = time.time()
+        for k, val in values.items():
+            self._values[k] = val
+            self._values_t[k] = t_now
+        # one after another, BlueZ fails concurrent StartNotify calls ("Operation already in progress")
+        for k in values:
+            await self.start_notify(VICTRON_CHARACTERISTICS[k]['uuid'], partial(self._handle_notification, k))
 
     async def connect(self, timeout=8):
         await super().connect(timeout=timeout)
         self._keep_alive_task = asyncio.create_task(self._keep_alive_loop())
-        for k, char in VICTRON_CHARACTERISTICS.items():
-            await self._subscribe(k)
+        await self._subscribe(await self._fetch_values(list(VICTRON_CHARACTERISTICS.keys())))
+        self._health_task = asyncio.create_task(self._health_loop())
 
     async def disconnect(self):
-        if self._keep_alive_task and not self._keep_alive_task.done():
-            self._keep_alive_task.cancel()
+        for task in (self._keep_alive_task, self._health_task):
+            if task and not task.done():
+                task.cancel()
         for k, char in VICTRON_CHARACTERISTICS.items():
             try:
                 await self.client.stop_notify(char['uuid'])
@@ -103,17 +150,12 @@ class SmartShuntBt(BtBms):
         self.logger.debug('msg %s %s', key, val)
 
     async def fetch(self) -> BmsSample:
-
-        t_expire = time.time() - 10
-        for k, t in self._values_t.items():
-            if t < t_expire and not math.isnan(self._values.get(k, 0)):
-                # check if value actually changed before re-subscription
-                val = await self._fetch_value(k, reload_services=True)
-                if val != self._values.get(k):
-                    self.logger.warning('value for %s expired %s, re-sub', k, t)
-                    await self._subscribe(k, val)
+        # notifications keep the values up to date, stalled ones are handled by _health_loop()
         values = self._values
-        sample = BmsSample(**values, timestamp=max(v for k, v in self._values_t.items() if not math.isnan(values[k])))
+        t_last = max((t for k, t in self._values_t.items() if not math.isnan(values.get(k, math.nan))), default=0)
+        if time.time() - t_last > self.EXPIRE_AFTER:
+            raise TimeoutError('%s no value updates for %.0fs' % (self.name, time.time() - t_last))
+        sample = BmsSample(**values, timestamp=t_last)
         return sample
 
     async def fetch_voltages(self):
@@ -134,6 +176,156 @@ class SmartShuntBt(BtBms):
         return dev
 
 
+VICTRON_MANUFACTURER_ID = 0x02E1
+RECORD_BATTERY_MONITOR = 0x02
+
+AUX_MODE_TEMPERATURE = 2
+
+
+def decrypt_advertisement(data: bytes, key: bytes) -> Tuple[int, int, bytes]:
+    """
+    Decrypt an instant readout advertisement (Victron manufacturer data).
+    Requires the `cryptography` package.
+    :return: model id, record type, decrypted payload
+    """
+    if len(data) < 9 or data[0] != 0x10:
+        raise ValueError('not an instant readout advertisement')
+    model_id = int.from_bytes(data[2:4], 'little')
+    record_type = data[4]
+    iv = int.from_bytes(data[5:7], 'little')
+    if data[7] != key[0]:
+        raise ValueError('advertisement key mismatch (expected key starting with %02x)' % data[7])
+
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    decryptor = Cipher(algorithms.AES(key), modes.CTR(iv.to_bytes(16, 'little'))).decryptor()
+    return model_id, record_type, decryptor.update(bytes(data[8:])) + decryptor.finalize()
+
+
+def parse_battery_monitor(payload: bytes) -> dict:
+    """
+    Parse a decrypted battery monitor record (SmartShunt, BMV).
+    Current is positive when discharging, `charge` is the consumed Ah (negative) as with SmartShuntBt.
+    """
+
+    def na(value, na_value, scale):
+        return math.nan if value == na_value else value * scale
+
+    payload = bytes(payload).ljust(16, b'\0')
+    bits = int.from_bytes(payload[8:16], 'little')  # aux mode:2, current:22, consumed Ah:20, soc:10
+    current = (bits >> 2) & 0x3FFFFF
+    current -= (current & 0x200000) << 1  # 22-bit two's complement
+    aux_mode = bits & 0x3
+    aux = int.from_bytes(payload[6:8], 'little')
+
+    return dict(
+        voltage=na(int.from_bytes(payload[2:4], 'little', signed=True), 0x7FFF, .01),
+        current=-na(current, 0x1FFFFF, .001),
+        charge=-na((bits >> 24) & 0xFFFFF, 0xFFFFF, .1),
+        soc=na((bits >> 44) & 0x3FF, 0x3FF, .1),
+        temperatures=[round(aux * .01 - 273.15, 2)] if aux_mode == AUX_MODE_TEMPERATURE else [],
+        remaining_mins=na(int.from_bytes(payload[0:2], 'little'), 0xFFFF, 1),
+    )
+
+
+class SmartShuntAdvBt(BtBms):
+    """
+    Reads a Victron battery monitor from its instant readout advertisements, without connecting.
+    Enable instant readout in VictronConnect and set the device's encryption key as `key`.
+    """
+    SUPPORTS_PUSH = True
+    PASSIVE = True
+
+    TIMEOUT = 10  # the device advertises about once per second
+
+    def __init__(self, address, key: str = None, **kwargs):
+        super().__init__(address, **kwargs)
+        if not key or len(bytes.fromhex(key)) != 16:
+            raise ValueError('%s needs the 32 digit hex advertisement encryption `key`' % address)
+        self._key = bytes.fromhex(key)
+        self._listening = False
+        self._model_id = None
+        self._sample: Optional[BmsSample] = None
+        self._t_fetched = 0.
+        self._new_sample = asyncio.Event()
+        self._callbacks: List[Callable[[BmsSample], None]] = []
+
+        try:
+            import cryptography
+        except ImportError:
+            self.logger.error('%s needs the `cryptography` package to decrypt advertisements', self.name)
+
+    @property
+    def is_connected(self):
+        return self._listening
+
+    def _on_advertisement(self, adv: Advertisement):
+        data = adv.adv.manufacturer_data.get(VICTRON_MANUFACTURER_ID)
+        if not data:
+            return
+        try:
+            self._model_id, record_type, payload = decrypt_advertisement(data, self._key)
+        except ValueError as e:
+            self.logger.debug('%s %s', self.name, e)
+            return
+        if record_type != RECORD_BATTERY_MONITOR:
+            self.logger.debug('%s unsupported record type %02x', self.name, record_type)
+            return
+
+        values = parse_battery_monitor(payload)
+        del values['remaining_mins']
+        self._sample = BmsSample(**values, timestamp=adv.t_seen)
+        self._new_sample.set()
+        for callback in self._callbacks:
+            callback(self._sample)
+
+    async def connect(self, timeout=20):
+        if BtBms.shutdown:
+            raise RuntimeError("in shutdown")
+        self._new_sample.clear()
+        await get_scanner(self._adapter).add_listener(self.address, self._on_advertisement)
+        self._listening = True
+        try:
+            await asyncio.wait_for(self._new_sample.wait(), timeout)
+        except asyncio.TimeoutError:
+            await self.disconnect()
+            raise TimeoutError('no instant readout advertisement from %s within %ds' % (self.name, timeout))
+        self._connect_time = time.time()
+
+    async def disconnect(self):
+        get_scanner(self._adapter).remove_listener(self.address, self._on_advertisement)
+        self._listening = False
+
+    async def subscribe(self, callback: Callable[[BmsSample], None]):
+        self._callbacks.append(callback)
+
+    async def unsubscribe(self, callback: Callable[[BmsSample], None]):
+        self._callbacks.remove(callback)
+
+    async def fetch(self) -> BmsSample:
+        # wait for an advertisement newer than the last sample returned
+        if not self._sample or self._sample.timestamp <= self._t_fetched:
+            self._new_sample.clear()
+            await asyncio.wait_for(self._new_sample.wait(), self.TIMEOUT)
+        self._t_fetched = self._sample.timestamp
+        return self._sample
+
+    async def fetch_voltages(self):
+        return []
+
+    async def fetch_temperatures(self):
+        return self._sample.temperatures if self._sample else []
+
+    async def fetch_device_info(self) -> DeviceInfo:
+        return DeviceInfo(
+            mnf="Victron",
+            model='%04X' % self._model_id if self._model_id is not None else None,
+            hw_version=None,
+            sw_version=None,
+            name=None,
+            sn=None,
+        )
+
+
 async def main():
     # raise NotImplementedError()
     v = SmartShuntBt(address='8B133977-182C-62EE-8E81-41FF77969EE9', name='test')
@@ -0,0 +1,295 @@
+"""
+Record and replay the bluetooth traffic of a BMS.
+
+RecordingClient wraps a BleakClient and writes the GATT services, every write, read and notification (with
+timestamps) to a capture file, one JSON object per line (gzip compressed if the file name ends with `.gz`):
+
+    {"address": "C8:47:8C:..", "t0": 1700000000.0, "services": [{"uuid": .., "characteristics": [..]}]}
+    {"t": 0.312, "w": "0000ffe1-0000-1000-8000-00805f9b34fb", "d": "aa5590eb97..."}
+    {"t": 0.402, "n": "0000ffe1-0000-1000-8000-00805f9b34fb", "d": "55aaeb9003..."}
+
+ReplayClient serves a capture back in place of a BleakClient, so the BtBms code paths run unchanged without bluetooth
+hardware. Each write is matched with the next recorded write of the same data, then the notifications that followed
+it in the recording are sent at recorded pace (divided by `speed`). Notifications after the last write (a BMS that
+streams its data, like JK) repeat in a loop. Reads return the recorded values of the characteristic in turn.
+
+Device config (see construct_bms):
+
+    capture: /data/capture_jk.jsonl.gz  # record the traffic of a real device
+    replay: /data/capture_jk.jsonl.gz   # serve a capture instead of connecting
+    replay_speed: 10                    # optional, 0 sends without delay
+"""
+import asyncio
+import functools
+import gzip
+import json
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from bmslib.util import dotdict, get_logger
+
+logger = get_logger()
+
+Event = Tuple[float, str, Union[str, int], bytes]  # time, 'w'rite/'r'ead/'n'otification, characteristic, data
+
+
+def _open(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+def _char_key(char) -> Union[str, int]:
+    """ characteristic uuid (or handle), as recorded """
+    if isinstance(char, int):
+        return char
+    return str(getattr(char, 'uuid', char)).lower()
+
+
+@functools.lru_cache(maxsize=16)
+def load_capture(path: str) -> Tuple[dict, List[Event]]:
+    """
+    Loaded once per file, replay clients share the (read-only) result.
+    :return: capture header (address, t0, services) and list of events
+    """
+    events = []
+    with _open(path, 'r') as f:
+        header = json.loads(f.readline())
+        try:
+            for line in f:
+                e = json.loads(line)
+                kind = next(k for k in 'wrn' if k in e)
+                events.append((e['t'], kind, e[kind], bytes.fromhex(e['d'])))
+        except (EOFError, json.JSONDecodeError) as e:
+            # recording still running or killed, the last connection is incomplete
+            logger.warning('capture %s truncated after %d events: %s', path, len(events), e)
+    return header, events
+
+
+def write_capture(path: str, header: dict, events: List[Event]):
+    """ write a capture file, e.g. of traffic imported from another tool """
+    with _open(path, 'w') as f:
+        f.write(json.dumps(header) + '\n')
+        for t, kind, char, data in events:
+            f.write(json.dumps({'t': round(t, 4), kind: char, 'd': data.hex()}) + '\n')
+
+
+class CaptureRecorder:
+    """
+    Writes the capture file of one device. Each connection is written (and closed) as a separate gzip member, so the
+    file stays readable while the device keeps running and after re-connects.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._t0 = 0.
+        self._lock = threading.Lock()  # notifications might arrive on another thread
+
+    def start(self, address: str, services: Callable[[], list]):
+        """ called on connect, the first connection truncates the file and writes the header """
+        with self._lock:
+            if self._file:
+                self._file.close()
+            if not self._t0:
+                self._t0 = time.time()
+                self._file = _open(self.path, 'w')
+                self._file.write(json.dumps(dict(address=address, t0=self._t0, services=services())) + '\n')
+                logger.info('recording %s to %s', address, self.path)
+            else:
+                self._file = _open(self.path, 'a')
+
+    def record(self, kind: str, char, data):
+        if not self._file:
+            return
+        line = json.dumps({'t': round(time.time() - self._t0, 4), kind: _char_key(char), 'd': bytes(data).hex()})
+        with self._lock:
+            if self._file:
+                self._file.write(line + '\n')
+
+    def finish(self):
+        """ called on disconnect and shutdown, completes the file """
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+class RecordingClient:
+    """
+    Wraps a BleakClient and records all writes and notifications. Clients that replace each other (e.g. after an
+    adapter change) share the recorder of the device.
+    """
+
+    def __init__(self, client, recorder: Union[str, CaptureRecorder]):
+        self._client = client
+        self.recorder = CaptureRecorder(recorder) if isinstance(recorder, str) else recorder
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _services(self) -> list:
+        try:
+            return [dict(uuid=s.uuid, characteristics=[
+                dict(uuid=c.uuid, handle=c.handle,
+                     properties=c.properties.split(',') if isinstance(c.properties, str) else list(c.properties))
+                for c in s.characteristics
+            ]) for s in self._client.services]
+        except Exception as e:
+            logger.warning('capture %s: services not available: %s', self.recorder.path, e)
+            return []
+
+    async def connect(self, **kwargs):
+        res = await self._client.connect(**kwargs)
+        self.recorder.start(self._client.address, self._services)
+        return res
+
+    async def disconnect(self):
+        try:
+            return await self._client.disconnect()
+        finally:
+            self.recorder.finish()
+
+    async def start_notify(self, char_specifier, callback: Callable[[int, bytearray], None], **kwargs):
+        def recording_callback(sender, data):
+            self.recorder.record('n', char_specifier, data)
+            callback(sender, data)
+
+        return await self._client.start_notify(char_specifier, recording_callback, **kwargs)
+
+    async def write_gatt_char(self, char_specifier, data, response: bool = False):
+        self.recorder.record('w', char_specifier, data)
+        return await self._client.write_gatt_char(char_specifier, data, response)
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        data = await self._client.read_gatt_char(char_specifier, **kwargs)
+        self.recorder.record('r', char_specifier, data)
+        return data
+
+    def close(self):
+        self.recorder.finish()
+
+
+class ReplayClient:
+    """
+    Serves a capture (see RecordingClient) in place of a BleakClient.
+    """
+
+    def __init__(self, path: str, address: str, disconnected_callback=None, speed: float = 1.):
+        """
+        :param speed: replay speed factor, 0 sends notifications without delay
+        """
+        self.address = address
+        self.speed = speed
+        header, self._events = load_capture(path)
+        self.services = [dotdict(uuid=s['uuid'], characteristics=[
+            dotdict(uuid=c['uuid'], handle=c['handle'], properties=c['properties'], descriptors=[])
+            for c in s['characteristics']]) for s in header.get('services', [])]
+        self._writes = [i for i, e in enumerate(self._events) if e[1] == 'w']
+        self._reads: Dict[Union[str, int], List[bytes]] = {}
+        for _, kind, char, data in self._events:
+            if kind == 'r':
+                self._reads.setdefault(char, []).append(data)
+        self._read_nr: Dict[Union[str, int], int] = {}
+        self._disconnected_callback = disconnected_callback
+        self._connected = False
+        self._callbacks: Dict[Union[str, int], Callable[[int, bytearray], None]] = {}
+        self._cursor = 0  # index of the next expected write in _writes
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    async def connect(self, timeout=20, **kwargs):
+        self._connected = True
+        self._cursor = 0
+        self._read_nr.clear()
+
+    async def disconnect(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        self._callbacks.clear()
+        if self._connected:
+            self._connected = False
+            cb = self._disconnected_callback
+            cb and cb(self)
+
+    async def pair(self, **kwargs):
+        return True
+
+    async def get_services(self):
+        return self.services
+
+    async def start_notify(self, char_specifier, callback: Callable[[int, bytearray], None], **kwargs):
+        self._callbacks[_char_key(char_specifier)] = callback
+
+    async def stop_notify(self, char_specifier):
+        self._callbacks.pop(_char_key(char_specifier), None)
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        char = _char_key(char_specifier)
+        reads = self._reads.get(char)
+        if not reads:
+            raise RuntimeError('replay %s: no recorded read of %s' % (self.address, char))
+        n = self._read_nr.get(char, 0)
+        self._read_nr[char] = n + 1
+        return bytearray(reads[n % len(reads)])
+
+    async def write_gatt_char(self, char_specifier, data, response: bool = False):
+        if not self._connected:
+            raise RuntimeError('replay client %s not connected' % self.address)
+        data = bytes(data)
+        i = self._find_write(data)
+        if i is None:
+            logger.debug('replay %s: no recorded write %s', self.address, data.hex())
+            return
+        self._tasks = [t for t in self._tasks if not t.done()]
+        self._tasks.append(asyncio.create_task(self._play(self._writes[i])))
+
+    def _find_write(self, data: bytes) -> Optional[int]:
+        n = len(self._writes)
+        for j in range(n):
+            i = (self._cursor + j) % n
+            if self._events[self._writes[i]][3] == data:
+                self._cursor = i + 1
+                return i
+        return None
+
+    async def _play(self, w: int):
+        """ send the notifications recorded after write event `w`, until the next write """
+        events = self._events
+        end = next((i for i in range(w + 1, len(events)) if events[i][1] == 'w'), len(events))
+        segment = [e for e in events[w + 1:end] if e[1] == 'n']
+        if not segment:
+            return
+
+        t_write = events[w][0]
+        loop = end == len(events)  # streaming after the last write
+        t_start = time.time()
+        t_offset = 0.
+        while True:
+            for t, _, char, data in segment:
+                if self.speed:
+                    delay = (t - t_write + t_offset) / self.speed - (time.time() - t_start)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                else:
+                    await asyncio.sleep(0)
+                if not self._connected:
+                    return
+                self._notify(char, data)
+            if not loop:
+                return
+            # next round continues after the last notification, at the pace of the recording
+            t_offset += segment[-1][0] - t_write + (segment[-1][0] - segment[-2][0] if len(segment) > 1 else 1.)
+
+    def _notify(self, char, data: bytes):
+        callback = self._callbacks.get(char)
+        if callback is None and len(self._callbacks) == 1:
+            # subscribed with another specifier (e.g. handle instead of uuid)
+            callback = next(iter(self._callbacks.values()))
+        if callback:
+            callback(char, bytearray(data))
@@ -1,6 +1,7 @@
 from collections import defaultdict
 
 import asyncio
+import contextlib
 import math
 import paho.mqtt.client
 import random
@@ -8,12 +9,11 @@ import re
 import sys
 import time
 from copy import copy
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Callable
 
 import bmslib.bt
 from bmslib.algorithm import create_algorithm, BatterySwitches
 from bmslib.bms import DeviceInfo, BmsSample, MIN_VALUE_EXPIRY
-from bmslib.cache.mem import mem_cache_deco
 from bmslib.group import BmsGroup, GroupNotReady
 from bmslib.pwmath import Integrator, DiffAbsSum, LHQ
 from bmslib.util import get_logger
@@ -53,6 +53,53 @@ class PeriodicBoolSignal:
             self.state = True
 
 
+class AdaptiveRate:
+    """
+    Backs the sample period off to `idle_period` when current and power have been flat for `idle_after` seconds.
+    Any activity (a power jump, a switch command, SoC near an algorithm threshold) snaps back to `fast_period`.
+    """
+
+    def __init__(self, fast_period, idle_period, idle_after=60 * 2, current_tol=0.5, power_tol=20, soc_margin=1.):
+        self.fast_period = fast_period
+        self.idle_period = max(idle_period, fast_period)
+        self.idle_after = idle_after
+        self.current_tol = current_tol  # A
+        self.power_tol = power_tol  # W
+        self.soc_margin = soc_margin  # %
+
+        self.period = fast_period
+        self.on_change: Optional[Callable[[float], None]] = None
+
+        self._t_active = time.time()
+        self._ref: Optional[BmsSample] = None
+
+    @property
+    def idle(self):
+        return self.period != self.fast_period
+
+    def update(self, sample: BmsSample, t_now: float, soc_thresholds=()):
+        ref = self._ref
+        if ref is None or abs(sample.current - ref.current) > self.current_tol or \
+                abs(sample.power - ref.power) > self.power_tol:
+            self._ref = sample
+            self.activity(t_now)
+        elif any(abs(sample.soc - th) <= self.soc_margin for th in soc_thresholds):
+            self.activity(t_now)
+        elif t_now - self._t_active > self.idle_after:
+            self._set_period(self.idle_period, reason='idle for %.0fs' % (t_now - self._t_active))
+
+    def activity(self, t_now: Optional[float] = None, reason=None):
+        self._t_active = t_now or time.time()
+        self._set_period(self.fast_period, reason=reason)
+
+    def _set_period(self, period, reason):
+        if period == self.period:
+            return
+        reason and logger.info('sample period %.1fs -> %.1fs (%s)', self.period, period, reason)
+        self.period = period
+        self.on_change and self.on_change(period)
+
+
 class BmsSampleSink:
     """ Interface of an arbitrary data sink of battery samples """
 
@@ -83,15 +130,21 @@ class BmsSampler:
                  algorithms: Optional[list] = None,
                  current_calibration_factor=1.0,
                  over_power=None,
-                 bms_group: Optional[BmsGroup] = None
+                 bms_group: Optional[BmsGroup] = None,
+                 push=False,
+                 adaptive_rate: Optional[AdaptiveRate] = None,
                  ):
 
         self.bms = bms
+        self.push = push  # driven by samples the BMS pushes (subscribe) instead of polling fetch()
+        self.adaptive_rate = adaptive_rate
+        self.command_slot: Optional[Callable] = None  # priority access to the bms adapter for switch commands
         self.mqtt_topic_prefix = re.sub(r'[^\w_.-/]', '_', bms.name)
         self.mqtt_client = mqtt_client
         self.invert_current = invert_current
         self.expire_after_seconds = expire_after_seconds
         self.device_info: Optional[DeviceInfo] = None
+        self._device_info_supported = True  # False if the BMS has no device info, don't ask again
         self.num_samples = 0
         self.bms_group = bms_group  # group, virtual, parent
         self.current_calibration_factor = current_calibration_factor
@@ -114,6 +167,11 @@ class BmsSampler:
         self._num_errors = 0
         self._time_next_retry = 0
 
+        # re-used between the intervals of the bms fetch plan
+        self._voltages: Optional[List[int]] = None
+        self._voltages_fresh = False  # fetched during the current sample
+        self._temperatures: Optional[List[float]] = None
+
         self.algorithm = None
         if algorithms:
             assert len(algorithms) == 1, "currently only 1 algo supported"
@@ -152,7 +210,7 @@ class BmsSampler:
         t_now = time.time()
 
         try:
-            s = await self._sample_inner()
+            s = await (self._push_inner() if self.push else self._sample_inner())
             if s:
                 self._num_errors = 0
             return s
@@ -193,12 +251,25 @@ class BmsSampler:
 
             raise
 
-    @mem_cache_deco(ttl=30)
-    async def _fetch_temperatures_cached(self):
-        try:
-            return await self.bms.fetch_temperatures()
-        except:
-            return None
+    async def _fetch_temperatures_planned(self):
+        plan = self.bms.fetch_plan
+        if plan.due('temperatures') or plan.pending('temperatures'):
+            plan.done('temperatures')
+            try:
+                self._temperatures = await self.bms.fetch_temperatures()
+            except:
+                self._temperatures = None
+        return self._temperatures
+
+    async def _fetch_voltages_planned(self):
+        plan = self.bms.fetch_plan
+        if self._voltages is None or plan.due('voltages') or plan.pending('voltages'):
+            self._voltages = await self.bms.fetch_voltages()
+            self._voltages_fresh = True
+            plan.done('voltages')
+            if self.bms_group:
+                self.bms_group.update_voltages(self.bms, self._voltages)
+        return self._voltages
 
     def _filter_temperatures(self, temperatures):
         if not temperatures or self._lhq_temp is None:
@@ -207,7 +278,6 @@ class BmsSampler:
 
     async def _sample_inner(self):
         bms = self.bms
-        mqtt_client = self.mqtt_client
 
         was_connected = bms.is_connected
 
@@ -216,8 +286,6 @@ class BmsSampler:
 
         t_conn = time.time()
 
-        err = False
-
         if not was_connected and t_conn < self._time_next_retry:
             logger.debug('retry in %.0f sec', self._time_next_retry - t_conn)
             await asyncio.sleep(4)
@@ -230,7 +298,7 @@ class BmsSampler:
             if not was_connected:
                 logger.info('connected bms %s!', bms)
 
-            if self.device_info is None and self.num_samples == 0:
+            if self._device_info_due() and self.num_samples == 0:
                 # try to fetch device info first. if bms.fetch() fails we might have at least some details
                 await self._try_fetch_device_info()
 
@@ -238,167 +306,249 @@ class BmsSampler:
 
             sample = await bms.fetch()
 
-            t_now = time.time()
-            t_hour = t_now * (1 / 3600)
+            return await self._process_sample(sample, t_conn=t_conn, t_fetch=t_fetch)
 
-            if sample.timestamp < t_now - max(self.expire_after_seconds, MIN_VALUE_EXPIRY):
-                raise SampleExpiredError("sample %s expired" % sample.timestamp)
-                # logger.warning('%s expired sample', bms.name)
-                # return
+    async def _push_inner(self):
+        """
+        Connect, subscribe to samples pushed by the BMS and process each one as it arrives.
+        Returns (or raises) when the connection drops or the stream stalls, so the caller can re-connect.
+        """
+        bms = self.bms
 
-            sample.num_samples = self.num_samples
+        if not bms.is_connected:
+            logger.info('connecting bms %s (push)', bms)
+            await bms.connect()
+            logger.info('connected bms %s!', bms)
 
-            if self.current_calibration_factor and self.current_calibration_factor != 1:
-                sample = sample.multiply_current(self.current_calibration_factor)
+        if self._device_info_due() and self.num_samples == 0:
+            await self._try_fetch_device_info()
 
-            # discharging P>0
-            self.power_integrator_charge += (t_hour, abs(min(0, sample.power)) * 1e-3)  # kWh
-            self.power_integrator_discharge += (t_hour, abs(max(0, sample.power)) * 1e-3)  # kWh
+        loop = asyncio.get_running_loop()
+        arrived = asyncio.Event()
+        latest: List[BmsSample] = []
 
-            # self.power_stats.add(sample.power)
+        def _put(s: BmsSample):
+            # only keep the most recent sample if processing falls behind
+            latest[:] = [s]
+            arrived.set()
 
-            if (self.sinks or self.bms_group) and not sample.temperatures:
-                sample.temperatures = await self._fetch_temperatures_cached()
+        def _on_sample(s: BmsSample):
+            # the notification callback might run on a foreign thread
+            loop.call_soon_threadsafe(_put, s)
 
-            sample.temperatures = self._filter_temperatures(sample.temperatures)
+        await bms.subscribe(_on_sample)
 
-            if not math.isnan(sample.mos_temperature) and self._lhq_temp is not None:
-                sample.mos_temperature = self._lhq_temp['mos'].add(sample.mos_temperature)
+        timeout = max(self.expire_after_seconds, MIN_VALUE_EXPIRY)
+        sample = None
+        try:
+            while bms.is_connected and not bmslib.bt.BtBms.shutdown:
+                try:
+                    await asyncio.wait_for(arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    await bms.disconnect()
+                    raise SampleExpiredError("no sample pushed for %.0fs" % timeout)
+                arrived.clear()
+
+                t_fetch = time.time()
+                sample = await self._process_sample(latest.pop(), t_conn=t_fetch, t_fetch=t_fetch)
+                if sample:
+                    self._num_errors = 0
+        finally:
+            await bms.unsubscribe(_on_sample)
+
+        return sample
+
+    async def _process_sample(self, sample: BmsSample, t_conn: float, t_fetch: float):
+        """
+        Update meters, run the algorithm and publish a fresh sample.
+        :param t_conn: time when connecting started
+        :param t_fetch: time when fetching the sample started
+        """
+        bms = self.bms
+        mqtt_client = self.mqtt_client
 
-            if self.bms_group:
-                # update before invert current
-                self.bms_group.update(bms, sample)
+        err = False
+        self._voltages_fresh = False
 
-            if self.invert_current:
-                sample = sample.invert_current()
+        t_now = time.time()
+        t_hour = t_now * (1 / 3600)
 
-            self.current_integrator += (t_hour, sample.current)  # Ah
-            self.power_integrator += (t_hour, sample.power * 1e-3)  # kWh
+        if sample.timestamp < t_now - max(self.expire_after_seconds, MIN_VALUE_EXPIRY):
+            raise SampleExpiredError("sample %s expired" % sample.timestamp)
+            # logger.warning('%s expired sample', bms.name)
+            # return
 
-            self.cycle_integrator += (t_hour, sample.soc * (0.01 / 2))  # SoC 100->0 is a half cycle
-            self.charge_integrator += (t_hour, sample.charge)  # Ah
+        sample.num_samples = self.num_samples
 
-            if self.algorithm:
-                res = self.algorithm.update(sample)
-                if res or self.bms.verbose_log:
-                    logger.info('Algo State=%s (bms=%s) -> %s ', self.algorithm.state,
-                                BatterySwitches(**sample.switches), res)
+        if self.current_calibration_factor and self.current_calibration_factor != 1:
+            sample = sample.multiply_current(self.current_calibration_factor)
 
-                if res:
-                    from bmslib.store import store_algorithm_state
-                    state = self.algorithm.state
-                    if state:
-                        store_algorithm_state(bms.name, algorithm_name=self.algorithm.name, state=state.__dict__)
+        # discharging P>0
+        self.power_integrator_charge += (t_hour, abs(min(0, sample.power)) * 1e-3)  # kWh
+        self.power_integrator_discharge += (t_hour, abs(max(0, sample.power)) * 1e-3)  # kWh
 
-                if res and res.switches:
-                    for swk in sample.switches.keys():
-                        if res.switches[swk] is not None:
-                            logger.info('%s algo set %s switch -> %s', bms.name, swk, res.switches[swk])
-                            await self.bms.set_switch('charge', res.switches[swk])
+        # self.power_stats.add(sample.power)
 
-            if self.num_samples == 0 and sample.switches and mqtt_client:
-                logger.info("%s subscribing for %s switch change", bms.name, sample.switches)
-                subscribe_switches(mqtt_client, device_topic=self.mqtt_topic_prefix, bms=bms,
-                                   switches=sample.switches.keys())
+        if (self.sinks or self.bms_group or bms.fetch_plan.pending('temperatures')) and not sample.temperatures:
+            sample.temperatures = await self._fetch_temperatures_planned()
 
-            for sink in self.sinks:
-                try:
-                    sink.publish_sample(bms.name, sample)
-                except:
-                    logger.error(sys.exc_info(), exc_info=True)
+        sample.temperatures = self._filter_temperatures(sample.temperatures)
 
-            self.downsampler += sample
+        if not math.isnan(sample.mos_temperature) and self._lhq_temp is not None:
+            sample.mos_temperature = self._lhq_temp['mos'].add(sample.mos_temperature)
 
-            log_data = (t_now - self._last_time_log) >= (60 if self.num_samples < 1000 else 300) or bms.verbose_log
-            if log_data:
-                self._last_time_log = t_now
+        if self.bms_group or bms.fetch_plan.pending('voltages'):
+            # the group aggregates as soon as the sample arrives, so its member voltages must be there before.
+            # take voltages the BMS read ahead with the sample, so it doesn't read them again before they are due
+            try:
+                await self._fetch_voltages_planned()
+            except Exception as e:
+                logger.debug('%s voltages: %s', bms.name, e)  # retried (and logged) below
 
-            voltages = []
+        if self.bms_group:
+            # update before invert current
+            self.bms_group.update(bms, sample)
 
-            async def cached_fetch_voltages():
-                nonlocal voltages, err
-                if voltages:
-                    return voltages
+        if self.invert_current:
+            sample = sample.invert_current()
 
-                # TODO fetch_voltages at t_fetch interval and down-sampling?
-                try:
-                    voltages = await bms.fetch_voltages()
+        self.current_integrator += (t_hour, sample.current)  # Ah
+        self.power_integrator += (t_hour, sample.power * 1e-3)  # kWh
 
-                    if self.bms_group:
-                        self.bms_group.update_voltages(bms, voltages)
-                except:
-                    logger.error("%s error fetching voltage", bms.name, exc_info=1)
-                    err = True
-                    voltages = None
+        self.cycle_integrator += (t_hour, sample.soc * (0.01 / 2))  # SoC 100->0 is a half cycle
+        self.charge_integrator += (t_hour, sample.charge)  # Ah
 
-                return voltages
+        if self.algorithm:
+            res = self.algorithm.update(sample)
+            if res or self.bms.verbose_log:
+                logger.info('Algo State=%s (bms=%s) -> %s ', self.algorithm.state,
+                            BatterySwitches(**sample.switches), res)
 
-            if self.sinks:
-                voltages = await cached_fetch_voltages()
-                for sink in self.sinks:
-                    sink.publish_voltages(bms.name, voltages)
+            if res:
+                from bmslib.store import store_algorithm_state
+                state = self.algorithm.state
+                if state:
+                    store_algorithm_state(bms.name, algorithm_name=self.algorithm.name, state=state.__dict__)
+
+            if res and res.switches:
+                for swk in sample.switches.keys():
+                    if res.switches[swk] is not None:
+                        logger.info('%s algo set %s switch -> %s', bms.name, swk, res.switches[swk])
+                        await self.bms.set_switch('charge', res.switches[swk])
+                        self._on_switch(swk, res.switches[swk])
+
+        if self.num_samples == 0 and sample.switches and mqtt_client:
+            logger.info("%s subscribing for %s switch change", bms.name, sample.switches)
+            subscribe_switches(mqtt_client, device_topic=self.mqtt_topic_prefix, bms=bms,
+                               switches=sample.switches.keys(), on_set=self._on_switch,
+                               slot=self._command_slot)
 
-            # z_score = self.power_stats.z_score(sample.power)
-            # if abs(z_score) > 12:
-            #    logger.info('%s Power z_score %.1f (avg=%.0f std=%.2f last=%.0f)', bms.name, z_score, self.power_stats.avg.value, self.power_stats.stddev, sample.power)
+        for sink in self.sinks:
+            try:
+                sink.publish_sample(bms.name, sample)
+            except:
+                logger.error(sys.exc_info(), exc_info=True)
 
-            PWR_CHG_REG = 120  # regularisation to suppress changes when power is low
-            PWR_CHG_HOLD = 4
-            power_chg = (sample.power - self._last_power) / (abs(self._last_power) + PWR_CHG_REG)
-            if not bms.is_virtual and abs(power_chg) > 0.15 and abs(sample.power) > abs(self._last_power):
-                if bms.verbose_log or (
-                        not self.period_pub and (t_now - self._t_last_power_jump) > PWR_CHG_HOLD):
-                    logger.info('%s Power jump %.0f %% (prev=%.0f last=%.0f, REG=%.0f)', bms.name, power_chg * 100,
-                                self._last_power, sample.power, PWR_CHG_REG)
-                self._t_last_power_jump = t_now
-            self._last_power = sample.power
+        self.downsampler += sample
 
-            if self.period_discov or self.period_pub or \
-                    (t_now - self._t_last_power_jump) < PWR_CHG_HOLD or abs(sample.power) > self.over_power:
-                self._t_pub = t_now
+        log_data = (t_now - self._last_time_log) >= (60 if self.num_samples < 1000 else 300) or bms.verbose_log
+        if log_data:
+            self._last_time_log = t_now
 
-                sample = self.downsampler.pop()
+        voltages = []
 
+        async def cached_fetch_voltages():
+            nonlocal voltages, err
+            if voltages:
+                return voltages
+
+            try:
+                voltages = await self._fetch_voltages_planned()
+            except GroupNotReady as e:
+                logger.debug("%s voltages not ready: %s", bms.name, e)
+                voltages = self._voltages = None
+            except:
+                logger.error("%s error fetching voltage", bms.name, exc_info=1)
+                err = True
+                voltages = self._voltages = None
+
+            return voltages
+
+        if self.sinks:
+            # the group might have fetched them already (and marked the plan done) in this sample
+            voltages = await cached_fetch_voltages()
+            if self._voltages_fresh:
+                for sink in self.sinks:
+                    sink.publish_voltages(bms.name, voltages)
+
+        # z_score = self.power_stats.z_score(sample.power)
+        # if abs(z_score) > 12:
+        #    logger.info('%s Power z_score %.1f (avg=%.0f std=%.2f last=%.0f)', bms.name, z_score, self.power_stats.avg.value, self.power_stats.stddev, sample.power)
+
+        PWR_CHG_REG = 120  # regularisation to suppress changes when power is low
+        PWR_CHG_HOLD = 4
+        power_chg = (sample.power - self._last_power) / (abs(self._last_power) + PWR_CHG_REG)
+        if not bms.is_virtual and abs(power_chg) > 0.15 and abs(sample.power) > abs(self._last_power):
+            if bms.verbose_log or (
+                    not self.period_pub and (t_now - self._t_last_power_jump) > PWR_CHG_HOLD):
+                logger.info('%s Power jump %.0f %% (prev=%.0f last=%.0f, REG=%.0f)', bms.name, power_chg * 100,
+                            self._last_power, sample.power, PWR_CHG_REG)
+            self._t_last_power_jump = t_now
+            if self.adaptive_rate:
+                self.adaptive_rate.activity(t_now, reason='%s power jump' % bms.name)
+        self._last_power = sample.power
+
+        if self.adaptive_rate:
+            self.adaptive_rate.update(sample, t_now,
+                                      soc_thresholds=self.algorithm.soc_thresholds() if self.algorithm else ())
+
+        if self.period_discov or self.period_pub or \
+                (t_now - self._t_last_power_jump) < PWR_CHG_HOLD or abs(sample.power) > self.over_power:
+            self._t_pub = t_now
+
+            sample = self.downsampler.pop()
+
+            publish_sample(mqtt_client, device_topic=self.mqtt_topic_prefix, sample=sample)
+            log_data and logger.info('%s: %s', bms.name, sample)
+
+            voltages = await cached_fetch_voltages()
+            publish_cell_voltages(mqtt_client, device_topic=self.mqtt_topic_prefix, voltages=voltages)
+
+            # temperatures = None
+            if self.period_30s or self.period_discov:
+                if not sample.temperatures:
+                    sample.temperatures = await self._fetch_temperatures_planned()
+                    sample.temperatures = self._filter_temperatures(sample.temperatures)
+                publish_temperatures(mqtt_client, device_topic=self.mqtt_topic_prefix,
+                                     temperatures=sample.temperatures)
+
+            if log_data and (voltages or sample.temperatures) and not bms.is_virtual:
+                logger.info('%s volt=[%s] temp=%s', bms.name,
+                            ','.join(map(str, voltages)) if voltages else voltages,
+                            sample.temperatures)
+
+        if self.period_discov or self.period_30s:
+            self.publish_meters()
+
+        if self._device_info_due() and bms.fetch_plan.due('device_info'):
+            await self._try_fetch_device_info()
+
+        # publish home assistant discovery every 60 samples
+        if self.period_discov:
+            logger.info("Sending HA discovery for %s (num_samples=%d)", bms.name, self.num_samples)
+            publish_hass_discovery(
+                mqtt_client, device_topic=self.mqtt_topic_prefix,
+                expire_after_seconds=self.expire_after_seconds,
+                sample=sample,
+                num_cells=len(voltages) if voltages else 0,
+                temperatures=sample.temperatures,
+                device_info=self.device_info,
+            )
+
+            # publish sample again after discovery
+            if self.period_pub.period > 2:
+                await asyncio.sleep(1)
                 publish_sample(mqtt_client, device_topic=self.mqtt_topic_prefix, sample=sample)
-                log_data and logger.info('%s: %s', bms.name, sample)
-
-                voltages = await cached_fetch_voltages()
-                publish_cell_voltages(mqtt_client, device_topic=self.mqtt_topic_prefix, voltages=voltages)
-
-                # temperatures = None
-                if self.period_30s or self.period_discov:
-                    if not sample.temperatures:
-                        sample.temperatures = await self._fetch_temperatures_cached()
-                        sample.temperatures = self._filter_temperatures(sample.temperatures)
-                    publish_temperatures(mqtt_client, device_topic=self.mqtt_topic_prefix,
-                                         temperatures=sample.temperatures)
-
-                if log_data and (voltages or sample.temperatures) and not bms.is_virtual:
-                    logger.info('%s volt=[%s] temp=%s', bms.name,
-                                ','.join(map(str, voltages)) if voltages else voltages,
-                                sample.temperatures)
-
-            if self.period_discov or self.period_30s:
-                self.publish_meters()
-
-            # publish home assistant discovery every 60 samples
-            if self.period_discov:
-                logger.info("Sending HA discovery for %s (num_samples=%d)", bms.name, self.num_samples)
-                if self.device_info is None:
-                    await self._try_fetch_device_info()
-                publish_hass_discovery(
-                    mqtt_client, device_topic=self.mqtt_topic_prefix,
-                    expire_after_seconds=self.expire_after_seconds,
-                    sample=sample,
-                    num_cells=len(voltages) if voltages else 0,
-                    temperatures=sample.temperatures,
-                    device_info=self.device_info,
-                )
-
-                # publish sample again after discovery
-                if self.period_pub.period > 2:
-                    await asyncio.sleep(1)
-                    publish_sample(mqtt_client, device_topic=self.mqtt_topic_prefix, sample=sample)
 
         self.num_samples += 1
         t_disc = time.time()
@@ -419,6 +569,13 @@ class BmsSampler:
         # pass "light" errors to the caller to trigger a re-connect after too many
         return sample if not err else None
 
+    def _command_slot(self):
+        return self.command_slot() if self.command_slot else contextlib.nullcontext()
+
+    def _on_switch(self, switch_name: str, state: bool):
+        if self.adaptive_rate:
+            self.adaptive_rate.activity(reason='%s switch %s -> %s' % (self.bms.name, switch_name, state))
+
     def publish_meters(self):
         device_topic = self.mqtt_topic_prefix
         for meter in self.meters:
@@ -436,11 +593,15 @@ class BmsSampler:
                 except:
                     logger.error(sys.exc_info(), exc_info=True)
 
+    def _device_info_due(self):
+        return self.device_info is None and self._device_info_supported
+
     async def _try_fetch_device_info(self):
+        self.bms.fetch_plan.done('device_info')
         try:
             self.device_info = await self.bms.fetch_device_info()
         except NotImplementedError:
-            pass
+            self._device_info_supported = False
         except Exception as e:
             logger.warning('%s error fetching device info: %s', self.bms.name, e)
 
@@ -0,0 +1,217 @@
+"""
+Process-wide bluetooth scanner, shared by all connection attempts.
+
+One scanner per adapter runs in the background and keeps a cache of the devices it saw (address, name, RSSI and
+advertisement data). Connection attempts query or await the cache instead of starting their own scan, so devices that
+re-connect at the same time don't fight over the controller. The scanner stops after a while without requests.
+
+Passive devices (that broadcast their data in advertisements) register a listener and are never connected, the scanner
+keeps running while listeners are registered.
+
+Active scanning while BlueZ connects to a device is a known cause of connection failures, so the scanner pauses while
+connections are being established on its adapter (see `paused`).
+"""
+import asyncio
+import contextlib
+import time
+from typing import Callable, Dict, List, Optional
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+
+class Advertisement:
+    def __init__(self, device, adv, t_seen: float):
+        self.device = device  # BLEDevice
+        self.adv = adv  # AdvertisementData
+        self.t_seen = t_seen
+
+    @property
+    def rssi(self):
+        return self.adv.rssi
+
+    @property
+    def name(self):
+        return self.device.name
+
+    def __str__(self):
+        return 'Advertisement(%s,%s,rssi=%s,%.0fs ago)' % (
+            self.device.address, self.name, self.rssi, time.time() - self.t_seen)
+
+
+class ScannerService:
+    IDLE_STOP = 60  # stop scanning after this many seconds without requests
+    MAX_AGE = 30  # a device not seen for longer is considered out of range
+
+    def __init__(self, adapter: Optional[str] = None):
+        self.adapter = adapter
+        self.seen: Dict[str, Advertisement] = {}  # upper case address -> last advertisement
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._listeners: Dict[str, List[Callable[[Advertisement], None]]] = {}
+        self._scanner = None
+        self._lock = asyncio.Lock()
+        self._t_last_request = 0.
+        self._num_paused = 0  # connects in flight
+        self._idle_timer: Optional[asyncio.TimerHandle] = None  # the pending _check_idle
+
+    def __str__(self):
+        return 'ScannerService(%s,%s,%d seen)' % (
+            self.adapter or 'default', 'running' if self.is_running else 'stopped', len(self.seen))
+
+    @property
+    def is_running(self):
+        return self._scanner is not None
+
+    def _on_detection(self, device, adv):
+        address = device.address.upper()
+        self.seen[address] = Advertisement(device, adv, time.time())
+        for key in {address, (device.name or '').strip().upper()}:
+            for fut in self._waiters.pop(key, []):
+                fut.done() or fut.set_result(self.seen[address])
+        for listener in self._listeners.get(address, []):
+            try:
+                listener(self.seen[address])
+            except Exception as e:
+                logger.warning('%s listener error for %s: %s', self, address, e)
+
+    def record(self, device, adv):
+        """ Add a detection of another scan (e.g. the discovery at start-up) to the cache """
+        self._on_detection(device, adv)
+
+    async def ensure_running(self):
+        """
+        Start scanning (if not already) and keep the scanner alive for another IDLE_STOP seconds. While paused, the
+        scanner starts when the connects are done.
+        """
+        self._t_last_request = time.time()
+        if not self._num_paused:
+            await self._start()
+
+    async def _start(self, what='started'):
+        async with self._lock:
+            if self._scanner:
+                return
+            from bleak import BleakScanner
+            kwargs = dict(adapter=self.adapter) if self.adapter else {}
+            scanner = BleakScanner(detection_callback=self._on_detection, **kwargs)
+            await scanner.start()
+            self._scanner = scanner
+            (logger.debug if what == 'resumed' else logger.info)('%s %s', self, what)
+            self._schedule_idle_check(self.IDLE_STOP)
+
+    def _schedule_idle_check(self, delay: float):
+        if self._idle_timer is None:
+            self._idle_timer = asyncio.get_running_loop().call_later(delay, self._check_idle)
+
+    def _wanted(self) -> bool:
+        return bool(self._waiters or self._listeners) or time.time() - self._t_last_request < self.IDLE_STOP
+
+    @contextlib.asynccontextmanager
+    async def paused(self):
+        """ Stop scanning while in this context (e.g. connecting a device), resume afterwards if still needed """
+        self._num_paused += 1
+        try:
+            if self._num_paused == 1 and self._scanner:
+                await self._stop('paused')
+            yield
+        finally:
+            self._num_paused -= 1
+            if not self._num_paused and self._wanted():
+                try:
+                    await self._start('resumed')
+                except Exception as e:
+                    logger.warning('%s error resuming: %s', self, e)
+
+    def _check_idle(self):
+        self._idle_timer = None
+        if not self._scanner:
+            return
+        idle = time.time() - self._t_last_request
+        if self._waiters or self._listeners or idle < self.IDLE_STOP:
+            self._schedule_idle_check(self.IDLE_STOP - idle if idle < self.IDLE_STOP else self.IDLE_STOP)
+            return
+        asyncio.create_task(self.stop())
+
+    async def stop(self):
+        await self._stop('stopped')
+
+    async def _stop(self, what: str):
+        async with self._lock:
+            if not self._scanner:
+                return
+            scanner, self._scanner = self._scanner, None
+            if self._idle_timer:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            try:
+                await scanner.stop()
+            except Exception as e:
+                logger.warning('%s error stopping: %s', self, e)
+            (logger.debug if what == 'paused' else logger.info)('%s %s', self, what)
+
+    async def add_listener(self, address: str, listener: Callable[[Advertisement], None]):
+        """ Call `listener` with each advertisement of the device, until removed """
+        self._listeners.setdefault(address.upper(), []).append(listener)
+        await self.ensure_running()
+
+    def remove_listener(self, address: str, listener: Callable[[Advertisement], None]):
+        listeners = self._listeners.get(address.upper(), [])
+        if listener in listeners:
+            listeners.remove(listener)
+        if not listeners:
+            self._listeners.pop(address.upper(), None)
+
+    def get(self, address: str, max_age: Optional[float] = None) -> Optional[Advertisement]:
+        """ Last advertisement of the device (by address or name), None if not seen (within `max_age` seconds) """
+        key = address.strip().upper()
+        adv = self.seen.get(key) or next(
+            (adv for adv in self.seen.values() if (adv.name or '').strip().upper() == key), None)
+        if adv and max_age is not None and time.time() - adv.t_seen > max_age:
+            return None
+        return adv
+
+    async def wait_for(self, address: str, timeout: float, max_age: Optional[float] = MAX_AGE) -> Advertisement:
+        """
+        Return the advertisement of the device (by address or name), scan until it is seen.
+        :raises asyncio.TimeoutError: if the device was not seen within `timeout` seconds
+        """
+        await self.ensure_running()
+        adv = self.get(address, max_age)
+        if adv:
+            return adv
+
+        key = address.strip().upper()
+        fut = asyncio.get_running_loop().create_future()
+        waiters = self._waiters.setdefault(key, [])
+        waiters.append(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            if fut in waiters:
+                waiters.remove(fut)
+            if not waiters and self._waiters.get(key) is waiters:
+                del self._waiters[key]
+
+
+_scanners: Dict[Optional[str], ScannerService] = {}
+
+
+def get_scanner(adapter: Optional[str] = None) -> ScannerService:
+    """ The shared scanner of the adapter (None for the default adapter) """
+    if adapter not in _scanners:
+        _scanners[adapter] = ScannerService(adapter)
+    return _scanners[adapter]
+
+
+def find_advertisement(address_or_name: str) -> Optional[Advertisement]:
+    """ Latest advertisement of a device (by address or name) seen by any of the scanners """
+    key = address_or_name.strip()
+    found = [adv for scanner in _scanners.values() for address, adv in scanner.seen.items()
+             if address == key.upper() or (adv.name or '').strip() == key]
+    return max(found, key=lambda adv: adv.t_seen, default=None)
+
+
+async def stop_scanners():
+    for scanner in _scanners.values():
+        await scanner.stop()
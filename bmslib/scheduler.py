@@ -0,0 +1,317 @@
+"""
+Periodic job scheduling with absolute deadlines.
+
+A job with period T started at t0 fires at t0 + k*T, regardless of how long each run takes. A run that overlaps the
+next deadline does not stretch the period, the deadline is skipped and counted as missed instead.
+
+The period of a job can change at runtime (see `Job.set_period`), a shorter period wakes the job immediately.
+
+Jobs that share a bluetooth adapter can be limited to a number of concurrent runs per adapter (one in serial mode).
+Commands (e.g. setting a switch) take priority over waiting jobs on the same adapter. The first run of each job
+(connecting the device) starts right away and takes the same adapter slots, so devices on different adapters connect
+concurrently and each job continues on its own schedule as soon as it is connected.
+"""
+import asyncio
+import contextlib
+import math
+import random
+import time
+import traceback
+from collections import deque
+from typing import Callable, Awaitable, List, Optional, Dict
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+MISSED_REPORT_INTERVAL = 60 * 5
+
+
+class Job:
+
+    def __init__(self, fn: Callable[[], Awaitable], period: float, name=None, max_errors=0, continuous=False,
+                 adapter: Optional[Callable[[], str]] = None):
+        """
+
+        :param fn: coroutine function, returns a truthy value on success and can raise
+        :param period: in seconds
+        :param name:
+        :param max_errors: stop scheduling after this many errors in a row (0 = never stop)
+        :param continuous: the job runs until it fails (e.g. push sampling). `period` is the delay before it is
+                           started again, deadlines don't apply.
+        :param adapter: returns the bluetooth adapter the job currently uses (devices can move between adapters),
+                        None if the job doesn't use bluetooth
+        """
+        self.fn = fn
+        self.period = period
+        self.name = name or str(fn)
+        self.max_errors = max_errors
+        self.continuous = continuous
+        self.adapter = adapter
+
+        self.deadline = 0.
+        self.num_runs = 0
+        self.num_missed = 0
+        self.num_errors_row = 0
+        self.last_duration = 0.
+
+        self._num_missed_reported = 0
+        self._t_last_report = 0.
+        self._wakeup: Optional[asyncio.Event] = None  # set by the loop running this job
+
+    def __str__(self):
+        return 'Job(%s,T=%.2fs)' % (self.name, self.period)
+
+    def start(self, t0: float):
+        self.deadline = t0
+        self._t_last_report = t0
+
+    def set_period(self, period: float):
+        """
+        Change the period. A shorter period wakes the job immediately, a longer one applies after the next run.
+        """
+        faster = period < self.period
+        self.period = period
+        if faster:
+            self.wake()
+
+    def wake(self):
+        """ Run the job as soon as possible and start a new deadline grid from there. """
+        self.deadline = min(self.deadline, time.time())
+        if self._wakeup:
+            self._wakeup.set()
+
+    def schedule_next(self, now: float):
+        if self.continuous:
+            self.deadline = now + self.period
+            return
+
+        self.deadline += self.period
+        if self.deadline <= now:
+            missed = math.floor((now - self.deadline) / self.period) + 1
+            self.num_missed += missed
+            self.deadline += missed * self.period
+
+    async def run(self) -> bool:
+        """
+        Run the job once.
+        :return: False if the job had too many errors in a row and should not be scheduled anymore
+        """
+        t = time.time()
+        try:
+            if await self.fn():
+                self.num_errors_row = 0
+        except Exception as e:
+            self.num_errors_row += 1
+            logger.error('Error (num %d, max %d) reading BMS: %s', self.num_errors_row, self.max_errors, e)
+            logger.error('Stack: %s', traceback.format_exc())
+            if self.max_errors and self.num_errors_row > self.max_errors:
+                logger.warning('%s too many errors, abort', self)
+                return False
+        finally:
+            self.num_runs += 1
+            self.last_duration = time.time() - t
+        return True
+
+    def report_missed(self, now: float):
+        if now - self._t_last_report < MISSED_REPORT_INTERVAL:
+            return
+        missed = self.num_missed - self._num_missed_reported
+        if missed:
+            logger.warning('%s missed %d deadlines in the last %.0f min (last run took %.2fs, total missed %d)',
+                           self, missed, (now - self._t_last_report) / 60, self.last_duration, self.num_missed)
+        self._num_missed_reported = self.num_missed
+        self._t_last_report = now
+
+
+class PrioritySemaphore:
+    """
+    Semaphore that serves priority waiters before all others (FIFO within each class).
+    """
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters = {True: deque(), False: deque()}
+
+    async def acquire(self, priority=False):
+        if self._value > 0 and not self._waiters[True] and not self._waiters[False]:
+            self._value -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.cancelled():
+                self._waiters[priority].remove(fut)
+            else:
+                self.release()  # the slot was handed over, pass it on
+            raise
+
+    def release(self):
+        for waiters in (self._waiters[True], self._waiters[False]):
+            while waiters:
+                fut = waiters.popleft()
+                if not fut.done():
+                    fut.set_result(None)
+                    return
+        self._value += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=False):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class Scheduler:
+    """
+    Fires jobs at their deadlines, either one after another (serial) or each job in its own task (concurrent).
+    Continuous jobs always run in their own task.
+    With `adapter_concurrency` jobs run concurrently, but at most that many at once per bluetooth adapter. Serial jobs
+    hold the (single) slot of their adapter too, which they share with first runs and commands.
+    """
+
+    def __init__(self, concurrent: bool, is_shutdown: Callable[[], bool], adapter_concurrency=0,
+                 startup_concurrency=0):
+        """
+
+        :param concurrent:
+        :param is_shutdown:
+        :param adapter_concurrency: max concurrent runs per adapter (0 = unlimited, or serial if not `concurrent`)
+        :param startup_concurrency: the first run of each job (connecting the device) happens concurrently, at most
+                                    this many at once per adapter. Each job continues on its own schedule right after.
+                                    0 = first runs like any other
+        """
+        self.concurrent = concurrent or adapter_concurrency > 0
+        self.adapter_concurrency = adapter_concurrency
+        self.startup_concurrency = startup_concurrency
+        self.jobs: List[Job] = []
+        self._is_shutdown = is_shutdown
+        self._adapter_slots: Dict[str, PrioritySemaphore] = {}
+        self._startup_slots: Dict[str, asyncio.Semaphore] = {}
+
+    def add(self, job: Job):
+        self.jobs.append(job)
+
+    @staticmethod
+    async def _sleep_until(deadline: Callable[[], float], wakeup: asyncio.Event):
+        # deadlines can move while sleeping, so re-evaluate them after each wake-up
+        while True:
+            dt = deadline() - time.time()
+            if dt <= 0:
+                return
+            try:
+                await asyncio.wait_for(wakeup.wait(), dt if math.isfinite(dt) else None)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+    def adapter_slot(self, adapter: str, priority=False):
+        """
+        Async context manager holding one of the adapter's slots. Use `priority` for commands, they are served before
+        waiting jobs.
+        """
+        if self.concurrent and not self.adapter_concurrency:
+            return contextlib.nullcontext()  # unlimited
+        if adapter not in self._adapter_slots:
+            self._adapter_slots[adapter] = PrioritySemaphore(self.adapter_concurrency or 1)
+        return self._adapter_slots[adapter].slot(priority)
+
+    async def _run(self, job: Job) -> bool:
+        if job.adapter is None or job.continuous:
+            return await job.run()
+
+        async with self.adapter_slot(job.adapter()):
+            return await job.run()
+
+    async def _first_run(self, job: Job) -> bool:
+        if not self.startup_concurrency or job.adapter is None or job.continuous:
+            return await self._run(job)
+
+        adapter = job.adapter()
+        if adapter not in self._startup_slots:
+            self._startup_slots[adapter] = asyncio.Semaphore(self.startup_concurrency)
+        async with self._startup_slots[adapter]:
+            return await self._run(job)
+
+    async def _job_loop(self, job: Job):
+        job._wakeup = asyncio.Event()
+        run = self._first_run
+        while not self._is_shutdown():
+            await self._sleep_until(lambda: job.deadline, job._wakeup)
+            if not await run(job):
+                break
+            run = self._run
+            now = time.time()
+            job.schedule_next(now)
+            job.report_missed(now)
+        logger.info("%s loop ends", job)
+
+    async def _serial_loop(self, jobs: List[Job]):
+        wakeup = asyncio.Event()
+        for job in jobs:
+            job._wakeup = wakeup
+
+        started = [] if self.startup_concurrency else list(jobs)
+        failed = []
+
+        async def _start(job: Job):
+            if await self._first_run(job):
+                job.schedule_next(time.time())
+                started.append(job)
+            else:
+                logger.warning('%s failed to start', job)
+                failed.append(job)
+            wakeup.set()
+
+        jobs_shuffle = list(jobs)
+        random.shuffle(jobs_shuffle)
+        startup = [asyncio.create_task(_start(j)) for j in jobs_shuffle if j not in started]
+
+        try:
+            while not self._is_shutdown():
+                # a job that failed to start ends the loop (like a job exceeding its max_errors)
+                await self._sleep_until(
+                    lambda: -math.inf if failed else min((j.deadline for j in started), default=math.inf), wakeup)
+                if failed:
+                    return
+
+                due = [j for j in started if j.deadline <= time.time()]
+                random.shuffle(due)
+                for job in due:
+                    if not await self._run(job):
+                        return
+                    now = time.time()
+                    job.schedule_next(now)
+                    job.report_missed(now)
+        finally:
+            for task in startup:
+                task.done() or task.cancel()
+            logger.info("serial loop ends")
+
+    async def run(self):
+        """
+        Run all jobs until shutdown or until a job exceeds its max_errors.
+        """
+        t0 = time.time()
+        for job in self.jobs:
+            job.start(t0)
+
+        serial = [j for j in self.jobs if not j.continuous and not self.concurrent]
+        loops = [self._job_loop(j) for j in self.jobs if j not in serial]
+        if serial:
+            loops.append(self._serial_loop(serial))
+
+        tasks = [asyncio.create_task(l) for l in loops]
+        if not tasks:
+            return
+
+        try:
+            done, pending = await asyncio.wait(tasks, return_when='FIRST_COMPLETED')
+            logger.debug('Done= %s, Pending=%s', done, pending)
+        finally:
+            for task in tasks:
+                task.done() or task.cancel()
@@ -0,0 +1,377 @@
+"""
+Sharded runtime: BMS devices are read in worker processes, one per bluetooth adapter.
+
+A worker connects to its devices, fetches samples, cell voltages and temperatures and streams them as compact records
+over a pipe. The coordinator (main process) keeps MQTT, sinks, groups, algorithms and meters. For each device it runs
+a regular BmsSampler in push mode on a `ShardProxyBms`, which is fed by the worker's records.
+
+A worker that dies (e.g. a crashed BLE stack) is restarted, the other shards keep running.
+"""
+import asyncio
+import functools
+import multiprocessing
+import signal
+import time
+import traceback
+from typing import Dict, List, Optional, Callable
+
+from bmslib.bms import BmsSample, DeviceInfo, FetchPlan
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+# worker -> coordinator
+MSG_SAMPLE = 's'
+MSG_VOLTAGES = 'v'
+MSG_TEMPERATURES = 't'
+MSG_DEVICE_INFO = 'i'
+MSG_CONNECTED = 'c'
+
+# coordinator -> worker
+CMD_SWITCH = 'switch'
+CMD_RECONNECT = 'reconnect'
+CMD_STOP = 'stop'
+
+SAMPLE_FIELDS = ('voltage', 'current', '_power', 'charge', 'capacity', 'soc', 'cycle_capacity', 'num_cycles',
+                 'balance_current', 'temperatures', 'mos_temperature', 'switches', 'uptime', 'timestamp')
+
+
+def sample_to_record(sample: BmsSample) -> tuple:
+    return tuple(getattr(sample, f) for f in SAMPLE_FIELDS)
+
+
+def record_to_sample(record: tuple) -> BmsSample:
+    # bypass __init__, the values are already normalized
+    sample = BmsSample.__new__(BmsSample)
+    sample.__dict__.update(zip(SAMPLE_FIELDS, record))
+    sample.num_samples = 0
+    return sample
+
+
+class ShardProxyBms:
+    """
+    Stands in for a BMS that is read by a worker process. Push-only: samples arrive through subscribe().
+    """
+    SUPPORTS_PUSH = True
+
+    CONNECT_TIMEOUT = 60
+
+    def __init__(self, bms, shard: 'Shard'):
+        self.address = bms.address
+        self.name = bms.name
+        self.verbose_log = bms.verbose_log
+        self.logger = bms.logger
+        self.shard = shard
+        self.fetch_plan = FetchPlan(voltages=0, temperatures=0, device_info=0)  # all in-memory
+
+        self.TEMPERATURE_STEP = getattr(bms, 'TEMPERATURE_STEP', 0)
+        self.TEMPERATURE_SMOOTH = getattr(bms, 'TEMPERATURE_SMOOTH', 10)
+
+        self._model = type(bms).__name__
+        self._connected = asyncio.Event()
+        self._connect_time = 0
+        self._callbacks: List[Callable[[BmsSample], None]] = []
+        self._voltages: Optional[List[int]] = None
+        self._temperatures: Optional[List[float]] = None
+        self._device_info: Optional[DeviceInfo] = None
+
+    def __str__(self):
+        return 'ShardProxyBms(%s,%s,%s)' % (self._model, self.name, self.shard.key)
+
+    @property
+    def adapter(self):
+        return self.shard.key
+
+    @property
+    def is_connected(self):
+        return self._connected.is_set()
+
+    @property
+    def is_virtual(self):
+        return False
+
+    @property
+    def connect_time(self):
+        return self._connect_time
+
+    def debug_data(self):
+        return "shard %s pid %s" % (self.shard.key, self.shard.pid)
+
+    def set_keep_alive(self, keep):
+        pass
+
+    async def connect(self, timeout=None):
+        # the worker connects on its own, wait for it
+        await asyncio.wait_for(self._connected.wait(), timeout or self.CONNECT_TIMEOUT)
+
+    async def disconnect(self):
+        from bmslib.bt import BtBms
+        if not BtBms.shutdown:  # on shutdown the worker disconnects on its own
+            self.shard.send(CMD_RECONNECT, self.name)
+
+    async def subscribe(self, callback: Callable[[BmsSample], None]):
+        self._callbacks.append(callback)
+
+    async def unsubscribe(self, callback: Callable[[BmsSample], None]):
+        self._callbacks.remove(callback)
+
+    async def fetch_voltages(self):
+        return self._voltages
+
+    async def fetch_temperatures(self):
+        return self._temperatures
+
+    async def fetch_device_info(self):
+        return self._device_info
+
+    async def set_switch(self, switch: str, state: bool):
+        self.shard.send(CMD_SWITCH, self.name, switch, state)
+
+    def on_message(self, kind: str, payload):
+        if kind == MSG_SAMPLE:
+            sample = record_to_sample(payload)
+            for callback in self._callbacks:
+                callback(sample)
+        elif kind == MSG_VOLTAGES:
+            self._voltages = payload
+        elif kind == MSG_TEMPERATURES:
+            self._temperatures = payload
+        elif kind == MSG_DEVICE_INFO:
+            self._device_info = DeviceInfo(**payload)
+        elif kind == MSG_CONNECTED:
+            if payload:
+                self._connect_time = time.time()
+                self._connected.set()
+            else:
+                self._connected.clear()
+
+
+class Shard:
+    """
+    Coordinator side of a worker process.
+    """
+    MAX_RESTART_DELAY = 60
+
+    def __init__(self, key: str, options: dict):
+        """
+
+        :param key: shard name, usually the adapter
+        :param options: worker options (verbose_log, keep_alive, sample_period, concurrent, adapter_concurrency,
+                        keep_alive_slots)
+        """
+        self.key = key
+        self.options = options
+        self.devices: List[dict] = []
+        self.proxies: Dict[str, ShardProxyBms] = {}
+        self.shutdown = False
+
+        self._process = None
+        self._conn = None
+        self._num_restarts = 0
+
+    def __str__(self):
+        return 'Shard(%s,%d devices)' % (self.key, len(self.devices))
+
+    @property
+    def pid(self):
+        return self._process and self._process.pid
+
+    def add(self, bms, dev: dict) -> ShardProxyBms:
+        """
+        Move a BMS into this shard.
+        :param bms: the BMS as constructed from `dev`
+        :param dev: device config, address and alias are resolved
+        :return: the proxy to sample in the coordinator
+        """
+        self.devices.append(dev)
+        proxy = ShardProxyBms(bms, self)
+        self.proxies[proxy.name] = proxy
+        return proxy
+
+    def start(self):
+        ctx = multiprocessing.get_context('spawn')  # don't fork the coordinator's event loop and threads
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=worker_main, args=(child_conn, self.devices, self.options),
+                                    name='shard-%s' % self.key, daemon=True)
+        self._process.start()
+        child_conn.close()
+        asyncio.get_running_loop().add_reader(self._conn.fileno(), self._on_readable)
+        logger.info('%s started worker pid %s', self, self._process.pid)
+
+    def send(self, *msg):
+        try:
+            self._conn.send(msg)
+        except Exception as e:
+            logger.warning('%s error sending %s: %s', self, msg[0], e)
+
+    def _on_readable(self):
+        try:
+            while self._conn.poll():
+                kind, name, payload = self._conn.recv()
+                proxy = self.proxies.get(name)
+                if proxy:
+                    proxy.on_message(kind, payload)
+        except (EOFError, OSError):
+            self._on_worker_exit()
+
+    def _on_worker_exit(self):
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self._conn.fileno())
+        self._conn.close()
+        self._process.join(1)
+        for proxy in self.proxies.values():
+            proxy.on_message(MSG_CONNECTED, False)
+
+        if self.shutdown:
+            return
+
+        self._num_restarts += 1
+        delay = min(2 ** self._num_restarts, self.MAX_RESTART_DELAY)
+        logger.error('%s worker exited (code %s), restart #%d in %ds', self, self._process.exitcode,
+                     self._num_restarts, delay)
+        loop.call_later(delay, lambda: self.shutdown or self.start())
+
+    def stop(self, timeout=5):
+        self.shutdown = True
+        if not self._process:
+            return
+        self.send(CMD_STOP, None)
+        self._process.join(timeout)
+        if self._process.is_alive():
+            logger.warning('%s worker did not stop, terminate', self)
+            self._process.terminate()
+
+
+def worker_main(conn, devices: List[dict], options: dict):
+    # the coordinator handles signals and stops workers with CMD_STOP (or by closing the pipe)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(_worker(conn, devices, options))
+    except Exception as e:
+        logger.error('Shard worker error: %s', e)
+        logger.error('Stack: %s', traceback.format_exc())
+
+
+async def _worker(conn, devices: List[dict], options: dict):
+    from bmslib.bt import BtBms
+    from bmslib.models import construct_bms
+    from bmslib.scanner import stop_scanners
+    from bmslib.scheduler import Scheduler, Job
+
+    verbose_log = options.get('verbose_log', False)
+    stop = asyncio.Event()
+
+    def send(kind, name, payload):
+        try:
+            conn.send((kind, name, payload))
+        except (BrokenPipeError, OSError):
+            stop.set()
+
+    bms_by_name: Dict[str, BtBms] = {}
+    errors: Dict[str, int] = {}
+    scheduler = Scheduler(concurrent=options.get('concurrent', False), is_shutdown=stop.is_set,
+                          adapter_concurrency=options.get('adapter_concurrency', 0))
+
+    for dev in devices:
+        bms = construct_bms(dev, verbose_log, [])
+        if bms is None:
+            logger.error('Shard worker can not construct %s (type %s), skipping it', dev.get('alias'), dev.get('type'))
+            continue
+        bms.set_keep_alive(options.get('keep_alive', False))
+        if dev.get('fetch_plan'):
+            bms.fetch_plan.update(dev['fetch_plan'])
+        bms_by_name[bms.name] = bms
+        period = float(dev.get('sample_period') or options['sample_period'])
+        scheduler.add(Job(functools.partial(_worker_sample, bms, send, errors), period=period, name=bms.name,
+                          adapter=lambda b=bms: b.adapter))
+
+    async def set_switch(bms, switch, state):
+        async with scheduler.adapter_slot(bms.adapter, priority=True):  # before waiting samples
+            await bms.set_switch(switch, state)
+
+    async def run_command(bms, coro, what):
+        try:
+            await coro
+        except Exception as e:
+            bms.logger.warning('%s error executing %s: %s', bms.name, what, e)
+
+    if options.get('keep_alive_slots'):
+        from bmslib.connections import ConnectionPool
+        connection_pool = ConnectionPool(options['keep_alive_slots'])  # the shard owns the adapter
+        for dev in devices:
+            if dev['alias'] in bms_by_name:
+                connection_pool.add(bms_by_name[dev['alias']], priority=int(dev.get('priority') or 0),
+                                    sample_period=float(dev.get('sample_period') or options['sample_period']))
+
+    def on_command():
+        try:
+            while conn.poll():
+                cmd, name, *args = conn.recv()
+                bms = bms_by_name.get(name)
+                if cmd == CMD_STOP:
+                    stop.set()
+                elif cmd == CMD_SWITCH and bms:
+                    asyncio.create_task(run_command(bms, set_switch(bms, *args), cmd))
+                elif cmd == CMD_RECONNECT and bms:
+                    asyncio.create_task(run_command(bms, bms.disconnect(), cmd))
+        except (EOFError, OSError):
+            stop.set()  # coordinator is gone
+
+    loop = asyncio.get_running_loop()
+    loop.add_reader(conn.fileno(), on_command)
+
+    run = asyncio.create_task(scheduler.run())
+    try:
+        await asyncio.wait([run, asyncio.create_task(stop.wait())], return_when='FIRST_COMPLETED')
+    finally:
+        run.cancel()
+        BtBms.shutdown = True
+        for bms in bms_by_name.values():
+            try:
+                await bms.disconnect()
+            except:
+                pass
+        await stop_scanners()
+
+
+async def _worker_sample(bms, send, errors: Dict[str, int]):
+    """
+    Read one sample (plus voltages, temperatures, device info as due in the fetch plan) and send it to the
+    coordinator. The device counts as connected while samples flow.
+    """
+    plan = bms.fetch_plan
+    try:
+        async with bms:
+            if plan.due('device_info'):
+                plan.done('device_info')
+                try:
+                    send(MSG_DEVICE_INFO, bms.name, (await bms.fetch_device_info()).__dict__)
+                except Exception as e:
+                    bms.logger.debug('%s error fetching device info: %s', bms.name, e)
+
+            sample = await bms.fetch()
+
+            if plan.due('voltages') or plan.pending('voltages'):
+                send(MSG_VOLTAGES, bms.name, await bms.fetch_voltages())
+                plan.done('voltages')
+
+            if not sample.temperatures and (plan.due('temperatures') or plan.pending('temperatures')):
+                plan.done('temperatures')
+                try:
+                    send(MSG_TEMPERATURES, bms.name, await bms.fetch_temperatures())
+                except Exception:
+                    pass
+    except Exception:
+        errors[bms.name] = errors.get(bms.name, 0) + 1
+        send(MSG_CONNECTED, bms.name, False)
+        if bms.is_connected and errors[bms.name] > 20:
+            bms.logger.warning("disconnecting %s due to too many errors %d", bms, errors[bms.name])
+            errors[bms.name] = 0
+            await bms.disconnect()
+        raise
+
+    if errors.get(bms.name, -1) != 0:
+        send(MSG_CONNECTED, bms.name, True)
+        errors[bms.name] = 0
+    send(MSG_SAMPLE, bms.name, sample_to_record(sample))
+    return True
@@ -4,6 +4,7 @@ import re
 from os import access, R_OK
 from os.path import isfile
 from threading import Lock
+from typing import Optional
 
 from bmslib.cache import random_str
 from bmslib.util import dotdict, get_logger
@@ -17,6 +18,7 @@ def is_readable(file):
 
 root_dir = '/data/' if is_readable('/data/options.json') else ''
 bms_meter_states_fn = root_dir + 'bms_meter_states.json'
+gatt_cache_fn = root_dir + 'bms_gatt_cache.json'
 
 lock = Lock()
 
@@ -59,6 +61,65 @@ def store_algorithm_state(bms_name, algorithm_name, state=None):
             return bms_state['algorithm_state'].get(algorithm_name, None)
 
 
+_gatt_cache = None
+
+
+def _load_gatt_cache() -> dict:
+    global _gatt_cache
+    if _gatt_cache is None:
+        try:
+            with open(gatt_cache_fn) as f:
+                _gatt_cache = json.load(f)
+        except FileNotFoundError:
+            _gatt_cache = {}
+        except Exception as e:
+            logger.warning('error reading %s: %s', gatt_cache_fn, e)
+            _gatt_cache = {}
+    return _gatt_cache
+
+
+def gatt_cache_key(address: str) -> str:
+    if not isinstance(address, str) or not address:
+        raise ValueError('invalid device address for gatt cache: %r' % (address,))
+    return address.lower()
+
+
+def load_gatt_cache(address: str, firmware: Optional[str] = None) -> dict:
+    """
+    Returns the GATT resolution (characteristic handles, UUIDs, frame variant) that worked with the device the last
+    time, or an empty dict. An entry recorded with another firmware is ignored.
+    """
+    with lock:
+        entry = _load_gatt_cache().get(gatt_cache_key(address)) or {}
+    if firmware is not None and entry.get('firmware') != firmware:
+        return {}
+    return dict(entry)
+
+
+def store_gatt_cache(address: str, firmware: Optional[str] = None, **values):
+    """
+    Record GATT resolution values (must be JSON serializable) of a device. Storing with another firmware than the
+    entry's replaces the entry.
+    """
+    key = gatt_cache_key(address)
+    with lock:
+        cache = _load_gatt_cache()
+        entry = cache.get(key) or {}
+        if firmware is not None and entry.get('firmware') != firmware:
+            entry = dict(firmware=firmware)
+        new_entry = dict(entry, **values)
+        if new_entry == cache.get(key):
+            return
+        cache[key] = new_entry
+        s = f'.{random_str(6)}.tmp'
+        try:
+            with open(gatt_cache_fn + s, 'w') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(gatt_cache_fn + s, gatt_cache_fn)
+        except Exception as e:
+            logger.warning('error writing %s: %s', gatt_cache_fn, e)
+
+
 def load_user_config():
     try:
         with open('/data/options.json') as f:
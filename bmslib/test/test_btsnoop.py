@@ -0,0 +1,72 @@
+import os
+import struct
+import tempfile
+
+from bmslib.btsnoop import BTSNOOP_EPOCH_DELTA, BTSNOOP_MAGIC, DATALINK_H4, read_att
+from bmslib.replay import load_capture, write_capture
+from bmslib.test.test_frame import BASIC_INFO, CELL_VOLTAGES
+
+CONN = 0x0040
+
+
+def _record(t: float, sent: bool, packet: bytes) -> bytes:
+    ts = int(t * 1e6) + BTSNOOP_EPOCH_DELTA
+    return struct.pack('>IIIIq', len(packet), len(packet), 0 if sent else 1, 0, ts) + packet
+
+
+def _acl(t: float, sent: bool, att: bytes, fragment=0) -> bytes:
+    """ ATT pdu in L2CAP, optionally split into ACL fragments of `fragment` bytes """
+    l2cap = struct.pack('<HH', len(att), 4) + att
+    fragment = fragment or len(l2cap)
+    out = b''
+    for i in range(0, len(l2cap), fragment):
+        chunk = l2cap[i:i + fragment]
+        hf = CONN | ((0x1 if i else 0x2) << 12)
+        out += _record(t, sent, b'\x02' + struct.pack('<HH', hf, len(chunk)) + chunk)
+    return out
+
+
+def _log() -> bytes:
+    addr = bytes.fromhex('a4c138000001')[::-1]
+    conn_complete = b'\x04\x3e\x13\x01\x00' + struct.pack('<H', CONN) + b'\x00\x00' + addr + bytes(7)
+    att = [
+        # services and characteristics
+        (1., False, b'\x11\x06' + struct.pack('<HHH', 0x10, 0x1F, 0xFF00)),
+        (1., False, b'\x09\x07' + struct.pack('<HBHH', 0x11, 0x10, 0x12, 0xFF01)
+         + struct.pack('<HBHH', 0x14, 0x0C, 0x15, 0xFF02)),
+        # jbd queries and responses, one response split into 2 notifications
+        (2., True, b'\x52\x15\x00' + bytes.fromhex('dda50300fffd77')),
+        (2.1, False, b'\x1b\x12\x00' + BASIC_INFO[:20]),
+        (2.2, False, b'\x1b\x12\x00' + BASIC_INFO[20:]),
+        (3., True, b'\x52\x15\x00' + bytes.fromhex('dda50400fffc77')),
+        (3.1, False, b'\x1b\x12\x00' + CELL_VOLTAGES),
+    ]
+    return (BTSNOOP_MAGIC + struct.pack('>II', 1, DATALINK_H4) + _record(0.5, False, conn_complete)
+            + b''.join(_acl(t, sent, pdu, fragment=11) for t, sent, pdu in att))
+
+
+def test_read_att():
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'btsnoop_hci.log')
+        with open(fn, 'wb') as f:
+            f.write(_log())
+
+        conns = read_att(fn)
+        assert len(conns) == 1
+        conn = conns[0]
+        assert conn.address == 'A4:C1:38:00:00:01'
+        assert [e.kind for e in conn.events] == ['w', 'n', 'n', 'w', 'n']
+        assert b''.join(e.data for e in conn.events[1:3]) == BASIC_INFO
+        assert conn.char_uuid(0x12) == '0000ff01-0000-1000-8000-00805f9b34fb'
+        assert conn.services[0]['characteristics'][1]['properties'] == ['write-without-response', 'write']
+
+        capture_fn = os.path.join(tmp, 'capture.jsonl')
+        t0 = conn.events[0].t
+        write_capture(capture_fn, dict(address=conn.address, services=conn.services),
+                      [(e.t - t0, e.kind, conn.char_uuid(e.handle), e.data) for e in conn.events])
+        header, events = load_capture(capture_fn)
+        assert header['address'] == conn.address
+        assert events[-1] == (1.1, 'n', '0000ff01-0000-1000-8000-00805f9b34fb', CELL_VOLTAGES)
+
+
+test_read_att()
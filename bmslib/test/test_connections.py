@@ -0,0 +1,78 @@
+import asyncio
+
+from bmslib.connections import ConnectionPool
+
+
+class _Bms:
+    def __init__(self, name, stats):
+        self.name = name
+        self.is_connected = False
+        self.stats = stats
+
+    def set_keep_alive(self, keep):
+        pass
+
+    async def connect(self):
+        await asyncio.sleep(.01)
+        self.is_connected = True
+        self.stats['open'] += 1
+        self.stats['peak'] = max(self.stats['peak'], self.stats['open'])
+
+    async def disconnect(self):
+        self.is_connected = False
+        self.stats['open'] -= 1
+
+
+async def _sample_concurrently(slots, num_devices):
+    stats = dict(open=0, peak=0)
+    pool = ConnectionPool(slots)
+    devices = [_Bms('bms%d' % i, stats) for i in range(num_devices)]
+    for bms in devices:
+        pool.add(bms)
+
+    async def sample(bms):
+        for _ in range(4):
+            await pool.enter(bms)
+            await asyncio.sleep(.02)
+            await pool.exit(bms)
+
+    await asyncio.gather(*map(sample, devices))
+    return stats['peak'], sum(bms.is_connected for bms in devices)
+
+
+def test_slot_budget():
+    peak, num_open = asyncio.run(_sample_concurrently(2, 5))
+    assert peak == 2 and num_open == 1  # the keep-alive device
+
+    peak, num_open = asyncio.run(_sample_concurrently(3, 3))
+    assert peak == 3 and num_open == 3
+
+
+async def _sample_round_robin(periods):
+    stats = dict(open=0, peak=0)
+    pool = ConnectionPool(2)
+    devices = [_Bms('bms%d' % i, stats) for i in range(len(periods))]
+    for bms, period in zip(devices, periods):
+        pool.add(bms, sample_period=period)
+
+    keep_sets = []
+    for _ in range(5):
+        for bms in devices:
+            await pool.enter(bms)
+            await pool.exit(bms)
+            keep_sets.append(frozenset(pool.keep_set()))
+    return keep_sets
+
+
+def test_no_churn():
+    # equal periods: the most recently used device must not take over the keep-alive
+    keep_sets = asyncio.run(_sample_round_robin([1., 1., 1.]))
+    assert len(set(keep_sets)) == 1
+
+    # a clearly faster device does
+    keep_sets = asyncio.run(_sample_round_robin([1., 1., .5]))
+    assert keep_sets[-1] == {'bms2'}
+
+
+test_slot_budget()
+test_no_churn()
@@ -0,0 +1,39 @@
+import asyncio
+
+from bmslib.models import detect_auto_types, detect_bms_type, get_bms_model_class
+from bmslib.scanner import ScannerService, get_scanner
+from bmslib.util import dotdict
+
+
+def test_detect_bms_type():
+    assert detect_bms_type('JK-B2A24S15P', [], []) == 'jk'
+    assert detect_bms_type('DL-40D63C000000', [], []) == 'daly'
+    assert detect_bms_type('SP04S020', [], []) == 'jbd'
+    assert detect_bms_type('Garage', ['0000FFE0-0000-1000-8000-00805F9B34FB'], [0x0B65]) == 'jk'
+    assert detect_bms_type('SmartShunt HQ2', [], [0x02E1]) == 'victron'
+    assert detect_bms_type('SmartShunt HQ2', [], [0x02E1], key='00' * 16) == 'victron_adv'
+    assert detect_bms_type('Phone', ['0000180f-0000-1000-8000-00805f9b34fb'], [0x004C]) is None
+
+    for bms_type in ('jk', 'daly', 'jbd', 'ant', 'sok', 'supervolt', 'victron', 'victron_adv'):
+        assert get_bms_model_class(bms_type)
+
+
+def test_scanner_by_name():
+    scanner = ScannerService()
+    scanner.record(dotdict(address='c8:47:8c:00:00:01', name='Garage '), dotdict(rssi=-70))
+    assert scanner.get('Garage').device.address == 'c8:47:8c:00:00:01'
+    assert scanner.get('C8:47:8C:00:00:01') is scanner.get('garage')
+    assert scanner.get('Shed') is None
+
+
+def test_detect_auto_types_cached():
+    # devices seen by an earlier scan need no further scanning
+    get_scanner().record(dotdict(address='C8:47:8C:00:00:02', name='JK-B2A24S15P'), dotdict(rssi=-60))
+    devices = [dict(address='JK-B2A24S15P', type='auto'), dict(address='#disabled', type='auto'),
+               dict(address='C8:47:8C:00:00:03', type='jk')]
+    assert asyncio.run(detect_auto_types(devices)) == []
+
+
+test_detect_bms_type()
+test_scanner_by_name()
+test_detect_auto_types_cached()
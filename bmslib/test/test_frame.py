@@ -0,0 +1,79 @@
+from bmslib.frame import FrameAssembler
+from bmslib.models.jbd import _check_frame, _frame_length
+
+# JBD responses 0x03 and 0x04, see JBDDummy
+BASIC_INFO = bytes.fromhex('dd03001b0a50fda4b717dac000002cf300000000000016540308020b7d0b77f8e277')
+CELL_VOLTAGES = bytes.fromhex('dd0400100ce50ce20ce90ce60ce30ce40ce70ce5f86777')
+
+
+def _jbd_assembler(frames: list, **kwargs):
+    def on_frame(frame):
+        assert isinstance(frame, memoryview)
+        frames.append(bytes(frame))
+
+    return FrameAssembler(on_frame, header=b'\xdd', length=_frame_length, trailer=b'\x77', check=_check_frame,
+                          **kwargs)
+
+
+def test_split_and_joined():
+    frames = []
+    fa = _jbd_assembler(frames)
+
+    # one response split over notifications
+    fa.feed(BASIC_INFO[:20])
+    assert frames == []
+    fa.feed(BASIC_INFO[20:])
+    assert frames == [BASIC_INFO]
+    assert len(fa) == 0
+
+    # two responses in one notification, the second one cut
+    data = BASIC_INFO + CELL_VOLTAGES
+    fa.feed(data[:40])
+    fa.feed(data[40:])
+    assert frames == [BASIC_INFO, BASIC_INFO, CELL_VOLTAGES]
+    assert fa.num_errors == 0
+
+
+def test_resync():
+    frames = []
+    fa = _jbd_assembler(frames)
+
+    # garbage, then a frame interrupted by the next one
+    fa.feed(b'\x01\x02' + BASIC_INFO[:15])
+    fa.feed(CELL_VOLTAGES)
+    fa.feed(BASIC_INFO)
+    assert frames == [CELL_VOLTAGES, BASIC_INFO]
+
+    # bad checksum
+    corrupt = bytearray(CELL_VOLTAGES)
+    corrupt[6] ^= 0xFF
+    fa.feed(corrupt + CELL_VOLTAGES)
+    assert frames == [CELL_VOLTAGES, BASIC_INFO, CELL_VOLTAGES]
+    assert fa.num_errors > 0
+
+
+def test_overflow():
+    frames = []
+    fa = _jbd_assembler(frames, max_size=40)
+    fa.feed(CELL_VOLTAGES[:10])
+    fa.feed(BASIC_INFO)  # doesn't fit behind the pending bytes
+    assert frames == [BASIC_INFO]
+    for i in range(0, len(CELL_VOLTAGES) * 3, 7):
+        fa.feed((CELL_VOLTAGES * 3)[i:i + 7])
+    assert frames == [BASIC_INFO] + [CELL_VOLTAGES] * 3
+
+
+def test_delimiter():
+    frames = []
+    fa = FrameAssembler(lambda f: frames.append(bytes(f)), header=b':', trailer=b'~')
+    fa.feed(b':0082')
+    fa.feed(b'31~')
+    fa.feed(b':00')  # incomplete, dropped by the next data set
+    fa.feed(b':0102~')
+    assert frames == [b':008231~', b':0102~']
+
+
+test_split_and_joined()
+test_resync()
+test_overflow()
+test_delimiter()
@@ -1,4 +1,5 @@
 import asyncio
+import time
 
 from bmslib import FuturesPool
 
@@ -25,4 +26,106 @@ async def test1():
         pass
 
 
-asyncio.run(test1())
\ No newline at end of file
+asyncio.run(test1())
+
+
+def test_request_queue():
+    async def run():
+        pool = FuturesPool()
+        sent = []
+
+        async def send(n):
+            sent.append(n)
+            asyncio.get_running_loop().call_later(.01, pool.set_result, 1, n)
+
+        # concurrent requests for the same response queue up instead of raising
+        r = await asyncio.gather(*(pool.request(1, lambda n=n: send(n), timeout=1) for n in range(3)))
+        assert r == [0, 1, 2]
+        assert sent == [0, 1, 2]
+
+    asyncio.run(run())
+
+
+def test_request_pipelined():
+    async def run():
+        pool = FuturesPool()
+
+        async def send(name):
+            asyncio.get_running_loop().call_later(.05, pool.set_result, name, name)
+
+        # requests for different responses are in flight at the same time
+        t = time.time()
+        r = await asyncio.gather(pool.request(1, lambda: send(1), timeout=1),
+                                 pool.request((2, 3), lambda: asyncio.gather(send(2), send(3)), timeout=1))
+        assert r == [1, [2, 3]]
+        assert time.time() - t < .09
+
+    asyncio.run(run())
+
+
+def test_request_timeout():
+    async def run():
+        pool = FuturesPool()
+
+        async def send():
+            pass
+
+        try:
+            await pool.request(1, send, timeout=.02)
+            assert False, "no timeout"
+        except asyncio.TimeoutError:
+            pass
+
+        # the queue is free again
+        async def send_ok():
+            pool.set_result(1, 'ok')
+
+        assert await pool.request(1, send_ok, timeout=.02) == 'ok'
+
+    asyncio.run(run())
+
+
+def test_result_before_wait():
+    async def run():
+        pool = FuturesPool()
+        with await pool.acquire_timeout((1, 2), .1):
+            pool.set_result(2, 'b')
+            pool.set_result(2, 'b2')  # repeated responses don't remove the pending result
+            pool.set_result(1, 'a')
+            assert await pool.wait_for((1, 2), .1) == ['a', 'b']
+
+    asyncio.run(run())
+
+
+def test_cancelled_request():
+    async def run():
+        pool = FuturesPool()
+
+        async def send():
+            pass
+
+        # a request waiting in the queue is cancelled, the queue must not stay locked
+        first = asyncio.create_task(pool.request(1, send, timeout=.05))
+        queued = asyncio.create_task(pool.request(1, send, timeout=1))
+        await asyncio.sleep(.01)
+        queued.cancel()
+        try:
+            await first
+        except asyncio.TimeoutError:
+            pass
+        assert not pool._locks[1].locked()
+
+        async def send_ok():
+            pool.set_result(1, 'ok')
+
+        assert await pool.request(1, send_ok, timeout=.02) == 'ok'
+
+        # sync acquire respects the queue
+        with await pool.acquire_timeout(1, .1):
+            try:
+                pool.acquire(1)
+                assert False, "acquired twice"
+            except Exception as e:
+                assert 'already waiting' in str(e)
+
+    asyncio.run(run())
@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+from bmslib.bms import BmsSample
+from bmslib.group import sum_parallel, BmsGroup, GroupNotReady, VirtualGroupBms
+from bmslib.models.dummy import DummyBt
+from bmslib.sampling import BmsSampler, BmsSampleSink
+from bmslib.util import dotdict
+
+
+def test_add_parallel():
+
+    samples = [
+        BmsSample(12.2, 2, charge=33, capacity=100),
+        BmsSample(12.4, 3, charge=77, capacity=100)
+    ]
+    assert samples[0].power == (12.2*2)
+    assert samples[0].soc == 33
+
+    ss = sum_parallel(samples)
+    assert ss.voltage == 12.3
+    assert ss.current == 5
+    assert ss.charge == 110
+    assert ss.capacity == 200
+    assert ss.soc == (33+77) / 2
+
+
+
+def test_partial_aggregate():
+    group = BmsGroup('grp', max_sample_age=10)
+    group.bms_names += ['a', 'b']
+    updates = []
+    group.add_listener(updates.append)
+
+    now = time.time()
+    group.update(dotdict(name='a'), BmsSample(12.2, 2, charge=33, capacity=100, timestamp=now))
+    group.update(dotdict(name='b'), BmsSample(12.4, 3, charge=77, capacity=100, timestamp=now - 20))
+    assert updates == ['a', 'b']
+
+    ss = group.fetch(now)
+    assert ss.stale_members == ('b',)
+    assert ss.current == 2
+    assert ss.values()['num_stale_members'] == 1
+
+    try:
+        group.fetch(now + 20)
+        assert False, "expected GroupNotReady"
+    except GroupNotReady:
+        pass
+
+
+async def _push_aggregate():
+    vg = VirtualGroupBms('a,b', name='grp')
+    for name in 'ab':
+        vg.add_member(dotdict(name=name))
+    emitted = []
+    await vg.subscribe(emitted.append)
+
+    # members deliver voltages before their sample (see BmsSampler)
+    now = time.time()
+    for name in 'ab':
+        vg.group.update_voltages(dotdict(name=name), [3300, 3301])
+        vg.group.update(dotdict(name=name), BmsSample(13.2, 1, charge=50, capacity=100, timestamp=now))
+    assert len(emitted) == 1 and emitted[0].current == 2
+    return await vg.fetch_voltages()
+
+
+def test_push_aggregate():
+    assert asyncio.run(_push_aggregate()) == [3300, 3301] * 2
+
+
+class _VoltageSink(BmsSampleSink):
+    def __init__(self):
+        self.voltages = []
+
+    def publish_sample(self, bms_name, sample):
+        pass
+
+    def publish_voltages(self, bms_name, voltages):
+        self.voltages.append(voltages)
+
+    def publish_meters(self, bms_name, readings):
+        pass
+
+
+async def _member_voltages_to_sinks():
+    bms = DummyBt('dummy', name='a')
+    bms.fetch_plan.update('voltages=10')
+    group = BmsGroup('grp', max_sample_age=10)
+    group.bms_names.append('a')
+    sink = _VoltageSink()
+    sampler = BmsSampler(bms, None, 1, 10, sinks=[sink], bms_group=group)
+    await bms.connect()
+    for _ in range(3):
+        # the group fetches the voltages first, the sink must still get them once
+        await sampler._process_sample(await bms.fetch(), time.time(), time.time())
+    return sink.voltages
+
+
+def test_member_voltages_to_sinks():
+    voltages = asyncio.run(_member_voltages_to_sinks())
+    assert len(voltages) == 1 and len(voltages[0]) == 4
+
+
+test_add_parallel()
+test_partial_aggregate()
+test_push_aggregate()
+test_member_voltages_to_sinks()
@@ -0,0 +1,84 @@
+import math
+import struct
+
+from bmslib.bms import BmsSample, LazyBmsSample
+from bmslib.layout import Field, Layout, unpack_array
+
+LAYOUT = Layout('<', [
+    Field('voltage', 2, 'I', 1e-3),
+    Field('current', 6, 'i', -1e-3),
+    Field('temp', 10, 'h', .1, nan=-2000),
+    Field('soc', 12, 'B'),
+    Field('mos_temp', 4, 'h', .1, variant='new'),  # overlaps voltage
+])
+
+
+def test_unpack():
+    buf = bytearray(16)
+    struct.pack_into('<Iih', buf, 2, 13070, 2500, 251)
+    buf[12] = 87
+
+    v = LAYOUT.unpack(buf)
+    assert v == dict(voltage=13.07, current=-2.5, temp=25.1, soc=87)
+    assert isinstance(v['soc'], int)
+
+    struct.pack_into('<h', buf, 10, -2000)
+    assert math.isnan(LAYOUT.unpack(buf)['temp'])
+
+    # variant fields and shifted offsets
+    shifted = b'\x00' * 3 + bytes(buf)
+    v = LAYOUT.unpack(shifted, variant='new', shift=3)
+    assert v['voltage'] == 13.07 and v['mos_temp'] == struct.unpack_from('<h', buf, 4)[0] / 10
+    assert LAYOUT.compile('new', 3) is LAYOUT.compile('new', 3)
+
+    # frame starting at base
+    assert LAYOUT.unpack(b'\xff' + bytes(buf), base=1)['soc'] == 87
+
+
+def test_unpack_array():
+    buf = b'\x00' + struct.pack('<3H', 3300, 3301, 3302)
+    assert unpack_array(buf, 1, 3, 'H', '<') == [3300, 3301, 3302]
+    buf = b'\x00' + struct.pack('>3H', 3300, 3301, 3302)
+    assert unpack_array(buf, 1, 3, 'H', '>') == [3300, 3301, 3302]
+    assert unpack_array(buf, 1, 0, 'H', '>') == []
+
+
+def test_bias():
+    layout = Layout('>', [Field('temp', 0, 'B', bias=-40), Field('current', 1, 'H', .01, bias=-30000)])
+    v = layout.unpack(struct.pack('>BH', 65, 29750))
+    assert v == dict(temp=25, current=-2.5)
+    assert isinstance(v['temp'], int)
+
+
+def test_lazy_sample():
+    layout = Layout('<', [
+        Field('voltage', 0, 'H', .01),
+        Field('current', 2, 'h', -.01),
+        Field('charge', 4, 'H', .1),
+        Field('capacity', 6, 'H', .1),
+        Field('soc', 8, 'B'),
+        Field('temp1', 9, 'b'),
+    ]).compile()
+    frame = struct.pack('<HhHHBb', 5320, -250, 800, 1000, 80, 21)
+
+    lazy = LazyBmsSample(frame, layout, dict(temperatures=lambda s: [s.raw('temp1')]), timestamp=1.,
+                         switches=dict(charge=True))
+    assert 'voltage' not in lazy.__dict__
+    assert lazy.current == 2.5
+    assert 'voltage' not in lazy.__dict__
+
+    eager = BmsSample(53.2, 2.5, charge=80., capacity=100., soc=80, temperatures=[21], switches=dict(charge=True),
+                      timestamp=1.)
+    assert lazy.soc == eager.soc == 80.
+    assert lazy.values() == eager.values()
+    assert str(lazy) == str(eager)
+
+    inv = LazyBmsSample(frame, layout, timestamp=1.).invert_current()
+    assert inv.current == -2.5 and inv.power == -53.2 * 2.5
+    assert math.isnan(inv.mos_temperature) and inv.temperatures is None
+
+
+test_unpack()
+test_unpack_array()
+test_bias()
+test_lazy_sample()
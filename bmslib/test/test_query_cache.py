@@ -0,0 +1,59 @@
+import asyncio
+
+from bmslib.bms import FetchPlan, QueryCache
+from bmslib.models.dummy import BleakDummyClient
+from bmslib.models.jbd import JbdBt
+
+
+def test_lifetimes():
+    plan = FetchPlan(status=30)
+    cache = QueryCache({'info': QueryCache.STATIC, 'status': QueryCache.SLOW}, plan)
+
+    cache.put('info', 'v1')
+    cache.put('status', 'on')
+    cache.put('sample', 1)  # dynamic, not cached
+    assert cache.get('info') == 'v1' and 'status' in cache
+    assert 'sample' not in cache
+
+    plan.intervals['status'] = 0  # slow entries expired
+    assert 'status' not in cache and 'info' in cache
+
+    plan.intervals['status'] = 30
+    cache.put('status', 'off')
+    cache.invalidate(QueryCache.SLOW)
+    assert 'status' not in cache and 'info' in cache
+
+    cache.invalidate()
+    assert cache.get('info') is None
+
+
+def test_prefetched():
+    plan = FetchPlan(voltages=10)
+    plan.prefetched('voltages')
+    assert plan.pending('voltages') and not plan.due('voltages')
+    plan.done('voltages')  # consumed
+    assert not plan.pending('voltages') and not plan.due('voltages')
+
+
+async def _read_ahead():
+    bms = JbdBt('test_jbd', name='jbd')
+    bms.client = BleakDummyClient('test_jbd', None)
+    writes = []
+    write = bms.client.write_gatt_char
+    bms.client.write_gatt_char = lambda char, data, **kw: writes.append(data[2]) or write(char, data, **kw)
+    await bms.connect()
+    for _ in range(3):
+        await bms.fetch()  # nobody consumes the voltages
+    voltages = await bms.fetch_voltages()
+    await bms.disconnect()
+    return writes, voltages
+
+
+def test_read_ahead_once():
+    writes, voltages = asyncio.run(_read_ahead())
+    assert writes == [0x03, 0x04, 0x03, 0x03] and voltages
+
+
+test_lifetimes()
+test_prefetched()
+test_read_ahead_once()
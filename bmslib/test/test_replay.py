@@ -0,0 +1,46 @@
+import asyncio
+import os
+import tempfile
+
+from bmslib.models.dummy import BleakDummyClient
+from bmslib.models.jbd import JbdBt
+from bmslib.replay import RecordingClient, load_capture
+
+
+async def _record_and_replay(path):
+    bms = JbdBt('test_jbd', name='jbd')
+    bms.client = RecordingClient(BleakDummyClient('test_jbd', None), path)
+    await bms.connect()
+    recorded = await bms.fetch(), await bms.fetch_voltages()
+    await bms.disconnect()
+
+    # a new client (adapter change) appends to the capture of the device
+    bms.client = RecordingClient(BleakDummyClient('test_jbd', None), bms.client.recorder)
+    await bms.connect()
+    await bms.fetch()
+    await bms.disconnect()
+
+    replay = JbdBt('replay_1', name='replay', replay=path, replay_speed=0)
+    await replay.connect()
+    replayed = [(await replay.fetch(), await replay.fetch_voltages()) for _ in range(3)]
+    await replay.disconnect()
+    return recorded, replayed
+
+
+def test_record_and_replay():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'jbd.jsonl.gz')
+        recorded, replayed = asyncio.run(_record_and_replay(path))
+        header, events = load_capture(path)
+
+    assert header['address'] == 'test_jbd'
+    # the 2nd session skips the voltages read-ahead, they are not due yet
+    assert [kind for _, kind, _, _ in events] == ['w', 'n'] * 3
+    sample0, voltages0 = recorded
+    for sample, voltages in replayed:
+        assert (sample.voltage, sample.current, sample.soc, sample.charge) == \
+               (sample0.voltage, sample0.current, sample0.soc, sample0.charge)
+        assert voltages == voltages0
+
+
+test_record_and_replay()
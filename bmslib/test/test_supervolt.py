@@ -0,0 +1,36 @@
+import struct
+
+from bmslib.models.supervolt import SuperVoltBt
+
+# realtime frame: header, date, 16 cell voltages, currents, temperatures, state, alarm, balance, cycles, soc
+CELLS = [3301, 3302, 3303, 3304] + [0] * 12
+REALTIME = b':' + (
+        struct.pack('>BBBH', 1, 0x82, 0x31, 0x3E) + bytes(7) + struct.pack('>16H', *CELLS)
+        + struct.pack('>HH4BHBHHHB', 0, 250, 65, 66, 40, 40, 0xF002, 0, 0, 12, 13, 87) + b'\x00'
+).hex().upper().encode() + b'~'
+CAPACITY = b':' + (
+        struct.pack('>BBBH', 1, 0x10, 0x31, 0x0E) + bytes(2) + struct.pack('>HHH', 800, 1000, 1000) + b'\x00'
+).hex().upper().encode() + b'~'
+
+
+def test_parse():
+    assert len(REALTIME) == 128 and len(CAPACITY) == 30
+
+    bms = SuperVoltBt('AA:BB:CC:DD:EE:FF', name='sv')
+    bms.parseData(REALTIME)
+    assert bms.address == 'AA:BB:CC:DD:EE:FF'
+    assert bms.frame_header == dict(bus_address=1, command=0x82, version=0x31, length=0x3E)
+    assert bms.cellV[:4] == CELLS[:4]
+    assert round(bms.totalV, 3) == 13.21
+    assert bms.loadA == 2.5
+    assert bms.tempC == [25, 26, 0, 0]
+    assert bms.workingState == 0xF002 and bms.soc == 87
+    assert bms.dischargeNumber == 12 and bms.chargeNumber == 13
+
+    bms.parseData(CAPACITY)
+    assert bms.frame_header['command'] == 0x10
+    assert bms.remainingAh == 80 and bms.completeAh == 100 and bms.designedAh == 100
+    assert bms.address == 'AA:BB:CC:DD:EE:FF'
+
+
+test_parse()
@@ -0,0 +1,56 @@
+import math
+
+import pytest
+
+from bmslib.models.victron import decrypt_advertisement, parse_battery_monitor, SmartShuntAdvBt
+from bmslib.scanner import Advertisement
+from bmslib.util import dotdict
+
+KEY = '0df4d0395b7d1e876c0c33ecb9e70dcd'
+
+# battery monitor record: 13.07V, 2.5A charging, 12.3Ah consumed, 87.5%, aux temperature 25°C
+PAYLOAD = bytes.fromhex('ffff1b05000077741227007b00b03600')
+ADVERTISEMENT = bytes.fromhex('100289a3027c4a0d78b7fb9a6f9f89a953766eea018c0e0d')
+
+
+def test_parse_battery_monitor():
+    values = parse_battery_monitor(PAYLOAD)
+    assert values['voltage'] == 13.07
+    assert values['current'] == -2.5
+    assert values['charge'] == -12.3
+    assert values['soc'] == 87.5
+    assert values['temperatures'] == [25.0]
+    assert math.isnan(values['remaining_mins'])
+
+
+def test_decrypt_advertisement():
+    pytest.importorskip('cryptography')  # optional dependency
+
+    model_id, record_type, payload = decrypt_advertisement(ADVERTISEMENT, bytes.fromhex(KEY))
+    assert model_id == 0xA389
+    assert record_type == 0x02
+    assert payload == PAYLOAD
+
+    try:
+        decrypt_advertisement(ADVERTISEMENT, bytes.fromhex('ff' + KEY[2:]))
+        assert False, "key mismatch not detected"
+    except ValueError:
+        pass
+
+
+def test_sample_from_advertisement():
+    pytest.importorskip('cryptography')
+
+    bms = SmartShuntAdvBt('AA:BB:CC:DD:EE:FF', name='shunt', key=KEY)
+    samples = []
+    bms._callbacks.append(samples.append)
+    adv = dotdict(manufacturer_data={0x02E1: ADVERTISEMENT, 0x004C: b'\x02\x15'}, rssi=-60)
+    bms._on_advertisement(Advertisement(dotdict(address='AA:BB:CC:DD:EE:FF', name='shunt'), adv, 1700000000.))
+
+    assert len(samples) == 1
+    assert samples[0].voltage == 13.07
+    assert samples[0].soc == 87.5
+    assert samples[0].timestamp == 1700000000.
+
+
+test_parse_battery_monitor()
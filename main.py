@@ -14,13 +14,18 @@ from paho.mqtt.enums import CallbackAPIVersion
 
 import bmslib.bt
 import mqtt_util
+from bmslib.adapters import AdapterPool
 from bmslib.bms import MIN_VALUE_EXPIRY
+from bmslib.connections import ConnectionPool
 from bmslib.group import BmsGroup, VirtualGroupBms
-from bmslib.models import construct_bms
-from bmslib.sampling import BmsSampler
+from bmslib.models import construct_bms, detect_auto_types, discovery_targets, get_bms_model_type
+from bmslib.sampling import BmsSampler, AdaptiveRate
+from bmslib.scanner import stop_scanners
+from bmslib.scheduler import Scheduler, Job
+from bmslib.shard import Shard
 from bmslib.store import load_user_config
 from bmslib.util import get_logger, exit_process
-from mqtt_util import mqtt_last_publish_time, mqtt_message_handler, mqtt_process_action_queue
+from mqtt_util import mqtt_last_publish_time, mqtt_message_handler, mqtt_start_action_consumers
 
 logger = get_logger(verbose=False)
 
@@ -30,23 +35,6 @@ shutdown = False
 t_last_store = 0
 
 
-async def fetch_loop(fn, period, max_errors):
-    num_errors_row = 0
-    while not shutdown:
-        try:
-            if await fn():
-                num_errors_row = 0
-        except Exception as e:
-            num_errors_row += 1
-            logger.error('Error (num %d, max %d) reading BMS: %s', num_errors_row, max_errors, e)
-            logger.error('Stack: %s', traceback.format_exc())
-            if max_errors and num_errors_row > max_errors:
-                logger.warning('too many errors, abort')
-                break
-        await asyncio.sleep(period)
-    logger.info("fetch_loop %s ends", fn)
-
-
 def store_states(samplers: List[BmsSampler]):
     meter_states = {s.bms.name: s.get_meter_state() for s in samplers}
     from bmslib.store import store_meter_states
@@ -102,12 +90,10 @@ async def background_loop(timeout: float, sampler_list: List[BmsSampler]):
         logger.info("mqtt watchdog loop started with timeout %.1fs", timeout)
 
     while not shutdown:
-
-        await mqtt_process_action_queue()
         if not bg_checks(sampler_list, timeout, t_start):
             break
 
-        await asyncio.sleep(.1)
+        await asyncio.sleep(4)
 
 
 async def main():
@@ -134,14 +120,29 @@ async def main():
         except Exception as e:
             logger.warning("Error power cycling BT: %s", e)
 
+    adapters = [a for a in (user_config.get('adapters') or []) if a]
+    adapter_pool = AdapterPool(adapters) if adapters else None
+
     try:
         if len(sys.argv) > 1 and sys.argv[1] == "skip-discovery":
             raise Exception("skip-discovery")
-        devices = await asyncio.wait_for(bmslib.bt.bt_discovery(logger), 30)
+        # the scan ends as soon as all configured devices were seen
+        targets = discovery_targets(user_config.get('devices', []))
+        if not targets:
+            devices = []
+        elif adapter_pool:
+            devices = await asyncio.wait_for(adapter_pool.discover(targets=targets), 30)
+            logger.info('BT Discovery on %s: %s', ', '.join(adapters),
+                        ', '.join('%s %s' % (d.address, d.name) for d in devices) or '- no devices found -')
+        else:
+            devices = await asyncio.wait_for(bmslib.bt.bt_discovery(logger, targets=targets), 30)
     except Exception as e:
         devices = []
         logger.error('Error discovering devices: %s', e)
 
+    # `type: auto` needs the advertisement, keep scanning for devices the discovery didn't see
+    devices += await detect_auto_types(user_config.get('devices', []))
+
     verbose_log = user_config.get('verbose_log', False)
     if verbose_log:
         logger.info('Verbose logging enabled')
@@ -166,6 +167,31 @@ async def main():
         names.add(name)
         dev_args[name] = dev
 
+        if adapter_pool and not bms.is_virtual and not dev.get('adapter') and bms.adapter != 'fake':
+            await adapter_pool.add(bms)
+
+    if adapter_pool:
+        logger.info('%s', adapter_pool)
+
+    shards: Dict[str, Shard] = {}
+    if user_config.get('shard_by_adapter', False):
+        shard_options = dict(verbose_log=verbose_log, keep_alive=user_config.get('keep_alive', False),
+                             sample_period=float(user_config.get('sample_period', 1.0)),
+                             concurrent=user_config.get('concurrent_sampling', False),
+                             adapter_concurrency=int(user_config.get('adapter_concurrency') or 0),
+                             keep_alive_slots=int(user_config.get('keep_alive_slots') or 0))
+        for i, bms in enumerate(bms_list):
+            if bms.is_virtual:
+                continue
+            key = bms.adapter
+            if key not in shards:
+                shards[key] = Shard(key, shard_options)
+            # the worker constructs the BMS again, pass the resolved type, address, name and adapter
+            dev = dict(dev_args[bms.name], type=get_bms_model_type(type(bms)) or dev_args[bms.name]['type'],
+                       address=bms.address, alias=bms.name, adapter=None if key == 'default' else key)
+            bms_list[i] = shards[key].add(bms, dev)
+        logger.info('Sharded runtime: %s', ', '.join(map(str, shards.values())))
+
     bms_by_name: Dict[str, bmslib.bt.BtBms] = {
         **{bms.address: bms for bms in bms_list if not bms.is_virtual},
         **{bms.name: bms for bms in bms_list}}
@@ -176,6 +202,8 @@ async def main():
 
         if isinstance(bms, VirtualGroupBms):
             group_bms = bms
+            group_bms.group.max_sample_age = float(dev_args[bms.name].get('stale_after') or
+                                                   user_config.get('expire_values_after') or MIN_VALUE_EXPIRY)
             for member_ref in bms.get_member_refs():
                 if member_ref not in bms_by_name:
                     logger.warning('Please choose one of these names: %s', set(bms_by_name.keys()))
@@ -207,6 +235,7 @@ async def main():
         if user_config.get('mqtt_user', None):
             mqtt_client.username_pw_set(user_config.mqtt_user, user_config.mqtt_password)
 
+        mqtt_start_action_consumers()
         mqtt_client.on_message = mqtt_message_handler
 
         try:
@@ -234,6 +263,9 @@ async def main():
     publish_period = float(user_config.get('publish_period', sample_period))
     expire_values_after = float(user_config.get('expire_values_after', MIN_VALUE_EXPIRY))
     ic = user_config.get('invert_current', False)
+    push_sampling = user_config.get('push_sampling', False)
+    adaptive_sampling = user_config.get('adaptive_sampling', False)
+    idle_sample_period = float(user_config.get('idle_sample_period') or 30)
 
     sinks = []
     if user_config.get('influxdb_host', None):
@@ -247,29 +279,69 @@ async def main():
         except:
             logger.warning("failed to init telemetry", exc_info=True)
 
-    sampler_list = [BmsSampler(
-        bms, mqtt_client=mqtt_client,
-        dt_max_seconds=max(60. * 10, sample_period * 2),
-        expire_after_seconds=expire_values_after and max(expire_values_after, int(sample_period * 2 + .5),
-                                                         int(publish_period * 2 + .5)),
-        invert_current=ic,
-        meter_state=meter_states.get(bms.name),
-        publish_period=publish_period,
-        algorithms=dev_args[bms.name].get('algorithm') and dev_args[bms.name].get('algorithm', '').split(";"),
-        current_calibration_factor=float(dev_args[bms.name].get('current_calibration', 1.0)),
-        bms_group=groups_by_bms.get(bms.name),
-        sinks=sinks,
-    ) for bms in bms_list]
-
-    # move groups to the end
-    sampler_list = sorted(sampler_list, key=lambda s: bms.is_virtual)
+    periods: Dict[str, float] = {}
+    sampler_list = []
+    for bms in bms_list:
+        dev = dev_args[bms.name]
+        period = float(dev.get('sample_period') or sample_period)  # per-device override
+        periods[bms.name] = period
+        if dev.get('fetch_plan'):
+            bms.fetch_plan.update(dev['fetch_plan'])
+            logger.info('%s %s', bms.name, bms.fetch_plan)
+        # groups are always updated by their members, passive devices by their advertisements
+        push = (push_sampling or bool(shards) or bms.is_virtual or getattr(bms, 'PASSIVE', False)) \
+               and getattr(bms, 'SUPPORTS_PUSH', False)
+        adaptive_rate = None
+        if adaptive_sampling and not push and not bms.is_virtual:
+            adaptive_rate = AdaptiveRate(fast_period=period, idle_period=idle_sample_period)
+        slowest_period = adaptive_rate.idle_period if adaptive_rate else period
+        sampler_list.append(BmsSampler(
+            bms, mqtt_client=mqtt_client,
+            dt_max_seconds=max(60. * 10, slowest_period * 2),
+            expire_after_seconds=expire_values_after and max(expire_values_after, int(slowest_period * 2 + .5),
+                                                             int(publish_period * 2 + .5)),
+            invert_current=ic,
+            meter_state=meter_states.get(bms.name),
+            publish_period=publish_period,
+            algorithms=dev.get('algorithm') and dev.get('algorithm', '').split(";"),
+            current_calibration_factor=float(dev.get('current_calibration', 1.0)),
+            bms_group=groups_by_bms.get(bms.name),
+            sinks=sinks,
+            push=push,
+            adaptive_rate=adaptive_rate,
+        ))
+
+    keep_alive_slots = int(user_config.get('keep_alive_slots') or 0)
+    if keep_alive_slots and not shards:
+        # push sampled devices hold their connection permanently
+        num_push = sum(s.push for s in sampler_list if not s.bms.is_virtual)
+        num_pooled = sum(not s.bms.is_virtual and not s.push for s in sampler_list)
+        if num_pooled and keep_alive_slots - num_push < 1:
+            logger.warning('keep_alive_slots=%d are all taken by %d push sampled devices, the other %d devices need '
+                           'one more connection (%d open at most)', keep_alive_slots, num_push, num_pooled,
+                           num_push + 1)
+        connection_pool = ConnectionPool(max(1, keep_alive_slots - num_push))
+        for s in sampler_list:
+            if not s.bms.is_virtual and not s.push:
+                connection_pool.add(s.bms, priority=int(dev_args[s.bms.name].get('priority') or 0),
+                                    sample_period=periods[s.bms.name])
+        logger.info('%s keep-alive %s', connection_pool, ', '.join(sorted(connection_pool.keep_set())))
 
     parallel_fetch = user_config.get('concurrent_sampling', False)
+    adapter_concurrency = int(user_config.get('adapter_concurrency') or 0)
 
-    logger.info('Fetching %d BMS + %d virtual + %d others %s, period=%.2fs, keep_alive=%s',
+    logger.info('Fetching %d BMS + %d virtual + %d others %s, period=%.2fs, keep_alive=%s, push=%d, adaptive=%d',
                 sum(not bms.is_virtual for bms in bms_list),
                 sum(bms.is_virtual for bms in bms_list), len(extra_tasks),
-                'concurrently' if parallel_fetch else 'serially', sample_period, user_config.get('keep_alive', False))
+                'concurrently' if parallel_fetch or adapter_concurrency else 'serially', sample_period,
+                user_config.get('keep_alive', False),
+                sum(s.push for s in sampler_list), sum(bool(s.adaptive_rate) for s in sampler_list))
+    for name, period in periods.items():
+        if period != sample_period:
+            logger.info('%s sample_period=%.2fs', name, period)
+    if adapter_concurrency:
+        logger.info('At most %d BMS reads at once per adapter (%s)', adapter_concurrency,
+                    ', '.join(sorted(set(bms.adapter for bms in bms_list if not bms.is_virtual))))
 
     watchdog_en = user_config.get('watchdog', False)
     max_errors = 200 if watchdog_en else 0
@@ -285,52 +357,50 @@ async def main():
 
     tasks = sampler_list + extra_tasks
 
-    # before we start the loops connect to each bms in random order
-    tasks_shuffle = list(tasks)
-    random.shuffle(tasks_shuffle)
-    for t in tasks_shuffle:
-        if isinstance(t, BmsSampler) and t.bms.is_virtual:
-            continue
-        try:
-            await t()
-        except:
-            pass
-
     if pair_only:
+        # connect to each bms in random order
+        tasks_shuffle = list(tasks)
+        random.shuffle(tasks_shuffle)
+        for t in tasks_shuffle:
+            if isinstance(t, BmsSampler) and (t.bms.is_virtual or t.push):
+                continue
+            try:
+                await t()
+            except:
+                pass
         sys.exit(0)
 
-    if parallel_fetch:
-        # parallel_fetch now uses a loop for each BMS, so they don't delay each other
+    for shard in shards.values():
+        shard.start()
+
+    def make_scheduler():
+        # the first sample connects the bms: connect concurrently (one at a time per adapter), each device starts
+        # sampling as soon as it is connected
+        scheduler = Scheduler(concurrent=parallel_fetch, is_shutdown=lambda: shutdown,
+                              adapter_concurrency=adapter_concurrency, startup_concurrency=adapter_concurrency or 1)
+        for t in tasks:
+            if isinstance(t, BmsSampler):
+                # push samplers run until the connection drops, `period` is the delay before re-connecting
+                job = Job(t, period=periods[t.bms.name], name=t.bms.name, max_errors=max_errors, continuous=t.push,
+                          adapter=None if t.bms.is_virtual else lambda b=t.bms: b.adapter)
+                if not t.bms.is_virtual:
+                    t.command_slot = lambda b=t.bms: scheduler.adapter_slot(b.adapter, priority=True)
+                if t.adaptive_rate:
+                    job.period = t.adaptive_rate.period
+                    t.adaptive_rate.on_change = job.set_period
+                scheduler.add(job)
+            else:
+                scheduler.add(Job(t, period=sample_period, max_errors=max_errors))
+        return scheduler
+
+    if parallel_fetch or adapter_concurrency:
+        # parallel_fetch uses a loop for each BMS, so they don't delay each other
 
         # this outer while loop recovers from a cancelled task. this happens when a device disconnects (bleak bug?)
         while not shutdown:
-            loops = [asyncio.create_task(fetch_loop(fn, period=sample_period, max_errors=max_errors)) for fn in tasks]
-            done, pending = await asyncio.wait(loops, return_when='FIRST_COMPLETED')
-
-            logger.debug('Done= %s, Pending=%s', done, pending)
-            for task in loops:
-                logger.debug('Task %s is done=%s', task, task.done())
-                task.done() or task.cancel()
-
+            await make_scheduler().run()
     else:
-        async def fn():
-            if parallel_fetch:
-                # concurrent synchronised fetch
-                # this branch is currently not reachable!
-                await asyncio.gather(*[t() for t in tasks], return_exceptions=False)
-            else:
-                random.shuffle(tasks)
-                exceptions = []
-                for t in tasks:
-                    try:
-                        await t()
-                    except Exception as ex:
-                        exceptions.append(ex)
-                if exceptions:
-                    logger.error('%d exceptions occurred fetching BMSs', len(exceptions))
-                    raise exceptions[0]
-
-        await fetch_loop(fn, period=sample_period, max_errors=max_errors)
+        await make_scheduler().run()
 
     logger.info('All fetch loops ended. shutdown is already %s', shutdown)
     shutdown = True
@@ -351,6 +421,14 @@ async def main():
         except:
             pass
 
+    try:
+        await stop_scanners()
+    except Exception as e:
+        logger.warning('Error stopping scanners: %s', e)
+
+    for shard in shards.values():
+        shard.stop()
+
 
 def on_exit(*args, **kwargs):
     global shutdown
@@ -361,16 +439,17 @@ def on_exit(*args, **kwargs):
         sys.exit(1)
 
 
-atexit.register(on_exit)
-# noinspection PyTypeChecker
-signal.signal(signal.SIGTERM, on_exit)
-# noinspection PyTypeChecker
-signal.signal(signal.SIGINT, on_exit)
+if __name__ == '__main__':  # shard workers (spawn) import this module
+    atexit.register(on_exit)
+    # noinspection PyTypeChecker
+    signal.signal(signal.SIGTERM, on_exit)
+    # noinspection PyTypeChecker
+    signal.signal(signal.SIGINT, on_exit)
 
-try:
-    asyncio.run(main())
-except Exception as e:
-    logger.error("Main loop exception: %s", e)
-    logger.error("Stack: %s", traceback.format_exc())
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        logger.error("Main loop exception: %s", e)
+        logger.error("Stack: %s", traceback.format_exc())
 
-sys.exit(1)
+    sys.exit(1)
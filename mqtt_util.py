@@ -5,12 +5,13 @@ HA mdi: icons https://pictogrammers.com/library/mdi/
 
 """
 import asyncio
+import functools
 import json
 import math
-import queue
 import statistics
 import time
 import traceback
+from typing import Callable, Dict, Optional
 
 import paho.mqtt.client as paho
 
@@ -385,25 +386,75 @@ def publish_hass_discovery(client, device_topic, expire_after_seconds: int, samp
 
 
 _switch_callbacks = {}
-_message_queue = queue.Queue()
+_switch_devices: Dict[str, str] = {}  # topic -> bms name
+
+# commands are handed over from paho's network thread to the event loop. each device has its own consumer, so a slow
+# device doesn't delay the commands of others. repeated commands for the same switch coalesce while they wait, only
+# the latest state is applied
+_action_loop: Optional[asyncio.AbstractEventLoop] = None
+_action_queues: Dict[str, asyncio.Queue] = {}  # bms name -> queue of topics
+_action_consumers: Dict[str, asyncio.Task] = {}
+_pending_actions: Dict[str, str] = {}  # topic -> payload
+
+
+def mqtt_start_action_consumers():
+    """
+    Prepare the execution of switch commands. Call from the event loop before subscribing switches. The consumer of
+    a device starts with its first command.
+    """
+    global _action_loop
+    _action_loop = asyncio.get_running_loop()
+
+
+def _put_action(topic: str, payload: str):
+    device = _switch_devices[topic]
+    if device not in _action_consumers:
+        _action_queues.setdefault(device, asyncio.Queue())
+        task = asyncio.create_task(_consume_actions(_action_queues[device]))
+        task.add_done_callback(functools.partial(_on_consumer_done, device))
+        _action_consumers[device] = task
+
+    if topic in _pending_actions:
+        logger.info('coalesce %s: %s -> %s', topic, _pending_actions[topic], payload)
+    else:
+        _action_queues[device].put_nowait(topic)
+    _pending_actions[topic] = payload
+
 
+def _on_consumer_done(device: str, task: asyncio.Task):
+    _action_consumers.pop(device, None)  # the next command starts a new one
+    if not task.cancelled() and task.exception():
+        logger.error('%s action consumer crashed: %s', device, task.exception(), exc_info=task.exception())
 
-async def mqtt_process_action_queue():
-    while not _message_queue.empty():
-        callback, arg = _message_queue.get(block=False)
+
+async def _consume_actions(queue: asyncio.Queue):
+    while True:
+        topic = await queue.get()
+        payload = _pending_actions.pop(topic)
         try:
-            await callback(arg)
+            await _switch_callbacks[topic](payload)
         except Exception as e:
             logger.error('exception in action callback: %s', e)
             logger.error('Stack: %s', traceback.format_exc())
-            await asyncio.sleep(1)
 
 
-def subscribe_switches(mqtt_client: paho.Client, device_topic, bms: BtBms, switches):
+def subscribe_switches(mqtt_client: paho.Client, device_topic, bms: BtBms, switches, on_set: Callable = None,
+                       slot: Callable = None):
+    """
+
+    :param on_set: called with (switch_name, state) after the switch was set
+    :param slot: returns an async context manager to hold while setting the switch (priority access to the adapter)
+    """
+
     async def set_switch(switch_name: str, state: bool):
         assert isinstance(state, bool)
         logger.info('Set %s %s switch %s', bms.name, switch_name, state)
-        await bms.set_switch(switch_name, state)
+        if slot:
+            async with slot():
+                await bms.set_switch(switch_name, state)
+        else:
+            await bms.set_switch(switch_name, state)
+        on_set and on_set(switch_name, state)
         topic = f"{device_topic}/switch/{switch_name}"
         mqtt_single_out(mqtt_client, topic, 'ON' if state else 'OFF')
 
@@ -413,16 +464,19 @@ def subscribe_switches(mqtt_client: paho.Client, device_topic, bms: BtBms, switc
         mqtt_client.subscribe(state_topic, qos=2)
         _switch_callbacks[state_topic] = \
             lambda msg, sn=switch_name: set_switch(sn, msg.lower() == "on")
+        _switch_devices[state_topic] = bms.name
 
 
 def mqtt_message_handler(client, userdata, message: paho.MQTTMessage):
+    # runs on paho's network thread
     payload = message.payload.decode("utf-8")
     logger.info("received msg %s: %s", message.topic, payload)
-    callback = _switch_callbacks.get(message.topic, None)
-    if callback:
-        _message_queue.put((callback, payload))
-    else:
+    if message.topic not in _switch_callbacks:
         logger.warning("No callback for topic %s (payload %s)", message.topic, payload)
+    elif not _action_loop:
+        logger.warning("Action consumer not started, drop %s (payload %s)", message.topic, payload)
+    else:
+        _action_loop.call_soon_threadsafe(_put_action, message.topic, payload)
 
 
 def paho_monkey_patch():
@@ -0,0 +1,100 @@
+"""
+Import a btsnoop HCI log (see doc/dev/BT Sniffing.md) of a BMS app session.
+
+For each BLE connection in the log it writes
+* `<name>.jsonl.gz`: the ATT writes, reads and notifications as a capture for the replay transport (bmslib/replay.py)
+* `<name>.frames.jsonl`: with `--type`, the notifications reassembled into response frames by the model's framing
+  rules, one `{"t": .., "char": .., "frame": "<hex>"}` per line, as decoder test vectors
+
+    python3 tools/btsnoop_import.py btsnoop_hci.log --type jk --out fixtures/
+
+Replay the capture with a device `replay: fixtures/C8_47_8C_00_00_00.jsonl.gz` or with tools/replay_bench.py.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bmslib.btsnoop import Connection, read_att
+from bmslib.frame import FrameAssembler
+from bmslib.models import get_bms_model_class
+from bmslib.replay import write_capture
+
+
+def import_connection(conn: Connection, out_dir: str, bms_class=None):
+    name = re.sub(r'[^\w.-]', '_', conn.address or 'conn_%04x' % conn.handle)
+    t0 = conn.events[0].t
+
+    def char(handle):
+        # replay clients match characteristics by uuid, if the log has the service discovery
+        return conn.char_uuid(handle) or handle
+
+    services = [dict(uuid=s['uuid'], characteristics=s['characteristics']) for s in conn.services]
+    events = [(e.t - t0, e.kind, char(e.handle), e.data) for e in conn.events]
+    capture_fn = os.path.join(out_dir, name + '.jsonl.gz')
+    write_capture(capture_fn, dict(address=conn.address or name, t0=t0, services=services), events)
+
+    counts = {k: sum(1 for e in conn.events if e.kind == k) for k in 'wrn'}
+    print('%s: %d writes, %d reads, %d notifications, %d services -> %s' % (
+        name, counts['w'], counts['r'], counts['n'], len(services), capture_fn))
+
+    if bms_class is None:
+        return
+
+    framing = getattr(bms_class, 'FRAMING', None)
+    if not framing:
+        print('%s has no FRAMING rules, skipping frames' % bms_class.__name__)
+        return
+
+    frames = []
+    assemblers = {}
+    for e in conn.events:
+        if e.kind != 'n':
+            continue
+        if e.handle not in assemblers:
+            def on_frame(frame, handle=e.handle):
+                frames.append(dict(t=round(t_now - t0, 4), char=char(handle), frame=bytes(frame).hex()))
+
+            assemblers[e.handle] = FrameAssembler(on_frame, **framing)
+        t_now = e.t
+        assemblers[e.handle].feed(e.data)
+
+    frames_fn = os.path.join(out_dir, name + '.frames.jsonl')
+    with open(frames_fn, 'w') as f:
+        for frame in frames:
+            f.write(json.dumps(frame) + '\n')
+    print('%s: %d %s frames (%d framing errors) -> %s' % (
+        name, len(frames), bms_class.__name__, sum(a.num_errors for a in assemblers.values()), frames_fn))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('log', help='btsnoop file (Android btsnoop_hci.log, PacketLogger/Wireshark export, btmon)')
+    parser.add_argument('--type', help='device type (jk, jbd, daly, ..) to reassemble response frames')
+    parser.add_argument('--address', help='only import connections to this device')
+    parser.add_argument('--out', default='.', help='output directory')
+    args = parser.parse_args()
+
+    bms_class = None
+    if args.type:
+        bms_class = get_bms_model_class(args.type)
+        if bms_class is None:
+            parser.error('unknown type %s' % args.type)
+
+    connections = read_att(args.log)
+    if args.address:
+        connections = [c for c in connections if (c.address or '').upper() == args.address.upper()]
+    if not connections:
+        print('no ATT traffic found')
+        return
+
+    os.makedirs(args.out, exist_ok=True)
+    for conn in connections:
+        import_connection(conn, args.out, bms_class)
+
+
+if __name__ == '__main__':
+    main()
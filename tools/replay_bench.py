@@ -0,0 +1,73 @@
+"""
+Benchmark the sampling pipeline with many replayed devices, without bluetooth hardware.
+
+Record a capture first by adding `capture: capture_jk.jsonl.gz` to a device in the add-on config, then:
+
+    python3 tools/replay_bench.py capture_jk.jsonl.gz --type jk --devices 200 --speed 10 --duration 30
+
+Each device runs a BmsSampler (without MQTT) on its own ReplayClient, see bmslib/replay.py.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bmslib.models import get_bms_model_class
+from bmslib.sampling import BmsSampler
+
+
+async def run_device(sampler: BmsSampler, t_end: float, period: float, latencies: list):
+    while time.time() < t_end:
+        t0 = time.time()
+        try:
+            await sampler()
+        except Exception:
+            pass
+        latencies.append(time.time() - t0)
+        await asyncio.sleep(max(0., period - (time.time() - t0)))
+    await sampler.bms.disconnect()
+
+
+async def main(args):
+    bms_class = get_bms_model_class(args.type)
+    assert bms_class, 'unknown type %s' % args.type
+
+    samplers = []
+    for i in range(args.devices):
+        bms = bms_class('replay_%d' % i, name='replay_%d' % i, replay=args.capture, replay_speed=args.speed)
+        samplers.append(BmsSampler(bms, mqtt_client=None, dt_max_seconds=600, expire_after_seconds=0,
+                                   push=args.push))
+    # after constructing the devices, get_logger() resets the level
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    latencies = []
+    t_start, cpu_start = time.time(), time.process_time()
+    t_end = t_start + args.duration
+    await asyncio.gather(*(run_device(s, t_end, args.period, latencies) for s in samplers))
+    wall, cpu = time.time() - t_start, time.process_time() - cpu_start
+
+    num_samples = sum(s.num_samples for s in samplers)
+    print('%d devices, %d samples in %.1fs: %.1f samples/s, cpu %.1fs (%.2f ms/sample)' % (
+        args.devices, num_samples, wall, num_samples / wall, cpu, cpu * 1e3 / max(1, num_samples)))
+    if len(latencies) > 1:
+        q = statistics.quantiles(latencies, n=100)
+        print('sample latency p50 %.1f ms, p95 %.1f ms, max %.1f ms' % (
+            q[49] * 1e3, q[94] * 1e3, max(latencies) * 1e3))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('capture', help='capture file recorded with the `capture` device option')
+    parser.add_argument('--type', required=True, help='device type of the capture, e.g. jk, jbd, daly')
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--speed', type=float, default=1., help='replay speed factor, 0 for no delays')
+    parser.add_argument('--period', type=float, default=1., help='sample period in seconds')
+    parser.add_argument('--duration', type=float, default=30.)
+    parser.add_argument('--push', action='store_true', help='sample pushed frames (subscribe) instead of polling')
+    parser.add_argument('--verbose', action='store_true')
+    asyncio.run(main(parser.parse_args()))